@@ -1730,6 +1730,9 @@ class Main(QtWidgets.QWidget):
         its effect. By default, the same type of data is calculated as the one
         of the read data (magnetic vs gravity and if magnetic, the same
         parameters for the Earth's field)')
+        Prisms of a model file are read and calculated by chunks (see
+        io.read_synthetic_chunks), their effects being accumulated, so that
+        memory use does not depend on the number of prisms.
 
         Returns
         -------
@@ -1737,8 +1740,8 @@ class Main(QtWidgets.QWidget):
 
         """
         data_type = self.data_types[self.actual_plotted_file][0]
-        x, y, z, sus, rem, rem_i, rem_d, rho = io.read_synthetic_model()
-        if x is None:
+        file = io.synthetic_model_file()
+        if file is None:
             nprism = 0
             x1 = []
             x2 = []
@@ -1807,7 +1810,9 @@ class Main(QtWidgets.QWidget):
                         f"{x[i, 0]} {x[i, 1]} {y[i, 0]} {y[i, 1]} "
                         + f"{z[i, 0]} {z[i, 1]} {s} {rem[i]} {rem_i[i]} "
                         + f"{rem_d[i]} {rho[i]}\n")
-        nprism = len(sus)
+            chunks = [(x, y, z, sus, rem, rem_i, rem_d, rho)]
+        else:
+            chunks = io.read_synthetic_chunks(file)
         xmin = self.data.xmin
         xmax = self.data.xmax
         ymin = self.data.ymin
@@ -1834,6 +1839,8 @@ class Main(QtWidgets.QWidget):
         ymin = float(results[4])
         ymax = float(results[5])
         dy = float(results[6])
+        height1 = 0.0
+        height2 = 0.0
         if len(labels) > 7:
             height1 = float(results[8])
             if results[9].lower() == "none":
@@ -1860,32 +1867,37 @@ class Main(QtWidgets.QWidget):
             xdat.append(xd)
             ydat.append(yd)
             zdat.append(np.ones_like(xd) * height2)
-        self.sPrism = PP(earth)
-        for i in range(nprism):
-            self.sPrism.add_prism(
-                x[i], y[i], z[i], sus[i], rem[i], rem_i[i], rem_d[i], rho[i])
+# Effects of all prisms of a chunk are calculated at both heights in one pass
+        xp = xd.flatten()
+        yp = yd.flatten()
+        zp = np.full(ndat1, height1)
+        if height2 != height1:
+            zp = np.array([zp, np.full(ndat1, height2)])
+        data_mod = np.zeros(zp.shape)
+        outlines = []
+        nprism = 0
+        for chunk in chunks:
+# Reading of the model file was aborted: nothing is plotted nor stored
+            if chunk is None:
+                print("Synthetic model calculation aborted")
+                return
+            x, y, z, sus, rem, rem_i, rem_d, rho = chunk
+            sPrism = PP(earth)
+            sPrism.add_prisms(x, y, z, sus, rem, rem_i, rem_d, rho)
+            if "m" in data_type:
+                data_mod += sPrism.mag_forward(xp, yp, zp)[..., 4]
+            else:
+                data_mod += sPrism.grav_forward(xp, yp, zp)
+# Only distinct horizontal outlines are kept for plotting
+            outlines.append(np.unique(np.column_stack((x, y)), axis=0))
+            nprism += len(x)
+            print(f"Synthetic model: effects of {nprism} prisms calculated")
+        if nprism == 0:
+            print("No prism defined, synthetic model calculation aborted")
+            return
         inv = inversion(data, xdat, ydat, zdat, earth=earth,
                         data_type=data_type)
-        inv.mPrism = self.sPrism
-        inv.params = np.zeros(nprism + 1)
-        if "m" in data_type:
-            if abs(sus).max() > 0.0:
-                inv.sus_inv = True
-                inv.params[:nprism] = sus
-            if abs(rem).max() > 0.0:
-                inv.rem_inv = True
-                inv.params[:nprism] = rem
-        else:
-            inv.rho_inv = True
-            inv.params[:nprism] = rho
-            inv.params
-        inv.max_iter = 0
-        if height1 != height2:
-            inv.x = np.concatenate((xdat[0].flatten(), xdat[1].flatten()))
-            inv.y = np.concatenate((ydat[0].flatten(), ydat[1].flatten()))
-            inv.z = np.concatenate((zdat[0].flatten(), zdat[1].flatten()))
-            inv.data = np.zeros_like(inv.x)
-        inv.run_inversion()
+        inv.data_mod = data_mod.flatten()
         dat = io.Data(0)
         if height1 == height2:
             dat.store_gxf("synthetic_data.gxf", inv.data_mod.reshape(d_shape),
@@ -1905,7 +1917,7 @@ class Main(QtWidgets.QWidget):
                 fo.write(f"{self.earth.inc}\n")
                 dec = self.earth.dec
                 fo.write(f'{dec+self.dat[-1].data["line_declination"]}\n')
-        inv.show_synthetic()
+        inv.show_synthetic(outlines)
 
     def Handler(self, signal_received, frame):
         """
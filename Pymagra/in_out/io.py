@@ -10,6 +10,8 @@ Contains functions for data input/output
 Contains methods:
     - get_files
     - read_lineaments
+    - synthetic_model_file
+    - read_synthetic_chunks
     - read_synthetic_model
     - read_geography_file
     - get_mag_field
@@ -22,6 +24,7 @@ Contains methods:
 #            eliminate_nans (actually not used)
 import sys
 import os
+from itertools import islice
 import numpy as np
 from PyQt5 import QtWidgets
 
@@ -194,9 +197,105 @@ def read_lineaments(file="lineaments.dat"):
     return lineaments
 
 
+def synthetic_model_file():
+    """
+    Ask for the name of a synthetic model file (see read_synthetic_model)
+
+    Returns
+    -------
+    str or None
+        Name of the file. None if no file was chosen.
+
+    """
+    file = list(
+        QtWidgets.QFileDialog.getOpenFileName(
+            None, "Select model file", "",
+            filter="txt/dat/mod (*.txt *.dat *.mod) ;; all (*.*)"))
+    if len(file) == 0:
+        print("No file chosen, program finishes")
+        return None
+    if len(file[0]) < 1:
+        print("read_synthetic_model: No files read")
+        return None
+    return file[0]
+
+
+def read_synthetic_chunks(file, chunk_size=5000):
+    """
+    Read a synthetic model file (format see read_synthetic_model) by chunks
+    of prisms. Memory use does not depend on the size of the model, so that
+    effects of very large models may be accumulated chunk by chunk.
+    Missing remanence and density columns are set to zero. If lines have
+    less than 11 columns, the user is asked once whether to continue.
+    If the file is not valid or the user abandons, None is yielded as last
+    item, so that effects of the chunks already read may be discarded.
+
+    Parameters
+    ----------
+    file : str
+        Name of model file
+    chunk_size : int, optional; default: 5000
+        Maximum number of prisms per chunk
+
+    Yields
+    ------
+    x, y, z : numpy float arrays of shape (n_chunk, 2)
+        X, Y and Z-coordinates of prisms.
+    sus, rem, rem_i, rem_d, rho : numpy float arrays of shape (n_chunk)
+        Susceptibilities, remanence intensities, inclinations and
+        declinations and densities of prisms.
+    None
+        If reading was aborted
+
+    """
+    warned = False
+    with open(file, "r") as fi:
+        while True:
+            lines = list(islice(fi, chunk_size))
+            if len(lines) == 0:
+                return
+            lines = [line.split() for line in lines if len(line.split()) > 0]
+            if len(lines) == 0:
+                continue
+            ncol = min(len(val) for val in lines)
+            if ncol < 7:
+                _ = QtWidgets.QMessageBox.warning(
+                    None,
+                    "Warning",
+                    "Synthetic model file does not have enough columns:\n"
+                    + f"At least 7 columns are needed, {ncol} found.\n"
+                    + "Synthetic modeling aborted.",
+                    QtWidgets.QMessageBox.Close, QtWidgets.QMessageBox.Ignore)
+                yield None
+                return
+            if ncol < 11 and not warned:
+                if ncol == 7:
+                    text = "Remanence and density are set to zero."
+                else:
+                    text = "Density is set to zero."
+                answer = QtWidgets.QMessageBox.warning(
+                    None,
+                    "Warning",
+                    f"Synthetic model file has only {ncol} columns:\n"
+                    + f"{text}\nPress Ignore to accept or Abort to abandon.",
+                    QtWidgets.QMessageBox.Ignore | QtWidgets.QMessageBox.Abort,
+                    QtWidgets.QMessageBox.Ignore)
+                if answer == QtWidgets.QMessageBox.Abort:
+                    yield None
+                    return
+                warned = True
+# Values are stored once per chunk, missing columns stay zero
+            vals = np.zeros((len(lines), 11))
+            for i, val in enumerate(lines):
+                vals[i, :len(val)] = [float(v) for v in val[:11]]
+            yield vals[:, 0:2], vals[:, 2:4], vals[:, 4:6], vals[:, 6],\
+                vals[:, 7], vals[:, 8], vals[:, 9], vals[:, 10]
+
+
 def read_synthetic_model():
     """
-    Read synthetic model.
+    Read synthetic model at once (see read_synthetic_chunks for reading
+    large models in chunks).
     The file should have an extension .txt, .dat or .mod
     The model is composed of rectangular prisms with faces parallel to axis.
     The format of the file is as follows:
@@ -235,96 +334,13 @@ def read_synthetic_model():
         Densities of prisms.
 
     """
-    file = list(
-        QtWidgets.QFileDialog.getOpenFileName(
-            None, "Select model file", "",
-            filter="txt/dat/mod (*.txt *.dat *.mod) ;; all (*.*)"))
-    if len(file) == 0:
-        print("No file chosen, program finishes")
+    file = synthetic_model_file()
+    if file is None:
         return None, None, None, None, None, None, None, None
-    if len(file[0]) < 1:
-        print("read_synthetic_model: No files read")
+    chunks = list(read_synthetic_chunks(file))
+    if len(chunks) == 0 or chunks[-1] is None:
         return None, None, None, None, None, None, None, None
-    xmin = []
-    xmax = []
-    ymin = []
-    ymax = []
-    zmin = []
-    zmax = []
-    sus = []
-    rem = []
-    rem_i = []
-    rem_d = []
-    rho = []
-    with open(file[0], "r") as fi:
-        lines = fi.readlines()
-    for line in lines:
-        val = line.split()
-        ncol = len(val)
-        if ncol < 7:
-            answer = QtWidgets.QMessageBox.warning(
-                None,
-                "Warning",
-                "Synthetic model file does not have enough columns:\n"
-                + f"At least 7 columns are needed, {ncol} found.\n"
-                + "Synthetic modeling aborted.",
-                QtWidgets.QMessageBox.Close, QtWidgets.QMessageBox.Ignore)
-            return None, None, None, None, None, None, None, None
-        if ncol < 11:
-            if ncol == 7:
-                text = "Remanence and density are set to zero."
-            else:
-                text = "Density is set to zero."
-            answer = QtWidgets.QMessageBox.warning(
-                None,
-                "Warning",
-                "Synthetic model file has only {ncol} columns:\n"
-                + f"{text}\nPress Ignore to accept or Abort to abandon.",
-                QtWidgets.QMessageBox.Ignore | QtWidgets.QMessageBox.Abort,
-                QtWidgets.QMessageBox.Ignore)
-            if answer == QtWidgets.QMessageBox.Abort:
-                return None, None, None, None, None, None, None, None
-        xmin.append(float(val[0]))
-        xmax.append(float(val[1]))
-        ymin.append(float(val[2]))
-        ymax.append(float(val[3]))
-        zmin.append(float(val[4]))
-        zmax.append(float(val[5]))
-        sus.append(float(val[6]))
-        if ncol > 7:
-            rem.append(float(val[7]))
-            if ncol > 8:
-                rem_i.append(float(val[8]))
-                if ncol > 9:
-                    rem_d.append(float(val[9]))
-                    if ncol > 10:
-                        rho.append(float(val[10]))
-                    else:
-                        rho.append(0.0)
-                else:
-                    rem_d.append(0.0)
-                    rho.append(0.0)
-            else:
-                rem_i.append(0.0)
-                rem_d.append(0.0)
-                rho.append(0.0)
-        else:
-            rem.append(0.0)
-            rem_i.append(0.0)
-            rem_d.append(0.0)
-            rho.append(0.0)
-        nprism = len(xmin)
-        x = np.zeros((nprism, 2))
-        x[:, 0] = np.array(xmin)
-        x[:, 1] = np.array(xmax)
-        y = np.zeros((nprism, 2))
-        y[:, 0] = np.array(ymin)
-        y[:, 1] = np.array(ymax)
-        z = np.zeros((nprism, 2))
-        z[:, 0] = np.array(zmin)
-        z[:, 1] = np.array(zmax)
-    return x, y, z, np.array(sus), np.array(rem), np.array(rem_i), \
-        np.array(rem_d), np.array(rho)
+    return tuple(np.concatenate(c) for c in zip(*chunks))
 
 
 def read_geography_file(file):
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Last modified: Oct 18, 2026
+
+@author: Hermann Zeyen
+        University Paris-Saclay
+
+Benchmark of the prism kernels of potential_prism.py. Every vectorized
+variant is compared with the scalar reference functions Prism.mag_prism and
+Prism.grav_prism for random points and for points located on face planes,
+vertical edges, face levels and corners of the prisms, where the edge guards
+of the kernels (tandet, isclose tests, replacement of small distances) are
+active. Throughput is given as prism-point evaluations per second.
+
+Run from the command line with
+    python -m Pymagra.inversion.benchmark
+
+Contains the following functions:
+    - random_prisms : draws a model of random prisms
+    - point_sets : draws random and edge/corner calculation points
+    - reference_effects : effects of every prism at every point calculated
+      with the scalar reference functions
+    - kernel_variants : effects of every prism at every point calculated
+      with all vectorized kernels
+    - max_rel_error : maximum error relative to the largest reference value
+    - time_call : best execution time of a function
+    - run_benchmark : runs accuracy and timing tests and prints a report
+
+"""
+
+import time
+import numpy as np
+from .potential_prism import Prism_calc, _mag_terms, _grav_terms
+from ..in_out.earth import Earth_mag as Earth
+
+# Point sets located on special positions relative to one prism
+SPECIAL_SETS = ("face plane", "vertical edge", "face level", "corner")
+# Shift [m] of points on special positions used to check the continuity of
+#   the kernels across edges and faces
+EDGE_SHIFT = 1.E-4
+
+
+def random_prisms(n_prisms, rng, extent=1000.):
+    """
+    Draws a model of random prisms below the surface
+
+    Parameters
+    ----------
+    n_prisms : int
+        Number of prisms
+    rng : numpy.random.Generator
+        Random generator
+    extent : float, optional; default: 1000.
+        Horizontal size of the model area [m]
+
+    Returns
+    -------
+    x, y, z : numpy 2D float arrays [n_prisms, 2]
+        Face coordinates of the prisms (z positive down)
+    sus, rem, inc, dec, rho : numpy 1D float arrays [n_prisms]
+        Properties of the prisms (see Prism.__init__)
+
+    """
+    x0 = rng.uniform(0., extent, n_prisms)
+    y0 = rng.uniform(0., extent, n_prisms)
+    z0 = rng.uniform(1., 50., n_prisms)
+    x = np.column_stack((x0, x0+rng.uniform(10., 200., n_prisms)))
+    y = np.column_stack((y0, y0+rng.uniform(10., 200., n_prisms)))
+    z = np.column_stack((z0, z0+rng.uniform(5., 100., n_prisms)))
+    sus = rng.uniform(0.001, 0.1, n_prisms)
+    rem = rng.uniform(0., 1., n_prisms)
+    inc = rng.uniform(-90., 90., n_prisms)
+    dec = rng.uniform(-180., 180., n_prisms)
+    rho = rng.uniform(-500., 500., n_prisms)
+    return x, y, z, sus, rem, inc, dec, rho
+
+
+def point_sets(x, y, z, n_points, rng):
+    """
+    Draws sets of calculation points. Points of the set "random" are located
+    above the model. For the other sets, each point is attached to a random
+    prism:
+        face plane : on the vertical plane of one of its X faces
+        vertical edge : on the prolongation of one of its vertical edges
+        face level : at the depth of its top or bottom face
+        corner : on one of its corners
+
+    Parameters
+    ----------
+    x, y, z : numpy 2D float arrays [n_prisms, 2]
+        Face coordinates of the prisms
+    n_points : int
+        Number of points per set
+    rng : numpy.random.Generator
+        Random generator
+
+    Returns
+    -------
+    sets : dictionary
+        For every set name a tuple (xp, yp, zp) of 1D float arrays. Heights
+        zp follow the convention of mag_prism (positive upward).
+
+    """
+    xmin, xmax = x.min()-100., x.max()+100.
+    ymin, ymax = y.min()-100., y.max()+100.
+    n_prisms = len(x)
+    k = rng.integers(0, n_prisms, n_points)
+    i = rng.integers(0, 2, n_points)
+    j = rng.integers(0, 2, n_points)
+    m = rng.integers(0, 2, n_points)
+    xr = rng.uniform(xmin, xmax, n_points)
+    yr = rng.uniform(ymin, ymax, n_points)
+    zr = rng.uniform(0., 20., n_points)
+    sets = {}
+    sets["random"] = (xr, yr, zr)
+    sets["face plane"] = (x[k, i], yr, zr)
+    sets["vertical edge"] = (x[k, i], y[k, j], zr)
+    sets["face level"] = (xr, yr, -z[k, m])
+    sets["corner"] = (x[k, i], y[k, j], -z[k, m])
+    return sets
+
+
+def reference_effects(model, xp, yp, zp):
+    """
+    Calculates the effects of every prism at every point with the scalar
+    functions Prism.mag_prism and Prism.grav_prism.
+
+    Parameters
+    ----------
+    model : object of class Prism_calc
+        Model containing the prisms
+    xp, yp, zp : numpy 1D float arrays [n_points]
+        Coordinates of calculation points (zp positive upward)
+
+    Returns
+    -------
+    mag : numpy 3D float array [n_prisms, 3, n_points]
+        X, Y and Z components of the magnetic effects
+    grav : numpy 2D float array [n_prisms, n_points]
+        Gravity effects at the same points (grav_prism is called with -zp)
+    t_mag, t_grav : floats
+        Calculation times [s]
+
+    """
+    prisms = list(model.prisms.values())
+    mag = np.zeros((len(prisms), 3, len(xp)))
+    grav = np.zeros((len(prisms), len(xp)))
+    t0 = time.perf_counter()
+    for ip, p in enumerate(prisms):
+        for jp in range(len(xp)):
+            mag[ip, :, jp] = p.mag_prism(xp[jp], yp[jp], zp[jp])
+    t1 = time.perf_counter()
+    for ip, p in enumerate(prisms):
+        for jp in range(len(xp)):
+            grav[ip, jp] = p.grav_prism(xp[jp], yp[jp], -zp[jp])
+    t2 = time.perf_counter()
+    return mag, grav, t1-t0, t2-t1
+
+
+def kernel_variants(model, xp, yp, zp):
+    """
+    Calculates the effects of every prism at every point with all vectorized
+    kernels
+
+    Parameters
+    ----------
+    model : object of class Prism_calc
+        Model containing the prisms
+    xp, yp, zp : numpy 1D float arrays [n_points]
+        Coordinates of calculation points (zp positive upward)
+
+    Returns
+    -------
+    mag : dictionary
+        For every magnetic kernel a numpy 3D float array
+        [n_prisms, 3, n_points]
+    grav : dictionary
+        For every gravity kernel a numpy 2D float array [n_prisms, n_points]
+
+    """
+    prisms = list(model.prisms.values())
+    x, y, z = model.get_prism_coor()
+    tx = np.array([p.tx for p in prisms])[:, None]
+    ty = np.array([p.ty for p in prisms])[:, None]
+    tz = np.array([p.tz for p in prisms])[:, None]
+    rho = np.array([p.rho for p in prisms])[:, None]
+    mag = {}
+    grav = {}
+    mag["mag_prism_batch"] = np.array(
+        [p.mag_prism_batch(xp, yp, zp) for p in prisms])
+    res = [p.mag_grav_prism_batch(xp, yp, zp) for p in prisms]
+    mag["mag_grav_prism_batch"] = np.array([r[:3] for r in res])
+    grav["mag_grav_prism_batch"] = np.array([r[3] for r in res])
+    for name, grav_flag in (("_mag_terms", False),
+                            ("_mag_terms(grav=True)", True)):
+        terms = _mag_terms(x, y, z, xp, yp, zp, grav=grav_flag)
+        g1, g2, g3, t1, t2, t3 = terms[:6]
+        mag[name] = np.stack((tx*t1+ty*g2+tz*g1, tx*g2+ty*t2+tz*g3,
+                              tx*g1+ty*g3+tz*t3), axis=1)
+        if grav_flag:
+            grav[name] = terms[6]*rho*model.G
+    grav["grav_prism_batch"] = np.array(
+        [p.grav_prism_batch(xp, yp, -zp) for p in prisms])
+    grav["_grav_terms"] = _grav_terms(x, y, z, xp, yp, -zp)*rho*model.G
+    return mag, grav
+
+
+def max_rel_error(values, reference):
+    """
+    Maximum absolute difference between values and reference divided by the
+    maximum absolute reference value. Non-finite values give an infinite
+    error.
+
+    Parameters
+    ----------
+    values, reference : numpy float arrays of equal shape
+
+    Returns
+    -------
+    float
+
+    """
+    if not np.all(np.isfinite(values)):
+        return np.inf
+    scale = np.abs(reference).max()
+    if scale == 0.:
+        scale = 1.
+    return np.abs(values-reference).max()/scale
+
+
+def time_call(func, repeat=3):
+    """
+    Best execution time of func() out of repeat calls
+
+    Parameters
+    ----------
+    func : callable without arguments
+    repeat : int, optional; default: 3
+
+    Returns
+    -------
+    float
+        Execution time [s]
+
+    """
+    t_best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        t_best = min(t_best, time.perf_counter()-t0)
+    return t_best
+
+
+def run_benchmark(n_prisms=40, n_points=100, n_prisms_timing=200,
+                  n_points_timing=2000, seed=0, repeat=3):
+    """
+    Runs the accuracy and timing tests of all prism kernels and prints
+    a report
+
+    Accuracy is given as maximum error relative to the largest value of the
+    reference functions for every point set. For points on special positions
+    (see point_sets), "jump" is the maximum change of the vectorized kernel
+    if points are shifted by EDGE_SHIFT, relative to the largest value. It
+    is small if the edge guards preserve the continuity of the effects.
+    Magnetic effects are singular at prism corners, large jumps are expected
+    there. The gravity effect of _mag_terms differs from grav_prism for
+    points at face levels, where the isclose guards of grav_prism drop log
+    terms of points far out on the prolongation of an edge.
+
+    Parameters
+    ----------
+    n_prisms, n_points : int, optional; defaults: 40, 100
+        Number of prisms and of points per set used for accuracy tests. The
+        scalar reference functions are called n_prisms*n_points times per
+        set.
+    n_prisms_timing, n_points_timing : int, optional; defaults: 200, 2000
+        Number of prisms and points used for timing the vectorized kernels
+    seed : int, optional; default: 0
+        Seed of the random generator
+    repeat : int, optional; default: 3
+        Number of repetitions of timed calls, the fastest is reported
+
+    Returns
+    -------
+    accuracy : list of tuples (kernel, set, max. relative error, jump)
+    timing : list of tuples (kernel, evaluations per second)
+
+    """
+    rng = np.random.default_rng(seed)
+    earth = Earth(50000., 62., 0.)
+    model = Prism_calc(earth, kernel_cache=False)
+    model.add_prisms(*random_prisms(n_prisms, rng))
+    sets = point_sets(*model.get_prism_coor(), n_points, rng)
+    accuracy = []
+    timing = []
+    t_scalar_mag = 0.
+    t_scalar_grav = 0.
+    n_eval = 0
+    print("\nAccuracy of prism kernels relative to mag_prism/grav_prism "
+          f"({n_prisms} prisms, {n_points} points per set)")
+    print(f"{'kernel':<30s}{'point set':<16s}{'max rel. error':>16s}"
+          f"{'jump':>12s}")
+    for set_name, (xp, yp, zp) in sets.items():
+        mag_ref, grav_ref, t_mag, t_grav = reference_effects(model, xp, yp,
+                                                             zp)
+        t_scalar_mag += t_mag
+        t_scalar_grav += t_grav
+        n_eval += n_prisms*n_points
+        mag, grav = kernel_variants(model, xp, yp, zp)
+        if set_name in SPECIAL_SETS:
+            mag_s, grav_s = kernel_variants(model, xp+EDGE_SHIFT,
+                                            yp+EDGE_SHIFT, zp-EDGE_SHIFT)
+        for results, ref, kind in ((mag, mag_ref, "mag"),
+                                   (grav, grav_ref, "grav")):
+            for name, val in results.items():
+                err = max_rel_error(val, ref)
+                jump = np.nan
+                if set_name in SPECIAL_SETS:
+                    shifted = mag_s if kind == "mag" else grav_s
+                    jump = max_rel_error(shifted[name], val)
+                accuracy.append((f"{name} ({kind})", set_name, err, jump))
+                print(f"{name+' ('+kind+')':<30s}{set_name:<16s}"
+                      f"{err:16.2e}{jump:12.2e}")
+# Forward functions summing the effects of all prisms
+    xp, yp, zp = sets["random"]
+    mag_ref, grav_ref, _, _ = reference_effects(model, xp, yp, zp)
+    mag_ref = mag_ref.sum(axis=0).T
+    grav_ref = grav_ref.sum(axis=0)
+    v, g = model.joint_forward(xp, yp, zp)
+    forward = [("mag_forward", model.mag_forward(xp, yp, zp)[:, :3],
+                mag_ref),
+               ("mag_forward(tol=1.E-3)",
+                model.mag_forward(xp, yp, zp, tol=1.E-3)[:, :3], mag_ref),
+               ("grav_forward", model.grav_forward(xp, yp, -zp), grav_ref),
+               ("grav_forward(tol=1.E-3)",
+                model.grav_forward(xp, yp, -zp, tol=1.E-3), grav_ref),
+               ("joint_forward (mag)", v[:, :3], mag_ref),
+               ("joint_forward (grav)", g, grav_ref)]
+    for name, val, ref in forward:
+        err = max_rel_error(val, ref)
+        accuracy.append((name, "random", err, np.nan))
+        print(f"{name:<30s}{'random':<16s}{err:16.2e}{np.nan:12.2e}")
+# Timing
+    model = Prism_calc(earth, kernel_cache=False)
+    model.add_prisms(*random_prisms(n_prisms_timing, rng))
+    x, y, z = model.get_prism_coor()
+    xp, yp, zp = point_sets(x, y, z, n_points_timing, rng)["random"]
+    zp2 = np.vstack((zp, zp+1.))
+    prisms = list(model.prisms.values())
+    n_pairs = n_prisms_timing*n_points_timing
+    calls = [
+        ("mag_prism_batch", lambda: [p.mag_prism_batch(xp, yp, zp)
+                                     for p in prisms], n_pairs),
+        ("grav_prism_batch", lambda: [p.grav_prism_batch(xp, yp, -zp)
+                                      for p in prisms], n_pairs),
+        ("mag_grav_prism_batch", lambda: [p.mag_grav_prism_batch(xp, yp, zp)
+                                          for p in prisms], n_pairs),
+        ("_mag_terms", lambda: _mag_terms(x, y, z, xp, yp, zp), n_pairs),
+        ("_mag_terms(grav=True)",
+         lambda: _mag_terms(x, y, z, xp, yp, zp, grav=True), n_pairs),
+        ("_grav_terms", lambda: _grav_terms(x, y, z, xp, yp, -zp), n_pairs),
+        ("mag_forward", lambda: model.mag_forward(xp, yp, zp), n_pairs),
+        ("mag_forward (2 heights)", lambda: model.mag_forward(xp, yp, zp2),
+         2*n_pairs),
+        ("mag_forward(tol=1.E-3)",
+         lambda: model.mag_forward(xp, yp, zp, tol=1.E-3), n_pairs),
+        ("grav_forward", lambda: model.grav_forward(xp, yp, -zp), n_pairs),
+        ("grav_forward(tol=1.E-3)",
+         lambda: model.grav_forward(xp, yp, -zp, tol=1.E-3), n_pairs),
+        ("joint_forward", lambda: model.joint_forward(xp, yp, zp), n_pairs)]
+    print(f"\nThroughput ({n_prisms_timing} prisms, {n_points_timing} "
+          "points, scalar functions measured during accuracy tests)")
+    print(f"{'kernel':<30s}{'evaluations/s':>16s}{'speed-up':>12s}")
+    rate_scalar = {"mag": n_eval/t_scalar_mag, "grav": n_eval/t_scalar_grav}
+    for kind, rate in rate_scalar.items():
+        timing.append((f"{kind}_prism", rate))
+        print(f"{kind+'_prism':<30s}{rate:16.3e}{1.:12.1f}")
+# Speed-up of combined kernels is given relative to mag_prism
+    for name, func, n in calls:
+        rate = n/time_call(func, repeat)
+        kind = "grav" if "grav" in name and "mag" not in name else "mag"
+        timing.append((name, rate))
+        print(f"{name:<30s}{rate:16.3e}{rate/rate_scalar[kind]:12.1f}")
+    return accuracy, timing
+
+
+if __name__ == "__main__":
+    run_benchmark()
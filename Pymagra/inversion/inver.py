@@ -11,6 +11,7 @@ import os
 from copy import deepcopy
 from datetime import datetime
 import numpy as np
+from scipy import sparse
 from PyQt5 import QtWidgets
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -19,7 +20,9 @@ from matplotlib.collections import PatchCollection
 from matplotlib.patches import Rectangle
 from ..in_out.dialog import dialog
 from .potential_prism import Prism_calc as PP
+from .progress import Cancelled, Progress
 from . import mag_grav_utilities as utils
+from . import solvers
 from ..plotting.new_window import newWindow
 
 
@@ -149,15 +152,90 @@ class inversion():
         self.prism_del = {}
         self.prism_new = {}
         self.fig_follow = []
+# Number of processes used for the calculation of the Frechet matrix. A
+#    process pool is only started on request (e.g. n_jobs = os.cpu_count()
+#    in scripts), not by default inside the GUI
+        self.n_jobs = 1
+# Sparse storage of the Frechet matrix: entries smaller than sparse_threshold
+#    times their column maximum or farther than sparse_cutoff [m] from the
+#    prism center are dropped (see Prism_calc.create_sparse_Frechet)
+        self.sparse_frechet = False
+        self.sparse_threshold = 1.E-3
+        self.sparse_cutoff = 0.
+# Wavelet compression of the Frechet matrix: Haar coefficients smaller than
+#    wavelet_threshold times the maximum of their row are dropped (see
+#    Prism_calc.create_wavelet_Frechet)
+        self.wavelet_frechet = False
+        self.wavelet_threshold = 1.E-3
+# Matrix-free Frechet operator using FFT convolutions, possible if the data of
+#    every sensor form a regular grid at constant height (see
+#    Prism_calc.create_operator), else the Frechet matrix is calculated
+#    normally. The linear systems are then solved by conjugate gradients.
+        self.fft_frechet = False
+# Dense Frechet matrix: type of stored values (np.float32 halves memory use)
+#    and optional storage out of core in a memmap file of the inversion
+#    folder (e.g. "Frechet.dat")
+        self.frechet_dtype = np.float64
+        self.frechet_file = None
+# Folder of a disk cache of derivative columns and forward responses shared
+#    by successive runs (see Prism_calc.cache_key). Unlike the inversion
+#    folder, it should not depend on the date.
+        self.cache_folder = None
+# Formulation of the linear system of every iteration: "parameter" (normal
+#    equations of size [n_param, n_param]), "data" (system of size
+#    [n_data, n_data], see solvers.solve_data_space), "auto" (data space if
+#    there are less data than parameters) or "cg" (matrix-free conjugate
+#    gradients, see solvers.solve_cg, stopped when the relative residual is
+#    smaller than cg_tol or after cg_max_iter iterations, None meaning the
+#    number of parameters). Conjugate gradients are always used if the
+#    Frechet matrix is a matrix-free operator (fft_frechet, wavelet_frechet)
+        self.solver = "auto"
+        self.cg_tol = 1.E-6
+        self.cg_max_iter = None
+# Positivity constrained inversion (see solvers.solve_positive): smallest
+#    allowed parameter, convergence limit of the relative model change and
+#    maximum number of Gauss-Newton iterations per inversion iteration
+        self.positive_min = 1.E-7
+        self.positive_tol = 1.E-3
+        self.positive_max_iter = 50
         now = datetime.now()
         self.c_time = now.strftime("%H-%M-%S")
         self.d1 = now.strftime("%Y-%m-%d")
         self.folder = f"inversion_{self.d1}_{self.c_time}"
         os.makedirs(self.folder)
 
-    def run_inversion(self):
+    def run_inversion(self, callback=None, cancel=None):
         """
-        Do 2D or 3D inversion using a self-refining algorithm
+        Do 2D or 3D inversion using a self-refining algorithm (see
+        iterate). The inversion may be followed and stopped from outside.
+
+        Parameters
+        ----------
+        callback : callable, optional; default: None
+            Called with the state of the calculation (see Progress.info),
+            items being iterations. It is also passed to the calculation of
+            the Frechet matrix, where items are prism-point combinations.
+        cancel : object of class CancelToken, optional; default: None
+            If its cancellation is requested, the inversion stops at the
+            next check. The model of the last completed iteration is kept.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.progress = Progress(callback, cancel, "inversion iterations")
+        self.progress.start(self.max_iter)
+        self.cancelled = False
+        try:
+            self.iterate()
+        except Cancelled:
+            self.cancelled = True
+            print(f"\nInversion cancelled during iteration {self.iteration}")
+
+    def iterate(self):
+        """
+        Iterations of the inversion, called by run_inversion
 
         Returns
         -------
@@ -180,7 +258,8 @@ class inversion():
                 print("\nOnly forward model calculated")
                 self.G = self.mPrism.create_Frechet(
                     self.sus_inv, self.rem_inv, self.rho_inv, self.x,
-                    self.y, self.z)
+                    self.y, self.z, callback=self.progress.callback,
+                    cancel=self.progress.cancel)
                 self.data_mod = np.matmul(self.G, self.params)
                 return
 # Calculate effect of actual model
@@ -192,9 +271,28 @@ class inversion():
             self.S = self.mPrism.create_smooth(
                 self.sus_inv, self.rem_inv, self.rho_inv, self.sigma_sus,
                 self.sigma_rem, self.sigma_rho, self.depth_ref)
-            self.G = self.mPrism.create_Frechet(
-                self.sus_inv, self.rem_inv, self.rho_inv, self.x, self.y,
-                self.z)
+            store_file = None
+            if self.frechet_file:
+                store_file = os.path.join(self.folder, self.frechet_file)
+            self.G = None
+            if self.fft_frechet:
+                self.G = self.mPrism.create_operator(
+                    self.sus_inv, self.rem_inv, self.rho_inv, self.x, self.y,
+                    self.z)
+            if self.G is None and self.wavelet_frechet:
+                self.G = self.mPrism.create_wavelet_Frechet(
+                    self.sus_inv, self.rem_inv, self.rho_inv, self.x, self.y,
+                    self.z, threshold=self.wavelet_threshold,
+                    callback=self.progress.callback,
+                    cancel=self.progress.cancel)
+            elif self.G is None:
+                self.G = self.mPrism.create_Frechet(
+                    self.sus_inv, self.rem_inv, self.rho_inv, self.x, self.y,
+                    self.z, sparse_store=self.sparse_frechet,
+                    threshold=self.sparse_threshold, cutoff=self.sparse_cutoff,
+                    dtype=self.frechet_dtype, store_file=store_file,
+                    callback=self.progress.callback,
+                    cancel=self.progress.cancel)
 # Define data covariance and regularization matrices.
 # Since both matrices have only values on their diagonal, values are stored as
 # 1D vector. For the regularization matrix, the base value is the squared one
@@ -206,63 +304,77 @@ class inversion():
             self.dat = np.copy(self.data)
             self.sigma_data, self.sigma_param = self.sigmas()
             print(f"Frechet calculated, shape: {self.G.shape}")
+            matrix_free = self.solver == "cg" or not (
+                isinstance(self.G, np.ndarray) or sparse.issparse(self.G))
 
             if self.positive:
-                fit = []
                 self.dat = self.data_ori
-                dd = np.copy(self.dat)
-                self.params[:-1] = 0.001
-                self.params[-1] = 0.
-                for it in range(50):
-                    self.yparam = np.copy(self.params)
-                    self.yparam[:-1] = np.log(self.params[:-1])
-                    fac = np.copy(self.params)
-                    fac[-1] = 1.
-                    G0 = self.G*fac
-                    GCT = G0.T*self.sigma_data
-                    G_inv = np.matmul(GCT, G0)
-                    Gi_max = abs(G_inv).max()
-                    Gp = self.lam*self.sigma_param*0.001
+                if matrix_free:
+                    mode = "cg"
+                elif solvers.use_data_space(self.G, self.solver):
+                    mode = "data"
+                else:
+                    mode = "parameter"
+# Start from the model of the former iteration (prisms created by splitting
+#    inherit the property of their parent); from a small uniform model in
+#    the first iteration
+                if self.iteration == 0 or self.params[:-1].max() <= 0.:
+                    self.params[:-1] = 0.001
+                    self.params[-1] = 0.
+                fac = np.clip(self.params, self.positive_min, 1.)
+                fac[-1] = 1.
+                G_inv = None
+                if mode == "parameter":
+                    if sparse.issparse(self.G):
+                        GCT = self.G.T.multiply(
+                            self.sigma_data[None, :]).tocsr()
+                        G_inv = (GCT @ self.G).toarray()
+                    else:
+                        G_inv, _ = utils.normal_equations(
+                            self.G, self.sigma_data, self.dat)
+                Gp = self.lam*self.sigma_param*0.001
+                Gs = self.gam*self.S*0.001
+                if self.iteration == 0:
+# The maximum of the scaled matrix F*G.T*Cd*G*F is on its diagonal
+                    if G_inv is None:
+                        Gi_max = solvers.normal_diagonal(
+                            self.G, self.sigma_data, fac).max()
+                    else:
+                        Gi_max = (G_inv.diagonal()*fac**2).max()
                     Gp_max = Gp.max()
-                    Gp_fac = Gi_max/Gp_max
-                    Gs = self.gam*self.S*0.001
                     Gs_max = Gs.max()
-                    Gs_fac = Gi_max/Gs_max
-                    if self.iteration == 0 and it == 0:
-                        print(f"\nMaximum GT*Cd*G: {Gi_max:0.1f}")
-                        print(f"   Maximum regularization: {Gp_max:0.1f} (fac:"
-                              + f" {Gp_fac:0.1f})")
-                        print(f"   Maximum smoothing     : {Gs_max:0.1f} (fac:"
-                              + f" {Gs_fac:0.1f})")
-                    G_inv += Gs
-                    G_inv[np.diag_indices(G_inv.shape[0])] += Gp
-                    d_par = np.matmul(np.matmul(np.linalg.inv(G_inv), GCT), dd)
-                    yp = self.yparam+d_par
-                    if yp[:-1].max() > 0.:
-                        ip = np.argmax(yp[:-1])
-                        factor = -self.yparam[ip]/d_par[ip]
-                    else:
-                        factor = 1.
-                    self.yparam[:-1] += d_par[:-1]*factor
-                    self.yparam[-1] += d_par[-1]
-                    self.params = np.copy(self.yparam)
-                    self.params[:-1] = np.exp(self.yparam[:-1])
-                    self.params[:-1][self.params[:-1] < 1.E-7] = 1.E-7
-                    self.data_mod = np.matmul(self.G, self.params)
-                    dd = self.dat - self.data_mod
-                    fit.append(np.std(dd))
-                    if it < 2:
-                        continue
-                    if abs((fit[-2] - fit[-1])/fit[-2]) < 1.E-5:
-                        break
+                    print(f"\nMaximum GT*Cd*G: {Gi_max:0.1f}")
+                    print(f"   Maximum regularization: {Gp_max:0.1f} (fac:"
+                          + f" {Gi_max/Gp_max:0.1f})")
+                    print(f"   Maximum smoothing     : {Gs_max:0.1f} (fac:"
+                          + f" {Gi_max/Gs_max:0.1f})")
+                self.params, n_pos = solvers.solve_positive(
+                    self.G, self.sigma_data, self.dat, self.params, Gp, Gs,
+                    mode, G_inv, p_min=self.positive_min,
+                    tol=self.positive_tol, max_iter=self.positive_max_iter,
+                    cg_tol=self.cg_tol, cg_max_iter=self.cg_max_iter,
+                    progress=self.progress)
+                print(f"   Positive solution: {n_pos} Gauss-Newton "
+                      + "iterations")
 # Do inversion
             else:
-                GCT = self.G.T*self.sigma_data
-                G_inv = np.matmul(GCT, self.G)
+                data_space = solvers.use_data_space(self.G, self.solver)
+                if data_space or matrix_free:
+                    if self.iteration == 0:
+                        mG = solvers.normal_diagonal(
+                            self.G, self.sigma_data).max()
+                elif sparse.issparse(self.G):
+                    GCT = self.G.T.multiply(self.sigma_data[None, :]).tocsr()
+                    G_inv = (GCT @ self.G).toarray()
+                    rhs = GCT @ self.dat
+                else:
+                    G_inv, rhs = utils.normal_equations(
+                        self.G, self.sigma_data, self.dat)
 # For first iteration test whether regularization and smoothing matrices have
 #     an appreciable effect. If not, give a warning message
                 if self.iteration == 0:
-                    mG = abs(G_inv).max()
+                    if not (data_space or matrix_free):
+                        mG = abs(G_inv).max()
                     print(f"\nMaximum GT*Cd*G: {mG:0.1f}")
                     mSig = (self.lam*self.sigma_param).max()
                     mSmo = (self.gam*self.S).max()
@@ -300,13 +412,23 @@ class inversion():
                                 self.lam = float(results[0])
                                 self.gam = float(results[1])
 
-                G_inv[np.diag_indices(G_inv.shape[0])] +=\
-                    self.lam*self.sigma_param
-                G_inv += self.gam*self.S
-                d_par = np.matmul(np.matmul(np.linalg.inv(G_inv), GCT),
-                                  self.dat)
+                if matrix_free:
+                    d_par, n_cg = solvers.solve_cg(
+                        self.G, self.sigma_data, self.dat,
+                        self.lam*self.sigma_param, self.gam*self.S,
+                        tol=self.cg_tol, max_iter=self.cg_max_iter)
+                    print(f"   Conjugate gradients: {n_cg} iterations")
+                elif data_space:
+                    d_par = solvers.solve_data_space(
+                        self.G, self.sigma_data, self.dat,
+                        self.lam*self.sigma_param, self.gam*self.S)
+                else:
+                    G_inv[np.diag_indices(G_inv.shape[0])] +=\
+                        self.lam*self.sigma_param
+                    solvers.add_smoothing(G_inv, self.gam*self.S)
+                    d_par = solvers.solve_normal(G_inv, rhs)
                 self.params += d_par
-            self.data_mod = np.matmul(self.G, self.params)
+            self.data_mod = utils.block_matvec(self.G, self.params)
 # Extract new prism properties from parameter vector, set the correspondig
 #   values in the prism parameters and copy them into vector par_hist
             i0 = 0
@@ -355,6 +477,7 @@ class inversion():
             print(f"Average: {self.params[-1]}, "
                   + f"sus:({self.params[:-1].min()*1000.}, "
                   + f"{self.params[:-1].max()*1000.})\n")
+            self.progress.update()
 # If Maximum iteration number is reached, misfit does not become smaller or
 # relative misfits are smaller than predefined minimum value, stop iterations
             if self.iteration == self.max_iter:
@@ -394,37 +517,35 @@ class inversion():
                 key_m1 = self.mPrism.get_max_prisms(
                     abs(data[:self.n_data1]).
                     reshape(self.data1_shape),
-                    self.G[:self.n_data1, :self.n_prisms],
-                    max_lim=self.max_amp, width=self.width_max)
+                    self.G, max_lim=self.max_amp, width=self.width_max)
                 key_m2 = self.mPrism.get_max_prisms(
                     abs(data[self.n_data1:]).
                     reshape(self.data2_shape),
-                    self.G[self.n_data1:, :self.n_prisms],
-                    max_lim=self.max_amp, width=self.width_max)
+                    self.G, max_lim=self.max_amp, width=self.width_max,
+                    row0=self.n_data1)
                 key_m = list(np.unique(np.array(key_m1+key_m2)))
             else:
                 key_m = self.mPrism.get_max_prisms(
                     abs(data.reshape(self.data_shape)),
-                    self.G[:self.n_data1, :self.n_prisms],
-                    width=self.width_max)
+                    self.G, width=self.width_max)
             if self.sus_inv and self.rem_inv:
                 if self.n_sensor == 2:
                     key_r1 = self.mPrism.get_max_prisms(
                         abs(data[:self.n_data1]).
                         reshape(self.data1_shape),
-                        self.G[:self.n_data1, self.n_prisms:],
-                        max_lim=self.max_amp, width=self.width_max)
+                        self.G, max_lim=self.max_amp, width=self.width_max,
+                        col0=self.n_prisms)
                     key_r2 = self.mPrism.get_max_prisms(
                         abs(data[self.n_data1:]).
                         reshape(self.data2_shape),
-                        self.G[self.n_data1:, self.n_prisms:],
-                        max_lim=self.max_amp, width=self.width_max)
+                        self.G, max_lim=self.max_amp, width=self.width_max,
+                        row0=self.n_data1, col0=self.n_prisms)
                     key_r = list(np.unique(np.array(key_r1+key_r2)))
                 else:
                     key_r = self.mPrism.get_max_prisms(
                         abs(data.reshape(self.data1_shape)),
-                        self.G[:self.n_data1, self.n_prisms:],
-                        max_lim=self.max_amp, width=self.width_max)
+                        self.G, max_lim=self.max_amp, width=self.width_max,
+                        col0=self.n_prisms)
             key_split = list(np.unique(np.array(key_m+key_r)))
 # Test whether prisms are marked for splitting
             if len(key_split) == 0:
@@ -478,43 +599,30 @@ class inversion():
             fac = (1./self.depth_ref-1.)/self.zprism_max
         else:
             fac = 1.
+# Depth factors of all prisms
+        f = 1.+self.mPrism.get_prism_set().centers()[2]*fac
+        if self.depth_ref < 1.:
+            f = 1./f
         if "m" in self.data_type:
             sigma_data = np.ones(self.n_data)/self.sigma_mag**2
-            i = -1
             if self.sus_inv:
                 sigma_param = np.ones(self.mPrism.n_prisms)\
                     / self.sigma_sus**2
                 if not np.isclose(self.depth_ref, 1.):
-                    for _, val in self.mPrism.prisms.items():
-                        i += 1
-                        f = 1.+(val.z[0]+val.z[1])/2.*fac
-                        if self.depth_ref < 1.:
-                            f = 1./f
-                        sigma_param[i] *= f**3
+                    sigma_param *= f**3
                 icol += self.n_prisms
             elif self.rem_inv:
                 sigma_param = np.ones(self.mPrism.n_prisms)\
                     / self.sigma_rem**2
                 if not np.isclose(self.depth_ref, 1.):
-                    for _, val in self.mPrism.prisms.items():
-                        i += 1
-                        f = 1.+(val.z[0]+val.z[1])/2.*fac
-                        if self.depth_ref < 1.:
-                            f = 1./f
-                        sigma_param[i] *= f**3
+                    sigma_param *= f**3
                 icol += self.n_prisms
         else:
             sigma_data = np.ones(self.n_data)/self.sigma_grav**2
             sigma_param =\
                 np.ones(self.mPrism.n_prisms)/self.sigma_rho**2
-            i = -1
             if not np.isclose(self.depth_ref, 1.):
-                for _, val in self.mPrism.prisms.items():
-                    i += 1
-                    f = 1.+(val.z[0]+val.z[1])/2.*fac
-                    if self.depth_ref < 1.:
-                        f = 1./f
-                    sigma_param[i] *= f**2
+                sigma_param *= f**2
         sigma_param = np.concatenate((sigma_param, np.array([0.])))
         return sigma_data, sigma_param
 
@@ -696,16 +804,20 @@ class inversion():
         nplty = max_ax_row
         width = npltx*5
         height = nplty*5
-        par = []
 # Plot model parameter distribution
-        for key, val in self.mPrism.prisms.items():
-            if self.sus_inv:
-                par.append(val.sus*self.pi4*1000.)
-            elif self.rem_inv:
-                par.append(val.rem)
-            else:
-                par.append(val.rho)
-        par = np.array(par)
+        pset = self.mPrism.get_prism_set()
+        if self.sus_inv:
+            par = pset.sus*self.pi4*1000.
+        elif self.rem_inv:
+            par = pset.rem
+        else:
+            par = pset.rho
+        if self.xprism_min > 100000.:
+            xplt = pset.x/1000.
+            yplt = pset.y/1000.
+        else:
+            xplt = pset.x
+            yplt = pset.y
         i0 += self.mPrism.n_prisms
         k = 0
         vmin = np.quantile(par, 0.01)
@@ -721,33 +833,18 @@ class inversion():
             for j in range(npltx):
                 figx0 += 10
                 patches = []
-                col = []
                 ax = self.fig_par.fig.add_subplot(self.gs[figy0:figy0+8,
                                                           figx0:figx0+8])
                 if k >= n_prop_plots:
                     ax.axis("off")
                     k += 1
                     continue
-                for key, val in self.mPrism.prisms.items():
-                    if val.z[0] <= self.z_plot[k] <= val.z[1]:
-                        if self.xprism_min > 100000.:
-                            x1 = val.x[0]/1000.
-                            x2 = val.x[1]/1000.
-                            y1 = val.y[0]/1000.
-                            y2 = val.y[1]/1000.
-                        else:
-                            x1 = val.x[0]
-                            x2 = val.x[1]
-                            y1 = val.y[0]
-                            y2 = val.y[1]
-                        if self.sus_inv:
-                            col.append(val.sus*self.pi4*1000.)
-                        elif self.rem_inv:
-                            col.append(val.rem)
-                        else:
-                            col.append(val.rho)
-                        patches.append(Rectangle((x1, y1), x2-x1, y2-y1))
-                col = np.array(col)
+                inside = np.where((pset.z[:, 0] <= self.z_plot[k]) &
+                                  (self.z_plot[k] <= pset.z[:, 1]))[0]
+                for x1, x2, y1, y2 in zip(xplt[inside, 0], xplt[inside, 1],
+                                          yplt[inside, 0], yplt[inside, 1]):
+                    patches.append(Rectangle((x1, y1), x2-x1, y2-y1))
+                col = par[inside]
                 p = PatchCollection(patches, cmap="rainbow", norm=norm,
                                     edgecolors=("black",))
                 p.set_array(col)
@@ -839,14 +936,12 @@ class inversion():
             cmap=br_map, norm=norm, cbar_title=unit,
             extent=[self.xplt_min, self.xplt_max,
                     self.yplt_min, self.yplt_max])
-# plot prism contours
-        for key, val in self.mPrism.prisms.items():
-            x1 = val.x[0]
-            x2 = val.x[1]
-            y1 = val.y[0]
-            y2 = val.y[1]
-            self.ax_theo[0].plot([x1, x2, x2, x1, x1], [y1, y1, y2, y2, y1],
-                                 "k", linewidth=1)
+# plot prism contours (all in one line, separated by NaN)
+        x_cont = np.column_stack((pset.x[:, [0, 1, 1, 0, 0]],
+                                  np.full(len(pset), np.nan))).ravel()
+        y_cont = np.column_stack((pset.y[:, [0, 0, 1, 1, 0]],
+                                  np.full(len(pset), np.nan))).ravel()
+        self.ax_theo[0].plot(x_cont, y_cont, "k", linewidth=1)
         self.ax_theo[0].set_xlim([self.xplt_min, self.xplt_max])
         self.ax_theo[0].set_ylim([self.yplt_min, self.yplt_max])
         self.ax_theo[0].grid(visible=True, which="both")
@@ -912,13 +1007,7 @@ class inversion():
                 extent=[self.xplt_min, self.xplt_max,
                         self.yplt_min, self.yplt_max])
 # plot prism contours
-            for key, val in self.mPrism.prisms.items():
-                x1 = val.x[0]
-                x2 = val.x[1]
-                y1 = val.y[0]
-                y2 = val.y[1]
-                self.ax_theo2[0].plot([x1, x2, x2, x1, x1],
-                                      [y1, y1, y2, y2, y1], "k", linewidth=1)
+            self.ax_theo2[0].plot(x_cont, y_cont, "k", linewidth=1)
             self.ax_theo2[0].set_xlim([self.xplt_min, self.xplt_max])
             self.ax_theo2[0].set_ylim([self.yplt_min, self.yplt_max])
             self.ax_theo2[0].grid(visible=True, which="both")
@@ -972,10 +1061,20 @@ class inversion():
         else:
             return True
 
-    def show_synthetic(self):
+    def show_synthetic(self, outlines=None):
         """
         Plots results from synthetic model calculation
 
+        Parameters
+        ----------
+        outlines : numpy 2D float array [n_outlines, 4] or list of such
+                   arrays, optional
+            Horizontal outlines (xmin, xmax, ymin, ymax) of the prisms to be
+            plotted. If a list is given (e.g. one array per chunk of
+            prisms), every array is drawn as one NaN-separated line.
+            If None, the outlines of the prisms of self.mPrism are
+            plotted. Default: None
+
         """
         if "m" in self.data_type:
             self.fig_syn = newWindow("Magnetic data", 1500, 1000, 20, 15)
@@ -1053,16 +1152,18 @@ class inversion():
                 extent=[self.xplt_min, self.xplt_max,
                         self.yplt_min, self.yplt_max])
 # plot prism contours
-        for key, val in self.mPrism.prisms.items():
-            x1 = val.x[0]
-            x2 = val.x[1]
-            y1 = val.y[0]
-            y2 = val.y[1]
-            self.ax_syn[0].plot([x1, x2, x2, x1, x1], [y1, y1, y2, y2, y1],
-                                "k", linewidth=1)
-            if self.n_sensor == 2:
-                self.ax_syn[1].plot([x1, x2, x2, x1, x1], [y1, y1, y2, y2, y1],
-                                    "k", linewidth=1)
+        if outlines is None:
+            outlines = np.array([[val.x[0], val.x[1], val.y[0], val.y[1]]
+                                 for val in self.mPrism.prisms.values()])
+        if isinstance(outlines, np.ndarray):
+            outlines = [outlines]
+# All outlines of a chunk are drawn with a single call
+        for out in outlines:
+            if len(out) == 0:
+                continue
+            xo, yo = utils.outline_path(out)
+            for ax in self.ax_syn[:self.n_sensor]:
+                ax.plot(xo, yo, "k", linewidth=1)
         self.ax_syn[0].set_xlim([self.xplt_min, self.xplt_max])
         self.ax_syn[0].set_ylim([self.yplt_min, self.yplt_max])
         self.ax_syn[0].grid(visible=True, which="both")
@@ -1104,25 +1205,23 @@ class inversion():
                      + " Prism coordinates\n")
             fo.write(f"      X          Y       Z   {text2}   #       W       "
                      + "  E          S          N      top   bottom\n")
-            for key, val in self.mPrism.prisms.items():
-                x1 = val.x[0]
-                x2 = val.x[1]
-                xc = (x1+x2)*0.5
-                y1 = val.y[0]
-                y2 = val.y[1]
-                yc = (y1+y2)*0.5
-                z1 = val.z[0]
-                z2 = val.z[1]
-                zc = (z1+z2)*0.5
-                fo.write(f"{xc:9.2f} {yc:10.2f} {zc:7.2f} ")
-                if self.sus_inv:
-                    fo.write(f"{val.sus*4*np.pi*1E6:10.0f}")
-                if self.rem_inv:
-                    fo.write(f"{val.rem:7.3f}")
-                if self.rho_inv:
-                    fo.write(f"{val.rho:7.0f}")
-                fo.write(f"{key:6d} {x1:9.2f} {x2:9.2f} {y1:10.2f} {y2:10.2f} "
-                         + f"{z1:7.2f} {z2:7.2f}\n")
+            pset = self.mPrism.get_prism_set()
+            xc, yc, zc = pset.centers()
+            cols = [xc, yc, zc]
+            fmt = "%9.2f %10.2f %7.2f "
+            if self.sus_inv:
+                cols.append(pset.sus*4*np.pi*1E6)
+                fmt += "%10.0f"
+            if self.rem_inv:
+                cols.append(pset.rem)
+                fmt += "%7.3f"
+            if self.rho_inv:
+                cols.append(pset.rho)
+                fmt += "%7.0f"
+            cols += [pset.keys, pset.x[:, 0], pset.x[:, 1], pset.y[:, 0],
+                     pset.y[:, 1], pset.z[:, 0], pset.z[:, 1]]
+            fmt += "%6d %9.2f %9.2f %10.2f %10.2f %7.2f %7.2f"
+            np.savetxt(fo, np.column_stack(cols), fmt=fmt)
         return None
 
     def get_inversion_parameters(self, data_type):
@@ -1580,20 +1679,25 @@ class inversion():
             self.mod_yshape = 1
 # Define prisms of initial model
         self.mPrism = PP(self.earth, self.min_size_x, self.min_size_y,
-                         self.min_size_z)
+                         self.min_size_z, n_jobs=self.n_jobs,
+                         disk_cache=self.cache_folder)
         self.nx_prism = len(self.x_prism)-1
         self.ny_prism = len(self.y_prism)-1
         self.nz_prism = len(self.z_prism)-1
         self.n_prisms = self.nx_prism*self.ny_prism*self.nz_prism
         self.prism_nr = []
-        for i in range(self.mod_xshape):
-            xpr = np.array([self.x_prism[i], self.x_prism[i+1]])
-            for j in range(self.mod_yshape):
-                ypr = np.array([self.y_prism[j], self.y_prism[j+1]])
-                for k in range(self.mod_zshape):
-                    zpr = np.array([self.z_prism[k], self.z_prism[k+1]])
-                    self.mPrism.add_prism(xpr, ypr, zpr, 0.001, 0.1,
-                                          self.earth.inc, self.earth.dec, 10.)
+# Prisms are added all at once in the order x, y, z (z varying fastest)
+        ix, iy, iz = np.meshgrid(np.arange(self.mod_xshape),
+                                 np.arange(self.mod_yshape),
+                                 np.arange(self.mod_zshape), indexing="ij")
+        ix = ix.ravel()
+        iy = iy.ravel()
+        iz = iz.ravel()
+        self.mPrism.add_prisms(
+            np.column_stack((self.x_prism[ix], self.x_prism[ix+1])),
+            np.column_stack((self.y_prism[iy], self.y_prism[iy+1])),
+            np.column_stack((self.z_prism[iz], self.z_prism[iz+1])), 0.001,
+            0.1, self.earth.inc, self.earth.dec, 10.)
         print("Model prism dictionary defined with "
               + f"{len(self.mPrism.prisms)} prisms")
 # Prepare book-keeping arrays
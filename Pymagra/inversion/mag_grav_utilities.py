@@ -14,6 +14,17 @@ University Paris-Saclay
        - compon
        - mag_color_map
        - data_plot
+       - outline_path
+       - get_extremes
+       - regular_grid
+       - grid_segments
+       - height_groups
+       - haar_forward
+       - haar_inverse
+       - normal_equations
+       - block_matvec
+       - block_rmatvec
+       - matrix_row
 
     Class: Earth_mag with methods:
           - __init__
@@ -24,6 +35,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 
+# Number of matrix elements treated at once in the blockwise matrix products
+_BLOCK_ELEMENTS = 4000000
+
 
 def magnetization_components(sus, rem, inc, dec, earth):
     """
@@ -386,6 +400,30 @@ def data_plot(data, fig, ax, title="", xtitle="Easting [m]",
     return im, cbar
 
 
+def outline_path(outlines):
+    """
+    Concatenate rectangular outlines into one polyline where the rectangles
+    are separated by NaN values, so that all of them are drawn by a single
+    call to matplotlib's plot.
+
+    Parameters
+    ----------
+    outlines : numpy 2D float array [n_outlines, 4]
+        Rectangles given as (xmin, xmax, ymin, ymax)
+
+    Returns
+    -------
+    x, y : numpy 1D float arrays [6*n_outlines]
+        Coordinates of the polyline
+
+    """
+    x1, x2, y1, y2 = np.asarray(outlines, dtype=float).T
+    gap = np.full_like(x1, np.nan)
+    x = np.column_stack((x1, x2, x2, x1, x1, gap)).ravel()
+    y = np.column_stack((y1, y1, y2, y2, y1, gap)).ravel()
+    return x, y
+
+
 def get_extremes(data, width=5):
     """
     Search position of relative minima and maxima on a 1D or2D grid
@@ -460,3 +498,313 @@ def get_extremes(data, width=5):
             if dd.min() == dmin:
                 min_pos.append((ymin, xmin))
     return min_pos, max_pos
+
+
+def regular_grid(xp, yp, tol=1.E-6):
+    """
+    Check whether points lie on a regular grid ordered like a flattened 2D
+    array of shape [ny, nx] (x varying fastest, as produced by
+    inversion.prepare_data).
+
+    Parameters
+    ----------
+    xp, yp : numpy 1D float arrays [n_points]
+        Coordinates of points
+    tol : float, optional; default: 1.E-6
+        Tolerance relative to the grid step for coordinate comparisons
+
+    Returns
+    -------
+    grid : tuple (x0, dx, nx, y0, dy, ny) or None
+        Origin, step and number of points in x and y direction. If there is
+        only one point in one direction, the corresponding step is set to 1.
+        None if the points do not form a regular grid.
+
+    """
+    n = len(xp)
+    if n == 0:
+        return None
+    nx = n
+    iy = np.where(yp != yp[0])[0]
+    if len(iy) > 0:
+        nx = iy[0]
+    if n % nx:
+        return None
+    ny = n//nx
+    x = xp.reshape(ny, nx)
+    y = yp.reshape(ny, nx)
+    dx = x[0, 1] - x[0, 0] if nx > 1 else 1.
+    dy = y[1, 0] - y[0, 0] if ny > 1 else 1.
+    if dx <= 0. or dy <= 0.:
+        return None
+    x0 = x[0, 0]
+    y0 = y[0, 0]
+    if np.abs(x - (x0 + dx*np.arange(nx))[None, :]).max() > tol*dx:
+        return None
+    if np.abs(y - (y0 + dy*np.arange(ny))[:, None]).max() > tol*dy:
+        return None
+    return x0, dx, nx, y0, dy, ny
+
+
+def grid_segments(xp, yp, zp):
+    """
+    Split a series of points into segments of constant height (e.g. data of
+    different sensors) and check for each segment whether the points form a
+    regular grid (see regular_grid).
+
+    Parameters
+    ----------
+    xp, yp, zp : numpy 1D float arrays [n_points]
+        Coordinates of points
+
+    Returns
+    -------
+    segments : list of tuples (slice, grid)
+        slice: position of the segment within the point arrays
+        grid: tuple (x0, dx, nx, y0, dy, ny) or None if the segment is not a
+        regular grid
+
+    """
+    n = len(zp)
+    if n == 0:
+        return []
+    breaks = list(np.where(np.diff(zp) != 0.)[0]+1)
+    segments = []
+    for i0, i1 in zip([0] + breaks, breaks + [n]):
+        segments.append((slice(i0, i1), regular_grid(xp[i0:i1], yp[i0:i1])))
+    return segments
+
+
+def height_groups(xp, yp):
+    """
+    Check whether a series of points consists of several copies of the same
+    horizontal positions (e.g. data of a gradiometer measured at two sensor
+    heights and stored one sensor after the other).
+
+    Parameters
+    ----------
+    xp, yp : numpy 1D float arrays [n_points]
+        Horizontal coordinates of points
+
+    Returns
+    -------
+    n_heights : int
+        Number of copies. The points of copy i are
+        xp[i*n_points//n_heights:(i+1)*n_points//n_heights]. If the points
+        are not repeated, n_heights is 1.
+
+    """
+    n = len(xp)
+    if n < 2:
+        return 1
+    for n1 in np.where((xp == xp[0]) & (yp == yp[0]))[0][1:]:
+        if n % n1:
+            continue
+        if np.array_equal(xp.reshape(-1, n1), np.broadcast_to(
+                xp[:n1], (n//n1, n1))) and np.array_equal(
+                    yp.reshape(-1, n1), np.broadcast_to(yp[:n1],
+                                                        (n//n1, n1))):
+            return n//n1
+    return 1
+
+
+def haar_forward(a, axis=-1):
+    """
+    Multilevel orthonormal Haar wavelet transform along one axis.
+
+    At every level, pairs of neighbouring values are replaced by their
+    normalized sums (stored at the beginning of the axis) and differences
+    (stored behind). If the number of values is odd, the last one is carried
+    unchanged to the next level. The transform is repeated on the sums until
+    only one value is left.
+
+    Parameters
+    ----------
+    a : numpy float array
+        Values to be transformed
+    axis : int, optional; default: -1
+        Axis along which the transform is done
+
+    Returns
+    -------
+    numpy float array with the same shape as a
+        Wavelet coefficients
+
+    """
+    c = np.moveaxis(np.array(a, dtype=np.float64), axis, -1)
+    n = c.shape[-1]
+    while n > 1:
+        m = n//2
+        even = c[..., 0:2*m:2].copy()
+        odd = c[..., 1:2*m:2].copy()
+        c[..., m:m+n % 2] = c[..., 2*m:n].copy()
+        c[..., :m] = (even+odd)/np.sqrt(2.)
+        c[..., m+n % 2:n] = (even-odd)/np.sqrt(2.)
+        n = m + n % 2
+    return np.moveaxis(c, -1, axis)
+
+
+def haar_inverse(c, axis=-1):
+    """
+    Inverse of haar_forward
+
+    Parameters
+    ----------
+    c : numpy float array
+        Wavelet coefficients
+    axis : int, optional; default: -1
+        Axis along which the transform is done
+
+    Returns
+    -------
+    numpy float array with the same shape as c
+        Reconstructed values
+
+    """
+    a = np.moveaxis(np.array(c, dtype=np.float64), axis, -1)
+    lengths = []
+    n = a.shape[-1]
+    while n > 1:
+        lengths.append(n)
+        n = n//2 + n % 2
+    for n in lengths[::-1]:
+        m = n//2
+        s = a[..., :m].copy()
+        d = a[..., m+n % 2:n].copy()
+        a[..., 2*m:n] = a[..., m:m+n % 2].copy()
+        a[..., 0:2*m:2] = (s+d)/np.sqrt(2.)
+        a[..., 1:2*m:2] = (s-d)/np.sqrt(2.)
+    return np.moveaxis(a, -1, axis)
+
+
+def normal_equations(G, sigma_data, data, scale=None,
+                     block_size=_BLOCK_ELEMENTS):
+    """
+    Calculate G.T*Cd*G and G.T*Cd*data by blocks of rows of G, so that no
+    temporary array of the size of G is needed. G may be a numpy memmap and
+    may be single precision; the products are accumulated in double
+    precision.
+
+    Parameters
+    ----------
+    G : numpy 2D float array [n_data, n_param]
+        Frechet matrix
+    sigma_data : numpy 1D float array [n_data]
+        Diagonal of the data covariance matrix Cd
+    data : numpy 1D float array [n_data]
+        Data vector
+    scale : numpy 1D float array [n_param], optional; default: None
+        If given, the columns of G are multiplied by scale
+    block_size : int, optional; default: 4000000
+        Approximate number of matrix elements per block
+
+    Returns
+    -------
+    G_inv : numpy 2D float array [n_param, n_param]
+        G.T*Cd*G
+    rhs : numpy 1D float array [n_param]
+        G.T*Cd*data
+
+    """
+    n_rows, n_param = G.shape
+    n_block = max(1, block_size//n_param)
+    G_inv = np.zeros((n_param, n_param))
+    rhs = np.zeros(n_param)
+    for i0 in range(0, n_rows, n_block):
+        i1 = min(i0+n_block, n_rows)
+        Gb = np.asarray(G[i0:i1], dtype=np.float64)
+        if scale is not None:
+            Gb = Gb*scale
+        GCT = Gb.T*sigma_data[i0:i1]
+        G_inv += GCT @ Gb
+        rhs += GCT @ data[i0:i1]
+    return G_inv, rhs
+
+
+def block_matvec(G, vector, block_size=_BLOCK_ELEMENTS):
+    """
+    Calculate the product of a matrix with a vector. Dense matrices (e.g.
+    numpy memmaps) are read by blocks of rows; other types (sparse
+    matrices, linear operators) use their own product.
+
+    Parameters
+    ----------
+    G : numpy 2D float array [n_rows, n_cols] or matrix-like object
+        Matrix
+    vector : numpy 1D float array [n_cols]
+        Vector
+    block_size : int, optional; default: 4000000
+        Approximate number of matrix elements per block
+
+    Returns
+    -------
+    numpy 1D float array [n_rows]
+
+    """
+    if not isinstance(G, np.ndarray):
+        return G @ vector
+    n_rows, n_cols = G.shape
+    n_block = max(1, block_size//max(n_cols, 1))
+    result = np.zeros(n_rows)
+    for i0 in range(0, n_rows, n_block):
+        result[i0:i0+n_block] = np.asarray(G[i0:i0+n_block],
+                                           dtype=np.float64) @ vector
+    return result
+
+
+def block_rmatvec(G, vector, block_size=_BLOCK_ELEMENTS):
+    """
+    Calculate the product of the transpose of a matrix with a vector. As in
+    block_matvec, dense matrices are read by blocks of rows.
+
+    Parameters
+    ----------
+    G : numpy 2D float array [n_rows, n_cols] or matrix-like object
+        Matrix
+    vector : numpy 1D float array [n_rows]
+        Vector
+    block_size : int, optional; default: 4000000
+        Approximate number of matrix elements per block
+
+    Returns
+    -------
+    numpy 1D float array [n_cols]
+
+    """
+    if not isinstance(G, np.ndarray):
+        return G.T @ vector
+    n_rows, n_cols = G.shape
+    n_block = max(1, block_size//max(n_cols, 1))
+    result = np.zeros(n_cols)
+    for i0 in range(0, n_rows, n_block):
+        result += vector[i0:i0+n_block] @ np.asarray(G[i0:i0+n_block],
+                                                     dtype=np.float64)
+    return result
+
+
+def matrix_row(G, i):
+    """
+    Extract one row of a matrix. For matrix-free operators, the row is the
+    product of the transpose of the operator with the unit vector i, so that
+    the matrix is never formed.
+
+    Parameters
+    ----------
+    G : numpy 2D float array, scipy sparse matrix or matrix-like object
+        [n_rows, n_cols]
+        Matrix
+    i : int
+        Index of the row
+
+    Returns
+    -------
+    numpy 1D float array [n_cols]
+
+    """
+    if isinstance(G, np.ndarray):
+        return np.asarray(G[i], dtype=np.float64)
+    if hasattr(G, "toarray"):
+        return G[[i], :].toarray().ravel()
+    unit = np.zeros(G.shape[0])
+    unit[i] = 1.
+    return block_rmatvec(G, unit)
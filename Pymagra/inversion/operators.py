@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+"""
+Last modified: Nov 22, 2024
+
+@author: Hermann Zeyen
+        University Paris-Saclay
+
+Contains two classes:
+    FFTSensitivity: matrix-free linear operator applying the Frechet matrix
+    of a prism model (see Prism_calc.create_Frechet) and its transpose to
+    vectors by 2D FFT convolutions.
+        Contains the following methods:
+        - __init__
+        - _matvec: product of the Frechet matrix with a parameter vector
+        - _rmatvec: product of the transposed Frechet matrix with a data
+          vector
+        - normal_diagonal: diagonal of G.T*Cd*G
+        - to_dense: explicit Frechet matrix (for control purposes)
+
+    WaveletFrechet: Frechet matrix stored as sparse matrix of the Haar
+    wavelet coefficients of its rows
+        Contains the following methods:
+        - __init__
+        - layer_groups: groups parameters by prism layers
+        - transform: wavelet transform of the rows of a matrix
+        - back_transform: inverse wavelet transform of the rows of a matrix
+        - _matvec: product of the Frechet matrix with a parameter vector
+        - _rmatvec: product of the transposed Frechet matrix with a data
+          vector
+        - __getitem__: dense sub-matrix of the reconstructed Frechet matrix
+
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.fft import rfft2, irfft2, next_fast_len
+from scipy.sparse.linalg import LinearOperator
+from . import mag_grav_utilities as utils
+from .progress import Progress
+
+# Number of matrix elements calculated and transformed at once when
+# compressing the Frechet matrix row block by row block
+_BLOCK_ELEMENTS = 4000000
+
+
+class FFTSensitivity(LinearOperator):
+    """
+    Frechet matrix of a prism model for data located on regular grids (one
+    grid of constant height per sensor).
+
+    For every grid, prisms are grouped into classes of equal size, depth and
+    position relative to the grid nodes (see Prism_calc.kernel_classes), in a
+    regular mesh usually one class per layer. Within a class, the effect of
+    all prisms is the 2D convolution of their parameter values (placed on the
+    lattice of prism shifts) with the kernel of one reference prism, which is
+    block-Toeplitz. Products are therefore calculated by FFT and only the
+    Fourier transforms of the reference kernels are stored: memory is of the
+    order of (number of data + number of prisms) per layer instead of their
+    product.
+
+    Data and parameters are ordered as in Prism_calc.create_Frechet:
+    rows contain magnetic data (if sus_inv or rem_inv) followed by gravity
+    data (if rho_inv); columns contain susceptibilities, remanences and
+    densities of all prisms (as far as they are inverted) followed by the
+    data zero level.
+
+    """
+
+    def __init__(self, mPrism, sus_inv, rem_inv, rho_inv, xp, yp, zp):
+        """
+        Calculate Fourier transforms of the reference kernels
+
+        Parameters
+        ----------
+        mPrism : object of class Prism_calc
+            Prism model
+        sus_inv, rem_inv, rho_inv : bool
+            If True, susceptibilities, remanences, densities are model
+            parameters
+        xp, yp, zp : 1D numpy float arrays
+            Coordinates of data points. Points of every sensor must form a
+            regular grid at constant height (see utils.grid_segments)
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sus_inv = sus_inv
+        self.rem_inv = rem_inv
+        self.rho_inv = rho_inv
+        segments = utils.grid_segments(xp, yp, zp)
+        self.n_prisms = mPrism.n_prisms
+        self.n_points = len(xp)
+        n_mag = 0
+        if sus_inv or rem_inv:
+            n_mag = self.n_points
+        n_grav = 0
+        if rho_inv:
+            n_grav = self.n_points
+        n_param = mPrism.get_n_param(sus_inv, rem_inv, rho_inv)
+        super().__init__(np.float64, (n_mag+n_grav, n_param))
+# Position of data and parameter blocks
+        self.row_mag = 0
+        self.row_grav = n_mag
+        icol = 0
+        self.col_sus = icol
+        if sus_inv:
+            icol += self.n_prisms
+        self.col_rem = icol
+        if rem_inv:
+            icol += self.n_prisms
+        self.col_rho = icol
+# Magnetization components for unit susceptibility and unit remanence
+#    (same convention as Prism_calc.combine_unit_deriv)
+        self.m_sus = np.zeros((self.n_prisms, 3))
+        self.m_rem = np.zeros((self.n_prisms, 3))
+        for i, val in enumerate(mPrism.prisms.values()):
+            self.m_sus[i] = utils.magnetization_components(
+                1., 0., val.dec, val.inc, mPrism.earth)
+            self.m_rem[i] = utils.magnetization_components(
+                0., 1., val.dec, val.inc, mPrism.earth)
+        kinds = []
+        if sus_inv or rem_inv:
+            kinds.append("mag")
+        if rho_inv:
+            kinds.append("grav")
+# For every kind of data, every grid and every class, store the prism
+#    indices, their shifts relative to the lattice origin and the Fourier
+#    transformed reference kernels
+        x, y, z = mPrism.get_prism_coor()
+        self.blocks = {}
+        for kind in kinds:
+            self.blocks[kind] = []
+            for jp, grid in segments:
+                x0, dx, nx, y0, dy, ny = grid
+                zp0 = zp[jp.start]
+                sx, sy, classes = mPrism.kernel_classes(
+                    x, y, z, zp0, grid, kind)
+                classes_seg = []
+                for members in classes.values():
+                    sx_max = sx[members].max()
+                    sx_min = sx[members].min()
+                    sy_max = sy[members].max()
+                    sy_min = sy[members].min()
+                    ox = np.arange(-sx_max, nx-sx_min)
+                    oy = np.arange(-sy_max, ny-sy_min)
+                    i0 = members[0]
+                    kernel = mPrism.reference_kernel(
+                        x[i0], y[i0], z[i0], x0 + (sx[i0] + ox)*dx,
+                        y0 + (sy[i0] + oy)*dy, zp0, kind)
+                    shape = (next_fast_len(len(oy), real=True),
+                             next_fast_len(len(ox), real=True))
+                    classes_seg.append(
+                        (members, sx[members]-sx_min, sy[members]-sy_min,
+                         sx[members]-sx_max, sy[members]-sy_max, shape,
+                         rfft2(kernel, s=shape)))
+                self.blocks[kind].append((jp, nx, ny, classes_seg))
+
+    def _matvec(self, params):
+        """
+        Calculate the data produced by a parameter vector
+
+        Parameters
+        ----------
+        params : numpy 1D float array [n_param]
+            Parameter values, ordered as the columns of the Frechet matrix
+
+        Returns
+        -------
+        data : numpy 1D float array [n_data]
+
+        """
+        params = np.asarray(params, dtype=np.float64).ravel()
+        data = np.full(self.shape[0], params[-1])
+        for kind, blocks in self.blocks.items():
+            if kind == "mag":
+# Magnetization vectors of all prisms
+                mag = np.zeros((self.n_prisms, 3))
+                if self.sus_inv:
+                    p = params[self.col_sus:self.col_sus+self.n_prisms]
+                    mag += p[:, None]*self.m_sus
+                if self.rem_inv:
+                    p = params[self.col_rem:self.col_rem+self.n_prisms]
+                    mag += p[:, None]*self.m_rem
+                row = self.row_mag
+            else:
+                mag = params[self.col_rho:self.col_rho+self.n_prisms, None]
+                row = self.row_grav
+            for jp, nx, ny, classes in blocks:
+                d = np.zeros((ny, nx))
+                for members, ax, ay, _, _, shape, kernel_f in classes:
+                    lx = ax.max() + 1
+                    ly = ay.max() + 1
+                    conv_f = 0.
+                    for k in range(mag.shape[1]):
+                        lattice = np.zeros(shape)
+                        lattice[ay, ax] = mag[members, k]
+                        conv_f = conv_f + rfft2(lattice)*kernel_f[k]
+                    d += irfft2(conv_f, s=shape)[ly-1:ly-1+ny, lx-1:lx-1+nx]
+                data[row+jp.start:row+jp.stop] += d.ravel()
+        return data
+
+    def _rmatvec(self, data):
+        """
+        Calculate the product of the transposed Frechet matrix with a data
+        vector
+
+        Parameters
+        ----------
+        data : numpy 1D float array [n_data]
+            Data values, ordered as the rows of the Frechet matrix
+
+        Returns
+        -------
+        params : numpy 1D float array [n_param]
+
+        """
+        data = np.asarray(data, dtype=np.float64).ravel()
+        params = np.zeros(self.shape[1])
+        params[-1] = data.sum()
+        for kind, blocks in self.blocks.items():
+            if kind == "mag":
+                row = self.row_mag
+                g = np.zeros((self.n_prisms, 3))
+            else:
+                row = self.row_grav
+                g = np.zeros((self.n_prisms, 1))
+            for jp, nx, ny, classes in blocks:
+                d = data[row+jp.start:row+jp.stop].reshape(ny, nx)
+                d_f = {}
+                for members, _, _, bx, by, shape, kernel_f in classes:
+# Correlation of data with the kernel, read at the shifts of the prisms
+                    if shape not in d_f:
+                        d_f[shape] = rfft2(d, s=shape)
+                    for k in range(g.shape[1]):
+                        corr = irfft2(d_f[shape]*np.conj(kernel_f[k]),
+                                      s=shape)
+                        g[members, k] += corr[by, bx]
+            if kind == "mag":
+                if self.sus_inv:
+                    params[self.col_sus:self.col_sus+self.n_prisms] =\
+                        np.sum(g*self.m_sus, axis=1)
+                if self.rem_inv:
+                    params[self.col_rem:self.col_rem+self.n_prisms] =\
+                        np.sum(g*self.m_rem, axis=1)
+            else:
+                params[self.col_rho:self.col_rho+self.n_prisms] = g[:, 0]
+        return params
+
+    def normal_diagonal(self, sigma_data):
+        """
+        Calculate the diagonal of G.T*Cd*G (see solvers.normal_diagonal).
+        The squared columns of the prisms of a class are shifted copies of
+        products of the reference kernel components, so that the diagonal is
+        obtained by correlations of the data weights with these products.
+
+        Parameters
+        ----------
+        sigma_data : numpy 1D float array [n_data]
+            Diagonal of the inverse data covariance matrix Cd
+
+        Returns
+        -------
+        diag : numpy 1D float array [n_param]
+
+        """
+        sigma_data = np.asarray(sigma_data, dtype=np.float64).ravel()
+        diag = np.zeros(self.shape[1])
+        diag[-1] = sigma_data.sum()
+        for kind, blocks in self.blocks.items():
+            if kind == "mag":
+                row = self.row_mag
+                n_comp = 3
+            else:
+                row = self.row_grav
+                n_comp = 1
+# g[i, k, l]: weighted sum over data of the products of components k and l
+#    of the kernel of prism i (only k <= l is calculated)
+            g = np.zeros((self.n_prisms, n_comp, n_comp))
+            for jp, nx, ny, classes in blocks:
+                s = sigma_data[row+jp.start:row+jp.stop].reshape(ny, nx)
+                s_f = {}
+                for members, _, _, bx, by, shape, kernel_f in classes:
+                    if shape not in s_f:
+                        s_f[shape] = rfft2(s, s=shape)
+                    kernel = irfft2(kernel_f, s=shape)
+                    for k in range(n_comp):
+                        for m in range(k, n_comp):
+                            corr = irfft2(s_f[shape]*np.conj(rfft2(
+                                kernel[k]*kernel[m])), s=shape)
+                            g[members, k, m] += corr[by, bx]
+            if kind == "mag":
+                g += np.triu(g, 1).transpose(0, 2, 1)
+                if self.sus_inv:
+                    diag[self.col_sus:self.col_sus+self.n_prisms] = np.einsum(
+                        "ik,ikm,im->i", self.m_sus, g, self.m_sus)
+                if self.rem_inv:
+                    diag[self.col_rem:self.col_rem+self.n_prisms] = np.einsum(
+                        "ik,ikm,im->i", self.m_rem, g, self.m_rem)
+            else:
+                diag[self.col_rho:self.col_rho+self.n_prisms] = g[:, 0, 0]
+        return diag
+
+    def to_dense(self):
+        """
+        Build the explicit Frechet matrix column by column. Only meant for
+        control of small problems.
+
+        Returns
+        -------
+        numpy 2D float array [n_data, n_param]
+
+        """
+        dense = np.zeros(self.shape)
+        e = np.zeros(self.shape[1])
+        for i in range(self.shape[1]):
+            e[i] = 1.
+            dense[:, i] = self._matvec(e)
+            e[i] = 0.
+        return dense
+
+
+class WaveletFrechet(LinearOperator):
+    """
+    Frechet matrix of a prism model compressed in the wavelet domain.
+
+    Every row of the Frechet matrix (effect of all prisms at one data point)
+    is a smooth function of the prism position. Rows are calculated block
+    by block directly from the prism kernels and compressed at once, so that
+    the dense matrix never exists. It is transformed with an
+    orthonormal Haar wavelet transform, separately for every parameter type
+    and every layer of prisms (prisms with the same vertical extension). If
+    the prisms of a layer form a complete regular mesh, the transform is done
+    separably in both horizontal directions, else along the prisms sorted by
+    Y and X coordinates. Wavelet coefficients smaller than threshold times
+    the largest coefficient of the row are dropped and the remaining ones are
+    stored in a sparse CSR matrix. The column of the zero level is not
+    transformed and always kept.
+
+    Since the transform is orthonormal, G @ p = C @ (W @ p) and
+    G.T @ d = W.T @ (C.T @ d), where C is the matrix of coefficients and W
+    the wavelet transform.
+
+    """
+
+    def __init__(self, mPrism, sus_inv, rem_inv, rho_inv, xp, yp, zp,
+                 threshold=1.E-3, callback=None, cancel=None):
+        """
+        Calculate the Frechet matrix row block by row block and compress
+        every block
+
+        Parameters
+        ----------
+        mPrism : object of class Prism_calc
+            Prism model
+        sus_inv, rem_inv, rho_inv : bool
+            If True, susceptibilities, remanences, densities are model
+            parameters
+        xp, yp, zp : 1D numpy float arrays
+            Coordinates of data points
+        threshold : float, optional; default: 1.E-3
+            Wavelet coefficients smaller than threshold times the absolute
+            maximum coefficient of their row are set to zero
+        callback, cancel : optional; default: None
+            Progress callback and cancellation token (see progress.Progress)
+
+        Returns
+        -------
+        None.
+
+        """
+        xp = np.asarray(xp, dtype=np.float64)
+        yp = np.asarray(yp, dtype=np.float64)
+        zp = np.asarray(zp, dtype=np.float64)
+        keys = list(mPrism.prisms.keys())
+        n_prisms = len(keys)
+        n_points = len(xp)
+        kinds = []
+        if sus_inv or rem_inv:
+            kinds.append("mag")
+        if rho_inv:
+            kinds.append("grav")
+        n_param = mPrism.get_n_param(sus_inv, rem_inv, rho_inv)
+        super().__init__(np.float64, (len(kinds)*n_points, n_param))
+        self.groups = self.layer_groups(mPrism, sus_inv, rem_inv, rho_inv)
+# First columns of susceptibilities, remanences and densities
+        col_sus = 0
+        col_rem = n_prisms if sus_inv else 0
+        col_rho = col_rem + (n_prisms if rem_inv else 0)
+        progress = Progress(callback, cancel, "wavelet Frechet matrix")
+        progress.start(len(kinds)*n_prisms*n_points)
+        n_rows = max(1, _BLOCK_ELEMENTS//n_param)
+        blocks = []
+        energy = 0.
+        energy_kept = 0.
+        for kind in kinds:
+            for i0 in range(0, n_points, n_rows):
+                jp = slice(i0, min(i0+n_rows, n_points))
+                rows = np.zeros((jp.stop-jp.start, n_param))
+                rows[:, -1] = 1.
+                for k0, k1, der in mPrism.deriv_chunks(
+                        keys, xp[jp], yp[jp], zp[jp], kind, progress,
+                        start=False):
+                    if kind == "grav":
+                        rows[:, col_rho+k0:col_rho+k1] = der[0].T
+                        continue
+                    sus_der, rem_der = mPrism.combine_unit_deriv(
+                        keys[k0:k1], der, sus_inv, rem_inv)
+                    if sus_inv:
+                        rows[:, col_sus+k0:col_sus+k1] = sus_der.T
+                    if rem_inv:
+                        rows[:, col_rem+k0:col_rem+k1] = rem_der.T
+                coef = self.transform(rows)
+                del rows
+                amp = np.abs(coef)
+                keep = (amp >= threshold*amp[:, :-1].max(axis=1,
+                                                          keepdims=True))\
+                    & (coef != 0.)
+                keep[:, -1] = True
+                energy += np.sum(coef**2)
+                energy_kept += np.sum(coef[keep]**2)
+                blocks.append(sparse.csr_matrix(np.where(keep, coef, 0.)))
+        self.coef = sparse.vstack(blocks, format="csr")
+        print(f"Wavelet Frechet matrix: "
+              + f"{100.*self.coef.nnz/max(1, np.prod(self.shape)):0.1f}% of "
+              + "coefficients kept, discarded energy: "
+              + f"{100.*(1.-energy_kept/max(energy, 1.E-300)):0.4f}%")
+
+    def layer_groups(self, mPrism, sus_inv, rem_inv, rho_inv):
+        """
+        Group the parameters (columns of the Frechet matrix) by parameter
+        type and prism layer
+
+        Parameters
+        ----------
+        mPrism : object of class Prism_calc
+            Prism model
+        sus_inv, rem_inv, rho_inv : bool
+            If True, susceptibilities, remanences, densities are model
+            parameters
+
+        Returns
+        -------
+        groups : list of tuples (columns, shape)
+            columns: numpy int array, columns of the parameters of one layer,
+            sorted by Y and X coordinate of the prism centers
+            shape: tuple (ny, nx) if the prisms form a complete regular mesh,
+            else None
+
+        """
+        x, y, z = mPrism.get_prism_coor()
+        xc = x.mean(axis=1)
+        yc = y.mean(axis=1)
+        _, layer = np.unique(z, axis=0, return_inverse=True)
+        layer = layer.ravel()
+        offsets = []
+        icol = 0
+        for inv in (sus_inv, rem_inv, rho_inv):
+            if inv:
+                offsets.append(icol)
+                icol += mPrism.n_prisms
+        groups = []
+        for il in range(layer.max()+1):
+            idx = np.where(layer == il)[0]
+            idx = idx[np.lexsort((xc[idx], yc[idx]))]
+            grid = utils.regular_grid(xc[idx], yc[idx])
+            shape = None
+            if grid is not None:
+                shape = (int(grid[5]), int(grid[2]))
+            for off in offsets:
+                groups.append((off+idx, shape))
+        return groups
+
+    def transform(self, rows):
+        """
+        Wavelet transform of the rows of a matrix
+
+        Parameters
+        ----------
+        rows : numpy 2D float array [n_rows, n_param]
+            Rows of the Frechet matrix (or parameter vectors)
+
+        Returns
+        -------
+        numpy 2D float array [n_rows, n_param]
+            Wavelet coefficients
+
+        """
+        rows = np.atleast_2d(rows)
+        coef = np.array(rows, dtype=np.float64)
+        for columns, shape in self.groups:
+            c = rows[:, columns]
+            if shape is None:
+                c = utils.haar_forward(c, axis=1)
+            else:
+                c = c.reshape(-1, *shape)
+                c = utils.haar_forward(utils.haar_forward(c, axis=2), axis=1)
+            coef[:, columns] = c.reshape(len(rows), -1)
+        return coef
+
+    def back_transform(self, coef):
+        """
+        Inverse wavelet transform of the rows of a matrix
+
+        Parameters
+        ----------
+        coef : numpy 2D float array [n_rows, n_param]
+            Wavelet coefficients
+
+        Returns
+        -------
+        numpy 2D float array [n_rows, n_param]
+
+        """
+        coef = np.atleast_2d(coef)
+        rows = np.array(coef, dtype=np.float64)
+        for columns, shape in self.groups:
+            c = coef[:, columns]
+            if shape is None:
+                c = utils.haar_inverse(c, axis=1)
+            else:
+                c = c.reshape(-1, *shape)
+                c = utils.haar_inverse(utils.haar_inverse(c, axis=1), axis=2)
+            rows[:, columns] = c.reshape(len(coef), -1)
+        return rows
+
+    def _matvec(self, params):
+        """
+        Calculate the data produced by a parameter vector
+
+        Parameters
+        ----------
+        params : numpy 1D float array [n_param]
+
+        Returns
+        -------
+        data : numpy 1D float array [n_data]
+
+        """
+        params = np.asarray(params, dtype=np.float64).ravel()
+        return self.coef @ self.transform(params)[0]
+
+    def _rmatvec(self, data):
+        """
+        Calculate the product of the transposed Frechet matrix with a data
+        vector
+
+        Parameters
+        ----------
+        data : numpy 1D float array [n_data]
+
+        Returns
+        -------
+        params : numpy 1D float array [n_param]
+
+        """
+        data = np.asarray(data, dtype=np.float64).ravel()
+        return self.back_transform(self.coef.T @ data)[0]
+
+    def __getitem__(self, index):
+        """
+        Extract a dense sub-matrix of the reconstructed Frechet matrix
+
+        Parameters
+        ----------
+        index : tuple of two slices or index arrays
+            Rows and columns to be extracted
+
+        Returns
+        -------
+        numpy 2D float array
+
+        """
+        rows, columns = index
+        return self.back_transform(self.coef[rows].toarray())[:, columns]
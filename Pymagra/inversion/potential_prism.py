@@ -5,12 +5,16 @@ Last modified: Nov 22, 2024
 @author: Hermann Zeyen
         University Paris-Saclay
 
-Contains two classes:
+Contains six classes:
     Prism: Defines position and properties of one prism
         Contains the following methods:
         - __init__
         - mag_prism (calculates magnetic effect at one point)
+        - mag_prism_batch (calculates magnetic effect at all points)
         - grav_prism (calculates gravity effect at one point)
+        - grav_prism_batch (calculates gravity effect at all points)
+        - mag_grav_prism_batch (calculates magnetic and gravity effects at
+          all points in one pass)
         - change_props (modifies one or several properties)
         - change_coor (modifies one or several prism coordinates)
 
@@ -20,8 +24,31 @@ Contains two classes:
     Contains the following methods:
         - __init__
         - add_prism: adds an entrance of class Prism to a dictionary
+        - add_prisms: adds several prisms at once
+        - get_prism_set: columnar copy (PrismSet) of the dictionary
         - remove_prism: removes an entrance of classe Prism from
           dictionary
+        - locate: keys of the prisms containing a point
+        - get_prism_coor: collects prism face coordinates into arrays
+        - get_blocks: splits prism-point combinations into blocks
+          respecting a memory budget
+        - height_sets: arranges points repeated at several heights
+        - combine_unit_deriv: susceptibility and remanence derivatives
+          from unit magnetization responses
+        - deriv_chunks: calculates derivative columns chunk by chunk of
+          prisms
+        - calc_deriv: calculates derivative columns of prisms
+        - cached_deriv: extracts derivative columns at gridded points from
+          translation-invariant reference kernels
+        - kernel_classes: groups prisms with shifted identical kernels
+        - reference_kernel: derivatives of one prism on a regular grid
+        - clear_kernel_cache: empties the cache of reference kernels
+        - cache_key: disk cache key of derivative columns or forward
+          responses
+        - direct_deriv: calculates derivatives block by block, optionally
+          on a pool of processes
+        - build_octree: organizes prisms in an octree
+        - tree_forward: approximate forward calculation using the octree
         - mag_forward: Solves magnetic forward problem for all prisms
           at all points
         - mag_deriv: Calculates derivatives of magnetic effect with
@@ -31,8 +58,15 @@ Contains two classes:
           at all points
         - grav_deriv: Calculates derivatives of magnetic effect with
           respect to density
+        - joint_forward: Solves magnetic and gravity forward problems in
+          one pass
         - create_Frechet: Assembles the derivative vectors of each
           prism into a Freceht matrix
+        - create_sparse_Frechet: Frechet matrix in sparse CSR format
+        - create_operator: Matrix-free FFT equivalent of the Frechet matrix
+          for regularly gridded data
+        - create_wavelet_Frechet: Frechet matrix compressed in the wavelet
+          domain
         - get_max_prisms: Find all prisms located below the strongest
           absolute maximum of magnetic and gravity fields.
           Usually used during inversion procedure where
@@ -41,11 +75,503 @@ Contains two classes:
           all directions as long as prisms stay larger than
           a given minimum size.
 
+    FrechetStore: Growable storage of the Frechet matrix allowing to remove
+    and add columns in place
+        Contains the following methods:
+        - __init__
+        - matrix: view of the actual Frechet matrix
+        - update: rearranges columns according to a new list of labels
+
+    PrismSet: Columnar storage of bounds, properties and neighbour links of
+    a set of prisms, allowing vectorized operations
+        Contains the following methods:
+        - __init__
+        - from_prisms: builds a PrismSet from a dictionary of prisms
+        - positions: positions of prisms in the arrays from their keys
+        - centers: coordinates of prism centers
+        - add: adds prisms and their neighbour links
+        - link_new: determines neighbour links of newly added prisms
+        - remove: removes prisms and their neighbour links
+        - split: replaces prisms by up to 8 prisms of half size
+
+    PrismIndex: Spatial index of prisms on a hashed regular grid used for
+    neighbour, overlap and point-location queries
+        Contains the following methods:
+        - __init__
+        - cells: grid cells covered by a box
+        - add_to_grid: registers a prism in the grid cells
+        - adapt: adapts the cell size to the typical prism size
+        - insert: adds a prism to the index
+        - remove: removes a prism from the index
+        - query: prisms touching or overlapping a box
+        - neighbours: prisms sharing a face with a box
+        - locate: prisms containing a point
+
+    DiskCache: Content-addressed storage of calculated arrays in a folder
+        Contains the following methods:
+        - __init__
+        - key: hash of a label and a series of arrays
+        - load: reads an array from the cache
+        - save: writes an array into the cache
+        - clear: deletes all cached arrays
+
 """
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import os
+from multiprocessing import shared_memory
 from . import mag_grav_utilities as utils
+from .operators import FFTSensitivity, WaveletFrechet
+from .progress import Cancelled, Progress
 from ..in_out.earth import Earth_mag as Earth
 import numpy as np
+from scipy import sparse
+
+# Signs of the eight corner terms of a prism. Index 0 corresponds to the
+# smaller coordinate of an edge pair (equivalent to Prism.iga, igb, igh)
+_SIG = np.array([-1., 1.])
+_CORNER_SIGN = (_SIG[:, None, None]*_SIG[None, :, None]
+                * _SIG[None, None, :])[None, :, :, :, None]
+# Approximate peak memory [bytes] used by the tensor kernels per combination
+# of one prism and one calculation point (eight corners, about a dozen
+# temporary float arrays)
+_BYTES_PER_PAIR = 1000
+# Minimum number of prism-point combinations for which derivatives are
+# calculated on a process pool (for less, starting the pool costs more time
+# than is gained)
+_MIN_PARALLEL_PAIRS = 2000000
+# Minimum number of points of a regular grid for which derivatives are taken
+# from cached reference kernels (see Prism_calc.cached_deriv)
+_MIN_GRID_POINTS = 16
+
+
+def _mag_terms(x, y, z, xp, yp, zp, grav=False):
+    """
+    Calculates the geometric terms of the exact 3D magnetic effect of vertical
+    prisms for all combinations of prisms and calculation points in one
+    vectorized pass. The formulas and the treatment of edge and interior
+    points are the same as in Prism.mag_prism, only the loops over points and
+    prism corners are replaced by numpy broadcasting and the arctan additions
+    of utils.tandet by direct sums of arctangents.
+
+    Points may be given at several heights for the same horizontal positions
+    (e.g. gradiometer data). Terms depending only on horizontal distances
+    are then calculated once and used for all heights.
+
+    Optionally, the gravity effect of the prisms is calculated in the same
+    pass. Corner distances and the logarithms of the gravity formula are the
+    same as those of the magnetic terms and are calculated only once. The
+    vertical distances follow the magnetic convention (zp positive upward),
+    i.e. the gravity effect is the one of _grav_terms at height -zp.
+
+    The magnetic effect of a prism with magnetization components tx, ty, tz
+    (see utils.magnetization_components) is then:
+        dex = tx*t1 + ty*g2 + tz*g1
+        dey = tx*g2 + ty*t2 + tz*g3
+        dez = tx*g1 + ty*g3 + tz*t3
+
+    Parameters
+    ----------
+    x, y, z : numpy float arrays of shape [n_prisms, 2] (or [2] for one prism)
+        Coordinates of prism faces (W/E, S/N, top/bottom, z positive down)
+    xp, yp : numpy 1D float arrays [n_points]
+        Horizontal coordinates of calculation points
+    zp : numpy float array [n_points] or [n_heights, n_points]
+        Heights of calculation points (positive upward)
+    grav : bool, optional; default: False
+        If True, the gravity effect for unit density is returned as seventh
+        term
+
+    Returns
+    -------
+    g1, g2, g3, t1, t2, t3 : numpy 2D float arrays
+        [n_prisms, n_heights*n_points]
+        Geometric terms, points of the first height first. Points where
+        Prism.mag_prism returns zero effect (zero prism thickness, point on
+        a prism corner or edge) contain zero.
+    g : numpy 2D float array [n_prisms, n_heights*n_points]
+        Only if grav is True: gravity effect of the prisms for a density of
+        1 kg/m3, not yet multiplied by the gravity constant.
+
+    """
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 2)
+    y = np.asarray(y, dtype=np.float64).reshape(-1, 2)
+    z = np.asarray(z, dtype=np.float64).reshape(-1, 2)
+    xp = np.atleast_1d(np.asarray(xp, dtype=np.float64))
+    yp = np.atleast_1d(np.asarray(yp, dtype=np.float64))
+    zp = np.asarray(zp, dtype=np.float64).reshape(-1, len(xp))
+# a and b are the horizontal distances between prism edges and calculation
+# points, arrays have shape [n_prisms, 2, n_points]
+    a = y[:, :, None] - yp[None, None, :]
+    a[abs(a) < 1.e-10] = 0.
+    b = x[:, :, None] - xp[None, None, :]
+    b[abs(b) < 1.e-10] = 0.
+    isa = np.sign(a)
+    isb = np.sign(b)
+    ija = isa.mean(axis=1)[:, None, None, None, :]
+    ijb = isb.mean(axis=1)[:, None, None, None, :]
+# Corner arrays have shape [n_prisms, 2 (h), 2 (a), 2 (b), n_points]
+    ai = a[:, None, :, None, :]
+    bj = b[:, None, None, :, :]
+    isai = isa[:, None, :, None, :]
+    isbj = isb[:, None, None, :, :]
+# Terms depending only on horizontal distances
+    ab2 = ai**2+bj**2
+    edge_h = (isbj == 0) | (isai != 0) | (ijb < 1)
+    e_b_h = edge_h & (isbj == 0)
+    e_a_h = edge_h & (isbj != 0) & (isai == 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_a = -np.log(abs(ai))
+        log_b = -np.log(abs(bj))
+        use_t = (ai*bj != 0.)
+        b_a = np.where(use_t, bj/ai, 0.)
+        a_b = np.where(use_t, ai/bj, 0.)
+    terms = []
+    for zh in zp:
+# Vertical distances are sorted such that h[:, 0] <= h[:, 1]. If the body is
+# located above the calculation point, sgh = -1, if its thickness is zero,
+# sgh = 0 and the effect vanishes
+        ht = abs(z[:, 0, None]+zh[None, :])
+        hb = abs(z[:, 1, None]+zh[None, :])
+        sgh = np.sign(hb-ht)
+        h = np.stack((np.minimum(ht, hb), np.maximum(ht, hb)), axis=1)
+        h0 = h[:, 0, :]
+        h0[h0 < 1.e-10] = 0.
+        hk = h[:, :, None, None, :]
+        rr = ab2+hk**2
+        zero = (rr <= 1.e-8).any(axis=(1, 2, 3)) | (sgh == 0.)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = np.sqrt(rr)
+            log1 = np.log(bj+r)
+            log3 = np.log(ai+r)
+            hr = hk/r
+            ft1 = b_a*hr
+            ft2 = a_b*hr
+            lg1 = log1
+            lg3 = log3
+#  Needed for interior/edge points and for negative values of ai/bj that lead
+#  to an undefined log (log of zero or negative value). Only points located
+#  at the depth of a prism face may be concerned
+            h_zero = hk <= 1.e-8
+            if h_zero.any():
+                edge = h_zero & edge_h
+                e_b = h_zero & e_b_h
+                e_a = h_zero & e_a_h
+                lg3 = np.where(e_b & (ija < 0), log_a, log3)
+                lg1 = np.where(e_a & (ijb < 0), log_b, log1)
+                zero |= (e_b & (ija == 0)).any(axis=(1, 2, 3))
+                zero |= (e_a & (ijb == 0)).any(axis=(1, 2, 3))
+                ft1 = np.where(edge, 0., ft1)
+                ft2 = np.where(edge, 0., ft2)
+# Negative arctan and reciprocal log terms for corners with negative sign
+            g1 = (_CORNER_SIGN*lg1).sum(axis=(1, 2, 3))
+            g2 = (_CORNER_SIGN*np.log(hk+r)).sum(axis=(1, 2, 3))
+            g3 = (_CORNER_SIGN*lg3).sum(axis=(1, 2, 3))
+            t1 = -(_CORNER_SIGN*np.arctan(ft1)).sum(axis=(1, 2, 3))
+            t2 = -(_CORNER_SIGN*np.arctan(ft2)).sum(axis=(1, 2, 3))
+            if grav:
+# Signed vertical distances in the order of h. If the order of the faces is
+#    inverted, the signs of the corner terms are inverted as well
+                zs = z[:, :, None] + zh[None, None, :]
+                flip = (hb < ht)[:, None, :]
+                zk = np.where(flip, zs[:, ::-1, :], zs)
+                zk[abs(zk) < 1.e-5] = 1.e-5
+# Factors depending on one coordinate only are applied after summing over
+#    the other corner indices. Products 0*log(0) appear for points on the
+#    prolongation of an edge, their limit is zero
+                lx = np.nan_to_num(b*(_CORNER_SIGN*log3).sum(axis=(1, 2)),
+                                   nan=0.)
+                ly = np.nan_to_num(a*(_CORNER_SIGN*log1).sum(axis=(1, 3)),
+                                   nan=0.)
+                lz = zk*(_CORNER_SIGN*np.arctan(
+                    (ai+bj+r)/zk[:, :, None, None, :])).sum(axis=(2, 3))
+                g = -(lx+ly+2.*lz).sum(axis=1)\
+                    * np.where(flip[:, 0, :], -1., 1.)
+                g[np.isclose(z[:, 0], z[:, 1]), :] = 0.
+        t3 = -(t1+t2)
+        terms_h = []
+        for t in (g1, g2, g3, t1, t2, t3):
+            terms_h.append(np.where(zero, 0., t*sgh))
+        if grav:
+            terms_h.append(g)
+        terms.append(terms_h)
+    if len(terms) == 1:
+        return tuple(terms[0])
+    return tuple(np.concatenate(t, axis=1) for t in zip(*terms))
+
+
+def _grav_terms(x, y, z, xp, yp, zp):
+    """
+    Calculates the exact 3D gravity effect of vertical prisms with unit
+    density for all combinations of prisms and calculation points in one
+    vectorized pass. The formula and the treatment of points located on the
+    prolongation of prism edges are the same as in Prism.grav_prism.
+    As in _mag_terms, points may be given at several heights for the same
+    horizontal positions.
+
+    Parameters
+    ----------
+    x, y, z : numpy float arrays of shape [n_prisms, 2] (or [2] for one prism)
+        Coordinates of prism faces (W/E, S/N, top/bottom, z positive down)
+    xp, yp : numpy 1D float arrays [n_points]
+        Horizontal coordinates of calculation points
+    zp : numpy float array [n_points] or [n_heights, n_points]
+        Z coordinates of calculation points
+
+    Returns
+    -------
+    g : numpy 2D float array [n_prisms, n_heights*n_points]
+        Gravity effect of the prisms for a density of 1 kg/m3, not yet
+        multiplied by the gravity constant, points of the first height first.
+
+    """
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 2)
+    y = np.asarray(y, dtype=np.float64).reshape(-1, 2)
+    z = np.asarray(z, dtype=np.float64).reshape(-1, 2)
+    xp = np.atleast_1d(np.asarray(xp, dtype=np.float64))
+    yp = np.atleast_1d(np.asarray(yp, dtype=np.float64))
+    zp = np.asarray(zp, dtype=np.float64).reshape(-1, len(xp))
+    xr = x[:, :, None] - xp[None, None, :]
+    yr = y[:, :, None] - yp[None, None, :]
+    xr[abs(xr) < 1.e-5] = 1.e-5
+    yr[abs(yr) < 1.e-5] = 1.e-5
+# Corner arrays have shape [n_prisms, 2 (z), 2 (y), 2 (x), n_points]
+# In Prism.grav_prism, the corner with the smaller coordinates has sign +1
+    yj = yr[:, None, :, None, :]
+    xi = xr[:, None, None, :, :]
+    xy2 = xi**2+yj**2
+    s = -_CORNER_SIGN
+    g = []
+    for zh in zp:
+        zr = z[:, :, None] - zh[None, None, :]
+        zr[abs(zr) < 1.e-5] = 1.e-5
+        zk = zr[:, :, None, None, :]
+        r = np.sqrt(xy2+zk**2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lx = np.where(np.isclose(-yj, r), 0., xi*np.log(yj+r))
+            ly = np.where(np.isclose(-xi, r), 0., yj*np.log(xi+r))
+            g.append((s*(lx+ly+2.*zk*np.arctan((xi+yj+r)/zk))).sum(
+                axis=(1, 2, 3)))
+    g = np.concatenate(g, axis=1)
+    g[np.isclose(z[:, 0], z[:, 1]), :] = 0.
+    return g
+
+
+def _mag_deriv_block(x, y, z, xp, yp, zp, earth):
+    """
+    Calculates the total field anomalies of a block of prisms having unit
+    magnetization in X, Y and Z direction at a block of points.
+    Derivatives with respect to susceptibility or to remanence of any
+    direction are linear combinations of these three responses.
+
+    Parameters
+    ----------
+    x, y, z : numpy 2D float arrays [n_prisms, 2]
+        Coordinates of prism faces
+    xp, yp : numpy 1D float arrays [n_points]
+        Horizontal coordinates of calculation points
+    zp : numpy float array [n_points] or [n_heights, n_points]
+        Heights of calculation points
+    earth : object of class Earth_mag
+
+    Returns
+    -------
+    der : numpy 3D float array [3, n_prisms, n_heights*n_points]
+        Total field anomalies for unit magnetization in X, Y and Z
+
+    """
+    g1, g2, g3, t1, t2, t3 = _mag_terms(x, y, z, xp, yp, zp)
+    der = np.zeros((3,) + g1.shape)
+    _, der[0] = utils.compon(t1, g2, g1, earth)
+    _, der[1] = utils.compon(g2, t2, g3, earth)
+    _, der[2] = utils.compon(g1, g3, t3, earth)
+    return der
+
+
+def _grav_deriv_block(x, y, z, xp, yp, zp, G):
+    """
+    Calculates the gravity derivatives of a block of prisms with respect to
+    density at a block of points.
+
+    Parameters
+    ----------
+    x, y, z : numpy 2D float arrays [n_prisms, 2]
+        Coordinates of prism faces
+    xp, yp : numpy 1D float arrays [n_points]
+        Horizontal coordinates of calculation points
+    zp : numpy float array [n_points] or [n_heights, n_points]
+        Z coordinates of calculation points
+    G : float
+        Gravity constant (in units giving mGal)
+
+    Returns
+    -------
+    der : numpy 3D float array [1, n_prisms, n_heights*n_points]
+        Derivatives of the gravity anomaly
+
+    """
+    return (_grav_terms(x, y, z, xp, yp, zp)*G)[None, :, :]
+
+
+def _mag_far(center, moment, xp, yp, zp):
+    """
+    Magnetic effect of a point dipole located at the center of a cluster of
+    prisms (far-field approximation of _mag_terms, same conventions).
+
+    Parameters
+    ----------
+    center : numpy 1D float array [3]
+        Coordinates of the dipole (z positive downward)
+    moment : numpy 1D float array [3]
+        Sum over the prisms of volume times magnetization components
+        (tx, ty, tz)
+    xp, yp, zp : numpy 1D float arrays [n_points]
+        Coordinates of calculation points
+
+    Returns
+    -------
+    dex, dey, dez : numpy 1D float arrays [n_points]
+        Field components (see Prism.mag_prism)
+
+    """
+    rx = center[0] - xp
+    ry = center[1] - yp
+    rz = center[2] + zp
+    r2 = rx*rx + ry*ry + rz*rz
+    r5 = r2*r2*np.sqrt(r2)
+# Second derivatives of 1/r, ordered like the terms of _mag_terms
+    t1 = (3.*ry*ry - r2)/r5
+    t2 = (3.*rx*rx - r2)/r5
+    t3 = (3.*rz*rz - r2)/r5
+    g1 = 3.*ry*rz/r5
+    g2 = 3.*rx*ry/r5
+    g3 = 3.*rx*rz/r5
+    mx, my, mz = moment
+    return mx*t1 + my*g2 + mz*g1, mx*g2 + my*t2 + mz*g3,\
+        mx*g1 + my*g3 + mz*t3
+
+
+def _grav_far(center, mass, xp, yp, zp):
+    """
+    Gravity effect of a point mass located at the center of a cluster of
+    prisms (far-field approximation of _grav_terms, same conventions).
+
+    Parameters
+    ----------
+    center : numpy 1D float array [3]
+        Coordinates of the point mass (z positive downward)
+    mass : float
+        Sum over the prisms of volume times density
+    xp, yp, zp : numpy 1D float arrays [n_points]
+        Coordinates of calculation points
+
+    Returns
+    -------
+    numpy 1D float array [n_points]
+        Gravity effect without gravity constant
+
+    """
+    rx = center[0] - xp
+    ry = center[1] - yp
+    rz = center[2] - zp
+    r2 = rx*rx + ry*ry + rz*rz
+    return mass*rz/(r2*np.sqrt(r2))
+
+
+# Calculation points and shared output array of a worker process, set once
+# per process by _init_worker
+_worker = {}
+
+
+def _init_worker(xp, yp, zp, shm_name, shape):
+    """
+    Initialize a worker process of Prism_calc.direct_deriv. The calculation
+    points (horizontal positions xp, yp and heights zp [n_heights, n_points],
+    see Prism_calc.height_sets) are sent only once per process instead of
+    once per block.
+    """
+    _worker["points"] = (xp, yp, zp)
+    _worker["shm_name"] = shm_name
+    _worker["shape"] = shape
+
+
+def _deriv_worker(task):
+    """
+    Calculate one block of derivatives in a worker process and write it
+    directly into the shared memory output array.
+
+    Parameters
+    ----------
+    task : tuple (ip, jp, func, args)
+        ip, jp: slices of prisms and horizontal point positions of the block
+        func: _mag_deriv_block or _grav_deriv_block
+        args: arguments of func following the point coordinates
+
+    Returns
+    -------
+    ip, jp : slices of the calculated block
+
+    """
+    ip, jp, func, args = task
+    xp, yp, zp = _worker["points"]
+    der = func(args[0], args[1], args[2], xp[jp], yp[jp], zp[:, jp],
+               *args[3:])
+    shm = shared_memory.SharedMemory(name=_worker["shm_name"])
+    shape = _worker["shape"]
+    out = np.ndarray(shape, dtype=np.float64, buffer=shm.buf).reshape(
+        shape[0], shape[1], len(zp), -1)
+    out[:, ip, :, jp] = der.reshape(shape[0], -1, len(zp), jp.stop-jp.start)
+    del out
+    shm.close()
+    return ip, jp
+
+
+def _shared_zeros(shape, blocks, shared=True):
+    """
+    Create an array of zeros. If shared is True, the array is located at the
+    start of a new block of shared memory, so that worker processes of
+    Prism_calc.direct_deriv can write into it directly.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the array
+    blocks : list
+        The new shared memory block is appended to this list (see
+        _free_shared)
+    shared : bool, optional; default: True
+        If False, a normal numpy array is created
+
+    Returns
+    -------
+    out : numpy float array
+    shm : SharedMemory object or None if shared is False
+
+    """
+    if not shared:
+        return np.zeros(shape), None
+    shm = shared_memory.SharedMemory(
+        create=True, size=max(int(np.prod(shape))*8, 8))
+    blocks.append(shm)
+    out = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    out[...] = 0.
+    return out, shm
+
+
+def _free_shared(blocks):
+    """
+    Release the shared memory blocks of list blocks (see _shared_zeros) and
+    empty the list.
+    """
+    while blocks:
+        shm = blocks.pop()
+        shm.unlink()
+# If an array still uses the block, it is unmapped when the array is deleted
+        try:
+            shm.close()
+        except BufferError:
+            pass
 
 
 class Prism(Earth):
@@ -89,7 +615,11 @@ class Prism(Earth):
 
     - __init__
     - mag_prism (calculates magnetic effect at one point)
+    - mag_prism_batch (calculates magnetic effect at all points)
     - grav_prism (calculates gravity effect at one point)
+    - grav_prism_batch (calculates gravity effect at all points)
+    - mag_grav_prism_batch (calculates magnetic and gravity effects at all
+      points in one pass)
     - change_props (modifies one or several properties)
     - change_coor (modifies one or several prism coordinates)
 
@@ -281,6 +811,31 @@ class Prism(Earth):
         dez = (self.tx*g1+self.ty*g3+self.tz*t3)*sgh
         return dex, dey, dez
 
+    def mag_prism_batch(self, xp, yp, zp):
+        """
+        Calculates the exact 3D magnetic effect of the prism at all
+        measurement points in one vectorized pass. Results are the same as
+        those of calling mag_prism for every point.
+        Needs susceptibilities in cgs system (SI/4pi))
+
+        Parameters
+        ----------
+        xp, yp, zp : 1D Numpy float arrays
+            Coordinates of all calculation points
+
+        Returns
+        -------
+        delx, dely, delz : 1D numpy float arrays
+            N-S, E-W and Z component of the effect of the body at all points
+
+        """
+        g1, g2, g3, t1, t2, t3 = _mag_terms(self.x, self.y, self.z, xp, yp,
+                                            zp)
+        dex = self.tx*t1[0]+self.ty*g2[0]+self.tz*g1[0]
+        dey = self.tx*g2[0]+self.ty*t2[0]+self.tz*g3[0]
+        dez = self.tx*g1[0]+self.ty*g3[0]+self.tz*t3[0]
+        return dex, dey, dez
+
     def grav_prism(self, xp, yp, zp):
         """
         Calculates the exact 3D gravity effect of a vertical rectangular prism.
@@ -337,6 +892,54 @@ class Prism(Earth):
                    2.*z*(np.arctan(atan_z)+sum_pi))
         return g*self.rho*self.G
 
+    def grav_prism_batch(self, xp, yp, zp):
+        """
+        Calculates the exact 3D gravity effect of a vertical rectangular prism
+        at all measurement points in one vectorized pass. Results are the same
+        as those of calling grav_prism for every point.
+
+        Parameters
+        ----------
+        xp, yp, zp : 1D Numpy float arrays
+            Coordinates of all calculation points
+
+        Returns
+        -------
+        g : 1D numpy float array
+            Gravity effect of the body at all points
+
+        """
+        return _grav_terms(self.x, self.y, self.z, xp, yp, zp)[0]\
+            * self.rho*self.G
+
+    def mag_grav_prism_batch(self, xp, yp, zp):
+        """
+        Calculates the magnetic and the gravity effect of the prism at all
+        measurement points in one vectorized pass. Corner distances and
+        logarithms are shared by both effects (see _mag_terms).
+        Heights follow the convention of mag_prism (zp positive upward), i.e.
+        the gravity effect is the one of grav_prism_batch(xp, yp, -zp).
+
+        Parameters
+        ----------
+        xp, yp, zp : 1D Numpy float arrays
+            Coordinates of all calculation points
+
+        Returns
+        -------
+        delx, dely, delz : 1D numpy float arrays
+            N-S, E-W and Z component of the magnetic effect of the body
+        g : 1D numpy float array
+            Gravity effect of the body
+
+        """
+        g1, g2, g3, t1, t2, t3, g = _mag_terms(self.x, self.y, self.z, xp,
+                                               yp, zp, grav=True)
+        dex = self.tx*t1[0]+self.ty*g2[0]+self.tz*g1[0]
+        dey = self.tx*g2[0]+self.ty*t2[0]+self.tz*g3[0]
+        dez = self.tx*g1[0]+self.ty*g3[0]+self.tz*t3[0]
+        return dex, dey, dez, g[0]*self.rho*self.G
+
     def change_props(self, sus=None, rem=None, inc=None, dec=None, dens=None):
         """
         Change properties of a prism for each entry that is not None
@@ -411,236 +1014,1856 @@ class Prism(Earth):
             self.z[1] = zmax
 
 
-class Prism_calc(Prism, Earth):
+class FrechetStore():
     """
+    Growable storage of the Frechet matrix.
+
+    Columns are kept in a Fortran ordered buffer having spare capacity, so
+    that the matrix seen by the inversion is a view of the first n_cols
+    columns. Every column is identified by a label (e.g. ("sus", key)).
+    When the model changes (e.g. prisms are split), columns of remaining
+    labels are moved in place to their new positions, columns of removed
+    labels are overwritten and only columns of new labels have to be filled.
+    The buffer may be a disk-backed numpy memmap (out-of-core storage) and
+    may be single precision. New columns may be written directly into the
+    buffer, blocks of columns at a time.
+
     Contains the following methods:
 
     - __init__
-    - add_prism: adds an entrance of class Prism to a dictionary
-    - remove_prism: removes an entrance of classe Prism from dictionary
-    - mag_forward: Solves magnetic forward problem for all prisms at all points
-    - mag_deriv: Calculates derivatives of magnetic effect with respect to
-      magnetic properties (susceptibility and/or remanence)
-    - grav_forward: Solves gravity forward problem for all prisms at all points
-    - grav_deriv: Calculates derivatives of magnetic effect with respect to
-      density
-    - create_Frechet: Assembles the derivative vectors of each prism into a
-      Frechet matrix
-    - get_max_prisms: Find all prisms located below the strongest absolute
-      maximum of magnetic and gravity fields. Usually used during inversion
-      procedure where the data correspond to actual misfit.
-    - split: split a prism into up to 8 prisms having half size in all
-      directions as long as prisms stay larger than a given minimum size.
-
+    - matrix: view of the actual Frechet matrix
+    - update: rearranges the columns according to a new list of labels
     """
 
-    def __init__(self, e, min_size_x=0., min_size_y=0., min_size_z=0.):
+    def __init__(self, n_rows, capacity=0, dtype=np.float64, filename=None):
         """
-        Initialize dictionary of prisms used for magnetic and gravity
-        calculation
-
         Parameters
         ----------
-        e: Obejct of class Earth_mag (found in file mag_grav_utilities.py)
-        min_size_x : float
-            Minimum allowed size of prisms in X direction (E-W).
-        min_size_y : float
-            Minimum allowed size of prisms in Y direction (N-S).
-        min_size_z : float
-            Minimum allowed size of prisms in Z direction.
+        n_rows : int
+            Number of rows (data) of the matrix
+        capacity : int, optional; default: 0
+            Initial number of columns that may be stored without reallocation
+        dtype : numpy float type, optional; default: np.float64
+            Type of the stored values (np.float32 halves memory or disk use)
+        filename : str, optional; default: None
+            If given, the buffer is a numpy memmap stored in this file.
+            Since the buffer is Fortran ordered, columns are contiguous on
+            disk and increasing the capacity only extends the file.
+        """
+        self.n_rows = n_rows
+        self.dtype = np.dtype(dtype)
+        self.filename = filename
+        if filename is None:
+            self.buffer = np.zeros((n_rows, capacity), dtype=self.dtype,
+                                   order="F")
+        else:
+            self.buffer = np.memmap(filename, dtype=self.dtype, mode="w+",
+                                    shape=(n_rows, max(capacity, 1)),
+                                    order="F")
+        self.labels = []
+        self.position = {}
 
+    def matrix(self):
+        """
         Returns
         -------
-        None.
-
+        numpy 2D float array [n_rows, n_cols]
+            View of the actual matrix. It is only valid until the next call
+            to update.
         """
-# self.G is the universal gravity constant multiplied by 10**5 so that results
-#       are in mGal
-        self.G = 6.67e-6
-# Define dictionaray that will contain all model prisms
-        self.prisms = {}
-# self.n_prisms is the number of defined prisms
-        self.n_prisms = 0
-# self.n_max is the key of the last defined prism. Initially, n_max = n_prism.
-#       However, if a prism other than the last defined one is removed from the
-#       dictionary, it's key is erased, n_prism is reduced by one, but the
-#       next prism that will be added to the dictionary will have key n_max+1.
-#       In this case, n_prisms and n_max will be different
-        self.n_max = -1
-        self.min_size_x = min_size_x
-        self.min_size_y = min_size_y
-        self.min_size_z = min_size_z
-        self.earth = e
+        return self.buffer[:, :len(self.labels)]
 
-    def add_prism(self, xpr, ypr, zpr, sus, rem, rinc, rdec, rho):
+    def update(self, labels, fill=None):
         """
-        Add a prism with its properties to the dictionary.
-        The key of this new prism will be self.n_max+1
+        Rearrange columns according to a new list of labels.
+        Labels must keep the relative order they had in the previous call
+        (this is the case for the column order of Prism_calc.create_Frechet,
+        since keys of new prisms are always added at the end of the
+        dictionary).
 
-        For the explanation of input parameters see Prism.__init__
-        """
-        self.n_max += 1
-        self.prisms[self.n_max] = Prism(xpr, ypr, zpr, sus, rem, rinc, rdec,
-                                        rho, self.earth)
-        self.n_prisms += 1
-        if self.n_prisms == 1:
-            return
-        x1 = xpr.min()
-        x2 = xpr.max()
-        y1 = ypr.min()
-        y2 = ypr.max()
-        z1 = zpr.min()
-        z2 = zpr.max()
-        keys = list(self.prisms.keys())
-        for key in keys[:-1]:
-            x3 = self.prisms[key].x.min()
-            x4 = self.prisms[key].x.max()
-            y3 = self.prisms[key].y.min()
-            y4 = self.prisms[key].y.max()
-            z3 = self.prisms[key].z.min()
-            z4 = self.prisms[key].z.max()
-            if (x3 == x2 or x4 == x1) and y2 > y3 and y1 < y4 and z2 > z3 and\
-                    z1 < z4:
-                self.prisms[self.n_max].x_neigh.append(key)
-            if (y3 == y2 or y4 == y1) and x2 > x3 and x1 < x4 and z2 > z3 and\
-                    z1 < z4:
-                self.prisms[self.n_max].y_neigh.append(key)
-            if (z3 == z2 or z4 == z1) and x2 > x3 and x1 < x4 and y2 > y3 and\
-                    y1 < y4:
-                self.prisms[self.n_max].z_neigh.append(key)
+        Parameters
+        ----------
+        labels : list of hashable objects
+            Labels of the columns in their new order
+        fill : function fill(label, column), optional; default: None
+            Called for every new label; must write the column values into the
+            numpy 1D float array column [n_rows]. If None, new columns are
+            set to zero and have to be written by the caller into
+            self.buffer.
+
+        Returns
+        -------
+        new : numpy 1D int array
+            Positions of the new columns
 
-    def remove_prism(self, key):
-        """
-        Remove a prism for the dictionary
-        n_prisms will be reduced by one, but not n_max.
         """
-        try:
-            del self.prisms[key]
-            self.n_prisms -= 1
-            for k in self.prisms.keys():
-                if key in self.prisms[k].x_neigh:
-                    del self.prisms[k].x_neigh[np.where(
-                        np.array(self.prisms[k].x_neigh) == key)[0][0]]
-                if key in self.prisms[k].y_neigh:
-                    del self.prisms[k].y_neigh[np.where(
-                        np.array(self.prisms[k].y_neigh) == key)[0][0]]
-                if key in self.prisms[k].z_neigh:
-                    del self.prisms[k].z_neigh[np.where(
-                        np.array(self.prisms[k].z_neigh) == key)[0][0]]
-            return True
-        except KeyError:
-            print(f"\nWarning in 'remove_prism': Prism {key} does not exist "
-                  + "in dictionary.")
-            return False
+        n_cols = len(labels)
+        src = np.array([self.position.get(lab, -1) for lab in labels],
+                       dtype=int)
+        dst = np.arange(n_cols)
+        if n_cols > self.buffer.shape[1] and self.filename is not None:
+# Memmapped buffer: the file is extended, existing columns keep their place
+            self.buffer.flush()
+            self.buffer = np.memmap(
+                self.filename, dtype=self.dtype, mode="r+",
+                shape=(self.n_rows, max(n_cols, self.buffer.shape[1]*3//2)),
+                order="F")
+        if n_cols > self.buffer.shape[1]:
+# Increase capacity by at least 50% to have amortized linear cost of
+#    reallocation. Kept columns are directly copied to their new positions.
+            buffer = np.zeros((self.n_rows, max(n_cols, self.buffer.shape[1]
+                                                * 3//2)), dtype=self.dtype,
+                              order="F")
+            kept = src >= 0
+            buffer[:, dst[kept]] = self.buffer[:, src[kept]]
+            self.buffer = buffer
+        else:
+# Moves in place: columns moving to the left are treated in ascending order,
+#    columns moving to the right in descending order, so that no column is
+#    overwritten before being moved
+            for i in np.where((src >= 0) & (src > dst))[0]:
+                self.buffer[:, i] = self.buffer[:, src[i]]
+            for i in np.where((src >= 0) & (src < dst))[0][::-1]:
+                self.buffer[:, i] = self.buffer[:, src[i]]
+        new = np.where(src < 0)[0]
+        for i in new:
+            if fill is None:
+                self.buffer[:, i] = 0.
+            else:
+                fill(labels[i], self.buffer[:, i])
+        if self.filename is not None:
+            self.buffer.flush()
+        self.labels = list(labels)
+        self.position = {lab: i for i, lab in enumerate(self.labels)}
+        return new
+
+
+class PrismSet():
+    """
+    Columnar (structure of arrays) storage of a set of prisms.
+
+    Bounds and properties of all prisms are kept in contiguous numpy arrays,
+    in the same units as the attributes of class Prism (susceptibility in
+    cgs units, inclination and declination of remanence in radians).
+    Neighbour links are stored as arrays of pairs of keys. Like the lists
+    x_neigh, y_neigh and z_neigh of Prism_calc, every pair is stored once,
+    the first key being the one of the prism added later.
+
+    Contains the following methods:
+
+    - __init__
+    - from_prisms: builds a PrismSet from a dictionary of Prism objects
+    - positions: positions of prisms in the arrays from their keys
+    - centers: coordinates of prism centers
+    - add: adds prisms and their neighbour links
+    - remove: removes prisms and their neighbour links
+    - split: replaces prisms by up to 8 prisms of half size
+    """
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=int)
+        self.x = np.zeros((0, 2))
+        self.y = np.zeros((0, 2))
+        self.z = np.zeros((0, 2))
+        self.sus = np.zeros(0)
+        self.rem = np.zeros(0)
+        self.inc = np.zeros(0)
+        self.dec = np.zeros(0)
+        self.rho = np.zeros(0)
+        self.x_links = np.zeros((0, 2), dtype=int)
+        self.y_links = np.zeros((0, 2), dtype=int)
+        self.z_links = np.zeros((0, 2), dtype=int)
+        self.n_max = -1
 
-    def mag_forward(self, xp, yp, zp):
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_prisms(cls, prisms):
         """
-        Calculate summed effect of all prisms on all field points
+        Build a PrismSet from a dictionary of Prism objects (e.g.
+        Prism_calc.prisms). Order of prisms is the one of the dictionary.
 
         Parameters
         ----------
-        prisms : dictionary with Prism class objects
-            Positions and properties of all prisms
-        xp : numpy 1D float array [n_points]
-            X-coordiante of field points
-            [nr: number of rows in NS direction, nc: number columns in EW
-            direction]
-        yp : numpy 1D float array [n_points]
-            Y-coordiante of field points
-        zp : numpy 1D float array [n_points]
-            Z-coordiante of field points
+        prisms : dictionary
+            Keys: int, values: objects of class Prism
 
         Returns
         -------
-        v : numpy 2D float array [n_points,5]
-            Calculated anomalies.
-            v[:,0] : X-component (N-S)
-            v[:,1] : Y-component (E-W)
-            v[:,2] : Z-component
-            v[:,3] : horizontal component
-            v[:,4] : total field component
+        pset : object of class PrismSet
+
         """
-        n_points = len(xp)
-        self.v = np.zeros((n_points, 5))
-        for i in range(n_points):
-            delx = 0.
-            dely = 0.
-            delz = 0.
-            for key, val in self.prisms.items():
-                dex, dey, dez = val.mag_prism(xp[i], yp[i], zp[i])
-                delx += dex
-                dely += dey
-                delz += dez
-            delh, delt = utils.compon(delx, dely, delz, self.earth)
-            self.v[i, 0] += delx
-            self.v[i, 1] += dely
-            self.v[i, 2] += delz
-            self.v[i, 3] += delh
-            self.v[i, 4] += delt
-            if np.mod(i+1, 100) == 0:
-                print(f"Point {i+1}: Magnetic field calculated")
-        return np.copy(self.v)
-
-    def mag_deriv(self, xp, yp, zp, sus_inv=True, rem_inv=False):
-        """
-        Calculate summed effect of all prisms on all field points
+        pset = cls()
+        n = len(prisms)
+        pset.keys = np.fromiter(prisms.keys(), dtype=int, count=n)
+        vals = list(prisms.values())
+        pset.x = np.array([val.x for val in vals], dtype=float).reshape(n, 2)
+        pset.y = np.array([val.y for val in vals], dtype=float).reshape(n, 2)
+        pset.z = np.array([val.z for val in vals], dtype=float).reshape(n, 2)
+        pset.sus = np.array([val.sus for val in vals], dtype=float)
+        pset.rem = np.array([val.rem for val in vals], dtype=float)
+        pset.inc = np.array([val.inc for val in vals], dtype=float)
+        pset.dec = np.array([val.dec for val in vals], dtype=float)
+        pset.rho = np.array([val.rho for val in vals], dtype=float)
+        for d in ("x", "y", "z"):
+            links = [(key, k) for key, val in prisms.items()
+                     for k in getattr(val, f"{d}_neigh")]
+            setattr(pset, f"{d}_links",
+                    np.array(links, dtype=int).reshape(len(links), 2))
+        if n > 0:
+            pset.n_max = int(pset.keys.max())
+        return pset
+
+    def positions(self, keys):
+        """
+        Positions of prisms in the arrays
 
         Parameters
         ----------
-        prisms : dictionary with Prism class objects
-            Positions and properties of all prisms
-        xp : numpy 1D float array [n_points]
-            X-coordiante of field points
-            [nr: number of rows in NS direction, nc: number columns in EW
-            direction]
-        yp : numpy 1D float array [n_points]
-            Y-coordiante of field points
-        zp : numpy 1D float array [n_points]
-            Z-coordiante of field points
-        sus_inv : bool, optional
-            If True susceptibility derivatives are calculated; Default: True
-        rem_inv : bool, optional
-            If True remanence derivatives are calculated; Default: False
+        keys : numpy int array or list of int
+            Keys of the prisms
+
+        Returns
+        -------
+        numpy int array of the same shape as keys
 
         """
-        n_points = len(xp)
-        for key, val in self.prisms.items():
-            if self.prisms[key].der_flag_mag:
-                continue
-            val.sus_der = np.zeros(n_points)
-            val.rem_der = np.zeros(n_points)
-            rem = val.rem
-            sus = val.sus
-            if sus_inv:
-                val.rem = 0.
-                val.sus = 1.
-                val.comps()
-                for i in range(n_points):
-                    dex, dey, dez = val.mag_prism(xp[i], yp[i], zp[i])
-                    deh, det = utils.compon(dex, dey, dez, self.earth)
-                    self.prisms[key].sus_der[i] = det
-                val.rem = rem
-                val.sus = sus
-                self.prisms[key].comps()
-                self.prisms[key].der_flag_mag = True
-            if rem_inv:
-                val.sus = 0.
-                val.rem = 1.
-                val.comps()
-                for i in range(n_points):
-                    dexr, deyr, dezr = val.mag_prism(xp[i], yp[i], zp[i])
-                    deh, det = utils.compon(dex, dey, dez, self.earth)
-                    self.prisms[key].rem_der[i] = det
-                val.sus = sus
-                val.rem = rem
-                self.prisms[key].comps()
-                self.prisms[key].der_flag_mag = True
-            print(f"Prism {key+1}: Magnetic derivative calculated")
-        return True
+        order = np.argsort(self.keys)
+        return order[np.searchsorted(self.keys, keys, sorter=order)]
 
-    def grav_forward(self, xp, yp, zp):
+    def centers(self):
         """
-        Calculate summed gravity effect of all prisms on all field points
+        Returns
+        -------
+        xc, yc, zc : numpy 1D float arrays
+            Coordinates of the centers of all prisms
+        """
+        return self.x.mean(axis=1), self.y.mean(axis=1), self.z.mean(axis=1)
+
+    def add(self, x, y, z, sus, rem, inc, dec, rho):
+        """
+        Add prisms at the end of the set and determine their neighbour links
+        (same criteria as Prism_calc.add_prism).
+
+        Parameters
+        ----------
+        x, y, z : numpy 2D float arrays [n_new, 2]
+            Face coordinates of the new prisms
+        sus, rem, inc, dec, rho : floats or numpy 1D float arrays [n_new]
+            Properties of the new prisms (units as in class Prism)
+
+        Returns
+        -------
+        keys : numpy 1D int array [n_new]
+            Keys of the new prisms
+
+        """
+        x = np.asarray(x, dtype=float).reshape(-1, 2)
+        n_new = len(x)
+        n0 = len(self.keys)
+        keys = np.arange(self.n_max+1, self.n_max+1+n_new)
+        self.n_max += n_new
+        self.keys = np.concatenate((self.keys, keys))
+        self.x = np.concatenate((self.x, x))
+        self.y = np.concatenate((self.y,
+                                 np.asarray(y, dtype=float).reshape(-1, 2)))
+        self.z = np.concatenate((self.z,
+                                 np.asarray(z, dtype=float).reshape(-1, 2)))
+        for name, v in (("sus", sus), ("rem", rem), ("inc", inc),
+                        ("dec", dec), ("rho", rho)):
+            setattr(self, name, np.concatenate(
+                (getattr(self, name), np.broadcast_to(v, (n_new,)))))
+        self.link_new(n0)
+        return keys
+
+    def link_new(self, n0):
+        """
+        Determine neighbour links of prisms at positions n0 and above with
+        all prisms located at smaller positions.
+        """
+        n = len(self.keys)
+        x1 = self.x.min(axis=1)
+        x2 = self.x.max(axis=1)
+        y1 = self.y.min(axis=1)
+        y2 = self.y.max(axis=1)
+        z1 = self.z.min(axis=1)
+        z2 = self.z.max(axis=1)
+        links = {"x": [], "y": [], "z": []}
+# Treat new prisms in chunks to limit the size of the comparison matrices
+        dm = max(4000000//max(n, 1), 1)
+        for i0 in range(n0, n, dm):
+            i = np.arange(i0, min(i0+dm, n))[:, None]
+            older = np.arange(n)[None, :] < i
+            ox = (x1[i] < x2) & (x2[i] > x1)
+            oy = (y1[i] < y2) & (y2[i] > y1)
+            oz = (z1[i] < z2) & (z2[i] > z1)
+            tx = (x1 == x2[i]) | (x2 == x1[i])
+            ty = (y1 == y2[i]) | (y2 == y1[i])
+            tz = (z1 == z2[i]) | (z2 == z1[i])
+            for d, mask in (("x", tx & oy & oz), ("y", ty & ox & oz),
+                            ("z", tz & ox & oy)):
+                ii, kk = np.where(mask & older)
+                links[d].append(np.column_stack((self.keys[i[ii, 0]],
+                                                 self.keys[kk])))
+        for d in ("x", "y", "z"):
+            setattr(self, f"{d}_links", np.concatenate(
+                [getattr(self, f"{d}_links")] + links[d]).astype(int))
+
+    def remove(self, keys):
+        """
+        Remove prisms and all neighbour links pointing to them
+
+        Parameters
+        ----------
+        keys : numpy int array or list of int
+            Keys of the prisms to be removed
+
+        Returns
+        -------
+        None.
+
+        """
+        keep = ~np.isin(self.keys, keys)
+        for name in ("keys", "x", "y", "z", "sus", "rem", "inc", "dec",
+                     "rho"):
+            setattr(self, name, getattr(self, name)[keep])
+        for d in ("x", "y", "z"):
+            links = getattr(self, f"{d}_links")
+            setattr(self, f"{d}_links",
+                    links[~np.isin(links, keys).any(axis=1)])
+
+    def split(self, keys, min_size_x=0., min_size_y=0., min_size_z=0.):
+        """
+        Replace prisms by up to eight prisms, half the size in all directions
+        (same rules as Prism_calc.split). The new prisms are added at the end
+        of the set, having the properties of their parent.
+
+        Parameters
+        ----------
+        keys : numpy int array or list of int
+            Keys of the prisms to be split
+        min_size_x, min_size_y, min_size_z : floats, optional; default: 0
+            Minimum size of prisms in the three directions
+
+        Returns
+        -------
+        new_keys : numpy 1D int array
+            Keys of the new prisms
+
+        """
+        pos = self.positions(np.atleast_1d(keys))
+        parts = []
+        for v, min_size in ((self.x[pos], min_size_x),
+                            (self.y[pos], min_size_y),
+                            (self.z[pos], min_size_z)):
+            v = np.sort(v, axis=1)
+            half = (v[:, 1]-v[:, 0])/2.
+            mid = np.where(half < min_size, v[:, 1], v[:, 0]+half)
+# Lower and upper half (the upper one is empty if no splitting is possible)
+            parts.append((np.column_stack((v[:, 0], mid)),
+                          np.column_stack((mid, v[:, 1])), half >= min_size))
+        props = [getattr(self, name)[pos] for name in
+                 ("sus", "rem", "inc", "dec", "rho")]
+        new = {"x": [], "y": [], "z": [], "p": []}
+# Children are created in the same order as in Prism_calc.split
+        for jx in range(2):
+            for jy in range(2):
+                for jz in range(2):
+                    ok = np.ones(len(pos), dtype=bool)
+                    for j, part in zip((jx, jy, jz), parts):
+                        if j == 1:
+                            ok &= part[2]
+                    for j, d, part in zip((jx, jy, jz), ("x", "y", "z"),
+                                          parts):
+                        new[d].append(part[j][ok])
+                    new["p"].append(np.nonzero(ok)[0])
+        ip = np.concatenate(new["p"])
+        order = np.argsort(ip, kind="stable")
+        xn, yn, zn = [np.concatenate(new[d])[order] for d in ("x", "y", "z")]
+        self.remove(self.keys[pos])
+        return self.add(xn, yn, zn, *[p[ip[order]] for p in props])
+
+
+class PrismIndex():
+    """
+    Spatial index of prisms on a hashed regular grid.
+
+    Space is divided into cells of constant size and every prism is
+    registered in all cells its closed box touches (a dictionary indexed by
+    the integer cell coordinates), so that prisms sharing a face always
+    share at least one cell. Queries only test the prisms registered in the
+    cells of the query box, which for a refined model contains a few prisms
+    independently of the size of the model.
+    Prisms that would cover more than max_cells cells are not registered in
+    the grid but kept in a list of large prisms that is tested by every
+    query. Whenever the number of prisms has doubled, the cell size is
+    adapted to twice the median prism size if it differs by more than a
+    factor of two from it, and the grid is rebuilt.
+
+    Contains the following methods:
+
+    - __init__
+    - cells: grid cells covered by a box
+    - add_to_grid: registers a prism in the grid cells
+    - adapt: adapts the cell size to the typical prism size
+    - insert: adds a prism to the index
+    - remove: removes a prism from the index
+    - query: prisms touching or overlapping a box
+    - neighbours: prisms sharing a face with a box
+    - locate: prisms containing a point
+    """
+
+    def __init__(self, cell=(0., 0., 0.), max_cells=64):
+        """
+        Parameters
+        ----------
+        cell : list or numpy array of 3 floats, optional; default: zeros
+            Initial cell size in X, Y and Z direction. Sizes that are not
+            positive are taken from the first prism inserted.
+        max_cells : int, optional; default: 64
+            Maximum number of cells in which a prism is registered
+        """
+        self.cell = np.array(cell, dtype=float)
+        self.max_cells = max_cells
+        self.grid = {}
+        self.bounds = {}
+        self.large = set()
+# Number of prisms at which the cell size is checked next (see adapt)
+        self.n_adapt = 16
+
+    def cells(self, box):
+        """
+        Grid cells covered by a closed box
+
+        Parameters
+        ----------
+        box : tuple of 6 floats
+            xmin, xmax, ymin, ymax, zmin, zmax
+
+        Returns
+        -------
+        list of tuples of 3 int or None
+            Integer coordinates of the cells. None if the box covers more
+            than self.max_cells cells.
+        """
+        ranges = [range(int(np.floor(box[2*i]/self.cell[i])),
+                        int(np.floor(box[2*i+1]/self.cell[i]))+1)
+                  for i in range(3)]
+        if len(ranges[0])*len(ranges[1])*len(ranges[2]) > self.max_cells:
+            return None
+        return [(i, j, k) for i in ranges[0] for j in ranges[1]
+                for k in ranges[2]]
+
+    def add_to_grid(self, key, box):
+        """
+        Register a prism in the grid cells covered by its box or, if they are
+        too many, in the list of large prisms
+
+        Parameters
+        ----------
+        key : int
+            Key of the prism
+        box : tuple of 6 floats
+            xmin, xmax, ymin, ymax, zmin, zmax
+        """
+        cells = self.cells(box)
+        if cells is None:
+            self.large.add(key)
+            return
+        for c in cells:
+            self.grid.setdefault(c, set()).add(key)
+
+    def adapt(self):
+        """
+        Set the cell size to twice the median size of the prisms if the
+        actual size differs from it by more than a factor of two in any
+        direction, and rebuild the grid. Directions in which prisms have no
+        extension keep their cell size.
+        """
+        boxes = np.array(list(self.bounds.values()))
+        size = 2.*np.median(boxes[:, 1::2]-boxes[:, ::2], axis=0)
+        size = np.where(size > 0., size, self.cell)
+        ratio = size/self.cell
+        if np.all((ratio <= 2.) & (ratio >= 0.5)):
+            return
+        self.cell = size
+        self.grid = {}
+        self.large = set()
+        for key, box in self.bounds.items():
+            self.add_to_grid(key, box)
+
+    def insert(self, key, x, y, z):
+        """
+        Add a prism to the index
+
+        Parameters
+        ----------
+        key : int
+            Key of the prism
+        x, y, z : numpy 1D float arrays [2]
+            Face coordinates of the prism
+        """
+        box = (min(x), max(x), min(y), max(y), min(z), max(z))
+        if np.any(self.cell <= 0.):
+            size = np.array(box[1::2])-np.array(box[::2])
+            size[size <= 0.] = 1.
+            self.cell = np.where(self.cell > 0., self.cell, size)
+        self.bounds[key] = box
+        self.add_to_grid(key, box)
+        if len(self.bounds) >= self.n_adapt:
+            self.n_adapt = 2*len(self.bounds)
+            self.adapt()
+
+    def remove(self, key):
+        """
+        Remove a prism from the index
+
+        Parameters
+        ----------
+        key : int
+            Key of the prism
+        """
+        box = self.bounds.pop(key)
+        if key in self.large:
+            self.large.discard(key)
+            return
+        for c in self.cells(box):
+            keys = self.grid[c]
+            keys.discard(key)
+            if not keys:
+                del self.grid[c]
+
+    def query(self, box):
+        """
+        Prisms touching or overlapping a closed box
+
+        Parameters
+        ----------
+        box : tuple of 6 floats
+            xmin, xmax, ymin, ymax, zmin, zmax
+
+        Returns
+        -------
+        list of int
+            Sorted keys of the prisms
+        """
+        if not self.bounds:
+            return []
+        cells = self.cells(box)
+        if cells is None:
+            found = self.bounds.keys()
+        else:
+            found = set(self.large)
+            for c in cells:
+                found.update(self.grid.get(c, ()))
+        keys = []
+        for key in found:
+            b = self.bounds[key]
+            if b[0] <= box[1] and b[1] >= box[0] and b[2] <= box[3] and\
+                    b[3] >= box[2] and b[4] <= box[5] and b[5] >= box[4]:
+                keys.append(key)
+        return sorted(keys)
+
+    def neighbours(self, x, y, z):
+        """
+        Prisms sharing a face with a box (same criteria as
+        Prism_calc.add_prism)
+
+        Parameters
+        ----------
+        x, y, z : numpy 1D float arrays [2]
+            Face coordinates of the box
+
+        Returns
+        -------
+        x_neigh, y_neigh, z_neigh : lists of int
+            Sorted keys of the neighbours in X, Y and Z direction
+        """
+        x1, x2, y1, y2, z1, z2 = box = (min(x), max(x), min(y), max(y),
+                                        min(z), max(z))
+        x_neigh = []
+        y_neigh = []
+        z_neigh = []
+        for key in self.query(box):
+            x3, x4, y3, y4, z3, z4 = self.bounds[key]
+            if (x3 == x2 or x4 == x1) and y2 > y3 and y1 < y4 and z2 > z3 and\
+                    z1 < z4:
+                x_neigh.append(key)
+            if (y3 == y2 or y4 == y1) and x2 > x3 and x1 < x4 and z2 > z3 and\
+                    z1 < z4:
+                y_neigh.append(key)
+            if (z3 == z2 or z4 == z1) and x2 > x3 and x1 < x4 and y2 > y3 and\
+                    y1 < y4:
+                z_neigh.append(key)
+        return x_neigh, y_neigh, z_neigh
+
+    def locate(self, xp, yp, zp):
+        """
+        Prisms containing a point (points on faces belong to all prisms
+        sharing the face)
+
+        Parameters
+        ----------
+        xp, yp, zp : floats
+            Coordinates of the point
+
+        Returns
+        -------
+        list of int
+            Sorted keys of the prisms
+        """
+        return self.query((xp, xp, yp, yp, zp, zp))
+
+
+class DiskCache():
+    """
+    Content-addressed storage of calculated arrays (forward responses,
+    derivative columns) in .npy files of a folder.
+
+    Entries are identified by a SHA-1 hash of everything the array depends
+    on (see Prism_calc.cache_key), so that they remain valid across program
+    runs and need no invalidation: a changed prism, Earth field or set of
+    points simply gives another key.
+
+    Contains the following methods:
+
+    - __init__
+    - key: hash of a label and a series of arrays
+    - load: reads an array from the cache
+    - save: writes an array into the cache
+    - clear: deletes all cached arrays
+    """
+
+    def __init__(self, folder):
+        """
+        Parameters
+        ----------
+        folder : str
+            Folder containing the cached arrays. It is created if necessary.
+        """
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, label, *arrays):
+        """
+        Hash of a label and of the values and shapes of a series of arrays
+
+        Parameters
+        ----------
+        label : str
+            Kind of cached data (e.g. "mag" or "grav")
+        arrays : numpy float arrays
+            Data on which the cached array depends
+
+        Returns
+        -------
+        str
+            Hexadecimal SHA-1 digest
+        """
+        h = hashlib.sha1(label.encode())
+        for a in arrays:
+            a = np.ascontiguousarray(a, dtype=np.float64)
+            h.update(str(a.shape).encode())
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    def load(self, key):
+        """
+        Read an array from the cache
+
+        Parameters
+        ----------
+        key : str
+            Key of the array (see key)
+
+        Returns
+        -------
+        numpy array or None if key is not cached
+        """
+        try:
+            val = np.load(os.path.join(self.folder, f"{key}.npy"))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return val
+
+    def save(self, key, val):
+        """
+        Write an array into the cache. The file is written under a temporary
+        name and renamed, so that concurrent runs never read partial files.
+
+        Parameters
+        ----------
+        key : str
+            Key of the array (see key)
+        val : numpy array
+            Array to be stored
+        """
+        tmp = os.path.join(self.folder, f"{key}.{os.getpid()}.tmp.npy")
+        np.save(tmp, val)
+        os.replace(tmp, os.path.join(self.folder, f"{key}.npy"))
+
+    def clear(self):
+        """
+        Delete all cached arrays
+        """
+        for f in os.listdir(self.folder):
+            if f.endswith(".npy"):
+                os.remove(os.path.join(self.folder, f))
+
+
+class Prism_calc(Prism, Earth):
+    """
+    Contains the following methods:
+
+    - __init__
+    - add_prism: adds an entrance of class Prism to a dictionary
+    - add_prisms: adds several prisms at once
+    - get_prism_set: columnar copy (PrismSet) of the dictionary
+    - remove_prism: removes an entrance of classe Prism from dictionary
+    - locate: keys of the prisms containing a point
+    - get_prism_coor: collects prism face coordinates into arrays
+    - get_blocks: splits prism-point combinations into blocks respecting a
+      memory budget
+    - height_sets: arranges points repeated at several heights
+    - combine_unit_deriv: susceptibility and remanence derivatives from unit
+      magnetization responses
+    - deriv_chunks: calculates derivative columns chunk by chunk of prisms
+    - calc_deriv: calculates derivative columns of prisms
+    - cached_deriv: extracts derivative columns at gridded points from
+      translation-invariant reference kernels
+    - kernel_classes: groups prisms with shifted identical kernels
+    - reference_kernel: derivatives of one prism on a regular grid
+    - clear_kernel_cache: empties the cache of reference kernels
+    - cache_key: disk cache key of derivative columns or forward responses
+    - direct_deriv: calculates derivatives block by block, optionally on a
+      pool of processes
+    - build_octree: organizes prisms in an octree
+    - tree_forward: approximate forward calculation using the octree
+    - mag_forward: Solves magnetic forward problem for all prisms at all points
+    - mag_deriv: Calculates derivatives of magnetic effect with respect to
+      magnetic properties (susceptibility and/or remanence)
+    - grav_forward: Solves gravity forward problem for all prisms at all points
+    - grav_deriv: Calculates derivatives of magnetic effect with respect to
+      density
+    - joint_forward: Solves magnetic and gravity forward problems in one pass
+    - create_Frechet: Assembles the derivative vectors of each prism into a
+      Frechet matrix
+    - create_sparse_Frechet: Frechet matrix in sparse CSR format
+    - create_operator: Matrix-free FFT equivalent of the Frechet matrix
+      for regularly gridded data
+    - create_wavelet_Frechet: Frechet matrix compressed in the wavelet domain
+    - get_max_prisms: Find all prisms located below the strongest absolute
+      maximum of magnetic and gravity fields. Usually used during inversion
+      procedure where the data correspond to actual misfit.
+    - split: split a prism into up to 8 prisms having half size in all
+      directions as long as prisms stay larger than a given minimum size.
+
+    """
+
+    def __init__(self, e, min_size_x=0., min_size_y=0., min_size_z=0.,
+                 mem_budget=256.E6, n_jobs=1, kernel_cache=True,
+                 disk_cache=None):
+        """
+        Initialize dictionary of prisms used for magnetic and gravity
+        calculation
+
+        Parameters
+        ----------
+        e: Obejct of class Earth_mag (found in file mag_grav_utilities.py)
+        min_size_x : float
+            Minimum allowed size of prisms in X direction (E-W).
+        min_size_y : float
+            Minimum allowed size of prisms in Y direction (N-S).
+        min_size_z : float
+            Minimum allowed size of prisms in Z direction.
+        mem_budget : float, optional; default: 256.E6
+            Memory [bytes] that may be used by the temporary arrays of the
+            tensor kernels. Blocks of prisms and points are chosen such that
+            this limit is respected (see get_blocks).
+        n_jobs : int, optional; default: 1
+            Number of processes used for the calculation of derivatives. If
+            larger than 1, blocks of prisms are distributed over a process
+            pool writing into a shared memory array (see direct_deriv).
+        kernel_cache : bool, optional; default: True
+            If True, derivatives at regularly gridded points are extracted
+            from cached translation-invariant reference kernels (see
+            cached_deriv).
+        disk_cache : str, optional; default: None
+            If given, folder in which derivative columns and forward
+            responses are stored (see class DiskCache). They are read from
+            there instead of being recalculated when the same prisms, Earth
+            field and points appear again, e.g. in later runs on the same
+            data or after splits recreating earlier prisms.
+
+        Returns
+        -------
+        None.
+
+        """
+# self.G is the universal gravity constant multiplied by 10**5 so that results
+#       are in mGal
+        self.G = 6.67e-6
+# Define dictionaray that will contain all model prisms
+        self.prisms = {}
+# self.n_prisms is the number of defined prisms
+        self.n_prisms = 0
+# self.n_max is the key of the last defined prism. Initially, n_max = n_prism.
+#       However, if a prism other than the last defined one is removed from the
+#       dictionary, it's key is erased, n_prism is reduced by one, but the
+#       next prism that will be added to the dictionary will have key n_max+1.
+#       In this case, n_prisms and n_max will be different
+        self.n_max = -1
+        self.min_size_x = min_size_x
+        self.min_size_y = min_size_y
+        self.min_size_z = min_size_z
+        self.earth = e
+        self.mem_budget = mem_budget
+        self.n_jobs = n_jobs
+# Reference kernels of classes of identical prisms, indexed by prism size,
+#       depth, height of points and position relative to the point grid
+        self.kernel_cache = None
+        if kernel_cache:
+            self.kernel_cache = {}
+        self.kernel_cache_size = 0
+# Spatial index of the prisms. Prisms are at least min_size large after
+#       splitting, cells of twice this size contain only a few of them. The
+#       cell size adapts to the actual prism sizes (see PrismIndex.adapt)
+        self.index = PrismIndex((2.*min_size_x, 2.*min_size_y,
+                                 2.*min_size_z))
+# Content-addressed storage of results on disk
+        self.disk_cache = None
+        if disk_cache:
+            self.disk_cache = DiskCache(disk_cache)
+# Storage of Frechet matrix (see create_Frechet)
+        self.frechet_store = None
+        self.frechet_setup = None
+        self.frechet_points = None
+
+    def add_prism(self, xpr, ypr, zpr, sus, rem, rinc, rdec, rho):
+        """
+        Add a prism with its properties to the dictionary.
+        The key of this new prism will be self.n_max+1
+        Neighbours (prisms sharing a face) are searched in the spatial index
+        (see PrismIndex.neighbours).
+
+        For the explanation of input parameters see Prism.__init__
+        """
+        self.n_max += 1
+        self.prisms[self.n_max] = Prism(xpr, ypr, zpr, sus, rem, rinc, rdec,
+                                        rho, self.earth)
+        self.n_prisms += 1
+        x_neigh, y_neigh, z_neigh = self.index.neighbours(xpr, ypr, zpr)
+        self.prisms[self.n_max].x_neigh += x_neigh
+        self.prisms[self.n_max].y_neigh += y_neigh
+        self.prisms[self.n_max].z_neigh += z_neigh
+        self.index.insert(self.n_max, xpr, ypr, zpr)
+
+    def add_prisms(self, xpr, ypr, zpr, sus, rem, rinc, rdec, rho):
+        """
+        Add several prisms to the dictionary at once. Equivalent to calling
+        add_prism for every prism, but neighbours are searched in vectorized
+        form (see PrismSet.add).
+
+        Parameters
+        ----------
+        xpr, ypr, zpr : numpy 2D float arrays [n_new, 2]
+            Face coordinates of the new prisms
+        sus, rem, rinc, rdec, rho : floats or numpy 1D float arrays [n_new]
+            Properties of the new prisms (units as for add_prism)
+
+        Returns
+        -------
+        keys : numpy 1D int array [n_new]
+            Keys of the new prisms
+
+        """
+        xpr = np.asarray(xpr, dtype=float).reshape(-1, 2)
+        n_new = len(xpr)
+        pset = self.get_prism_set()
+        pset.n_max = self.n_max
+        keys = pset.add(xpr, ypr, zpr, np.asarray(sus)/(4*np.pi), rem,
+                        np.radians(rinc), np.radians(rdec), rho)
+        i0 = len(pset) - n_new
+        for i, key in enumerate(keys):
+            self.prisms[key] = Prism(
+                pset.x[i0+i], pset.y[i0+i], pset.z[i0+i],
+                np.broadcast_to(sus, (n_new,))[i], pset.rem[i0+i],
+                np.broadcast_to(rinc, (n_new,))[i],
+                np.broadcast_to(rdec, (n_new,))[i], pset.rho[i0+i],
+                self.earth)
+        for d in ("x", "y", "z"):
+            for key, k in getattr(pset, f"{d}_links"):
+                if key >= keys[0]:
+                    getattr(self.prisms[key], f"{d}_neigh").append(k)
+        for i, key in enumerate(keys):
+            self.index.insert(key, pset.x[i0+i], pset.y[i0+i], pset.z[i0+i])
+        self.n_max = pset.n_max
+        self.n_prisms += n_new
+        return keys
+
+    def get_prism_set(self):
+        """
+        Get a columnar copy of the prism dictionary, used for vectorized
+        passes over the whole model (see class PrismSet)
+
+        Returns
+        -------
+        object of class PrismSet
+
+        """
+        return PrismSet.from_prisms(self.prisms)
+
+    def remove_prism(self, key):
+        """
+        Remove a prism for the dictionary
+        n_prisms will be reduced by one, but not n_max.
+        Only the prisms touching the removed one (found in the spatial index)
+        may have it in their neighbour lists.
+        """
+        try:
+            del self.prisms[key]
+            self.n_prisms -= 1
+            touching = self.index.query(self.index.bounds[key])
+            self.index.remove(key)
+            for k in touching:
+                if k == key:
+                    continue
+                if key in self.prisms[k].x_neigh:
+                    del self.prisms[k].x_neigh[np.where(
+                        np.array(self.prisms[k].x_neigh) == key)[0][0]]
+                if key in self.prisms[k].y_neigh:
+                    del self.prisms[k].y_neigh[np.where(
+                        np.array(self.prisms[k].y_neigh) == key)[0][0]]
+                if key in self.prisms[k].z_neigh:
+                    del self.prisms[k].z_neigh[np.where(
+                        np.array(self.prisms[k].z_neigh) == key)[0][0]]
+            return True
+        except KeyError:
+            print(f"\nWarning in 'remove_prism': Prism {key} does not exist "
+                  + "in dictionary.")
+            return False
+
+    def locate(self, xp, yp, zp):
+        """
+        Find the prisms containing a point using the spatial index
+
+        Parameters
+        ----------
+        xp, yp, zp : floats
+            Coordinates of the point
+
+        Returns
+        -------
+        list of int
+            Keys of the prisms containing the point (several ones if the
+            point lies on a common face; empty if it is outside the model)
+
+        """
+        return self.index.locate(xp, yp, zp)
+
+    def get_prism_coor(self, keys=None):
+        """
+        Collect the face coordinates of prisms into arrays, as needed by the
+        tensor kernels
+
+        Parameters
+        ----------
+        keys : list of int, optional; default: None
+            Keys of the prisms to be used. If None, all prisms in dictionary
+            order
+
+        Returns
+        -------
+        x, y, z : numpy 2D float arrays [n_keys, 2]
+            Coordinates of W/E, S/N and top/bottom faces of the prisms
+
+        """
+        if keys is None:
+            keys = list(self.prisms.keys())
+        x = np.zeros((len(keys), 2))
+        y = np.zeros((len(keys), 2))
+        z = np.zeros((len(keys), 2))
+        for i, key in enumerate(keys):
+            x[i, :] = self.prisms[key].x
+            y[i, :] = self.prisms[key].y
+            z[i, :] = self.prisms[key].z
+        return x, y, z
+
+    def get_blocks(self, n_prisms, n_points, n_jobs=1, n_heights=1):
+        """
+        Split the combinations of n_prisms prisms and n_points points into
+        blocks that can be evaluated as one broadcast tensor operation
+        without the temporary arrays exceeding self.mem_budget.
+        If possible, a block contains all points and as many prisms as
+        allowed, else a block contains one prism and part of the points.
+
+        Parameters
+        ----------
+        n_prisms : int
+            Number of prisms
+        n_points : int
+            Number of calculation points
+        n_jobs : int, optional; default: 1
+            Number of processes evaluating blocks simultaneously. The memory
+            budget is shared among them and prisms are split into at least
+            4*n_jobs blocks (if there are enough prisms) for load balancing.
+        n_heights : int, optional; default: 1
+            Number of heights at which every point is evaluated (see
+            height_sets)
+
+        Yields
+        ------
+        ip : slice
+            Prism indices of the block
+        jp : slice
+            Point indices of the block
+
+        """
+        max_pairs = max(int(self.mem_budget/(_BYTES_PER_PAIR*n_jobs
+                                             * n_heights)), 1)
+        if n_points <= max_pairs:
+            dp = n_points
+            dm = max(max_pairs//max(n_points, 1), 1)
+            if n_jobs > 1:
+                dm = min(dm, max(int(np.ceil(n_prisms/(4*n_jobs))), 1))
+        else:
+            dp = max_pairs
+            dm = 1
+        for i0 in range(0, n_prisms, dm):
+            for j0 in range(0, n_points, dp):
+                yield slice(i0, min(i0+dm, n_prisms)),\
+                    slice(j0, min(j0+dp, n_points))
+
+    def height_sets(self, xp, yp, zp):
+        """
+        Arrange calculation points for an evaluation at several heights in
+        one pass (see _mag_terms). If zp is 1D, the points are tested for
+        being copies of the same horizontal positions (utils.height_groups),
+        as for two-sensor data.
+
+        Parameters
+        ----------
+        xp, yp : numpy 1D float arrays
+            Horizontal coordinates of points
+        zp : numpy float array, 1D [n_points] or 2D [n_heights, n_points]
+            Heights of points. If zp is 2D, all heights belong to the
+            positions xp, yp [n_points].
+
+        Returns
+        -------
+        xh, yh : numpy 1D float arrays [n_positions]
+            Horizontal positions
+        zh : numpy 2D float array [n_heights, n_positions]
+            Heights of points. Points are ordered like zh.ravel().
+
+        """
+        xp = np.asarray(xp, dtype=np.float64)
+        yp = np.asarray(yp, dtype=np.float64)
+        zp = np.asarray(zp, dtype=np.float64)
+        if zp.ndim == 2:
+            return xp, yp, zp
+        n_heights = utils.height_groups(xp, yp)
+        n = len(xp)//n_heights
+        return xp[:n], yp[:n], zp.reshape(n_heights, n)
+
+    def deriv_chunks(self, keys, xp, yp, zp, kind, progress=None,
+                     start=True):
+        """
+        Calculate derivative columns of the given prisms chunk by chunk of
+        prisms. Only the derivatives of one chunk are held in memory; a chunk
+        takes at most a quarter of self.mem_budget, the kernel evaluation
+        uses the budget for its own temporary arrays.
+        For segments of points forming a regular grid at constant height,
+        columns are extracted from translation-invariant reference kernels
+        (see cached_deriv). All other points are treated by direct_deriv.
+        If a disk cache is used, columns found in the cache are not
+        calculated and new columns are saved.
+
+        Parameters
+        ----------
+        keys : list of int
+            Keys of the prisms for which derivatives are calculated
+        xp, yp, zp : numpy 1D float arrays [n_points]
+            Coordinates of calculation points
+        kind : str
+            If "mag", the derivatives are the total field anomalies of unit
+            magnetizations in X, Y and Z (n_types = 3).
+            If "grav", the derivatives are taken with respect to density
+            (n_types = 1).
+        progress : object of class Progress, optional; default: None
+            Receives the number of calculated prism-point combinations and
+            allows cancelling the calculation
+        start : bool, optional; default: True
+            If True, progress is started for the prism-point combinations of
+            this call. If False, it continues counting (e.g. the calculation
+            is one of several calls started by the caller).
+
+        Yields
+        ------
+        i0, i1 : int
+            The chunk contains prisms keys[i0:i1]
+        der : numpy 3D float array [n_types, i1-i0, n_points]
+            Derivatives of the chunk. The array is overwritten by the next
+            chunk.
+
+        """
+        n_points = len(xp)
+        n_types = 3 if kind == "mag" else 1
+        if progress is None:
+            progress = Progress()
+        if start:
+            progress.start(len(keys)*n_points)
+        grids = []
+        if self.kernel_cache is not None:
+            grids = [(jp, grid) for jp, grid in
+                     utils.grid_segments(xp, yp, zp) if grid is not None
+                     and grid[2]*grid[5] >= _MIN_GRID_POINTS]
+        rest = np.ones(n_points, dtype=bool)
+        for jp, _ in grids:
+            rest[jp] = False
+        rest = np.where(rest)[0]
+        n_chunk = max(min(int(self.mem_budget/(32*n_types*max(n_points, 1))),
+                          len(keys)), 1)
+# With a process pool, arrays passed to direct_deriv are placed in shared
+#    memory, so that the workers write into them without further copies
+        shared = self.n_jobs > 1
+        blocks = []
+        tmp_blocks = []
+        try:
+            buffer, shm = _shared_zeros(n_types*n_chunk*n_points, blocks,
+                                        shared)
+            for i0 in range(0, len(keys), n_chunk):
+                chunk = keys[i0:i0+n_chunk]
+                der = buffer[:n_types*len(chunk)*n_points].reshape(
+                    n_types, len(chunk), n_points)
+                missing = list(range(len(chunk)))
+                if self.disk_cache is not None:
+                    cache_keys = self.cache_key(kind, xp, yp, zp, keys=chunk)
+                    missing = []
+                    for i, key in enumerate(cache_keys):
+                        val = self.disk_cache.load(key)
+                        if val is None:
+                            missing.append(i)
+                        else:
+                            der[:, i, :] = val.reshape(n_types, n_points)
+                    progress.update((len(chunk)-len(missing))*n_points)
+                if len(missing) > 0:
+                    new = [chunk[i] for i in missing]
+                    if len(new) == len(chunk):
+                        d, d_shm = der, shm
+                    else:
+                        d, d_shm = _shared_zeros(
+                            (n_types, len(new), n_points), tmp_blocks, shared)
+                    for jp, grid in grids:
+                        self.cached_deriv(new, zp[jp.start], grid, kind,
+                                          d[:, :, jp])
+                        progress.update(len(new)*(jp.stop-jp.start))
+                    if len(rest) == n_points:
+                        self.direct_deriv(new, xp, yp, zp, kind, d, progress,
+                                          d_shm)
+                    elif len(rest) > 0:
+                        r, r_shm = _shared_zeros((n_types, len(new),
+                                                  len(rest)), tmp_blocks,
+                                                 shared)
+                        self.direct_deriv(new, xp[rest], yp[rest], zp[rest],
+                                          kind, r, progress, r_shm)
+                        d[:, :, rest] = r
+                    if d is not der:
+                        der[:, missing, :] = d
+                    d = r = None
+                    _free_shared(tmp_blocks)
+                    if self.disk_cache is not None:
+                        for i in missing:
+                            self.disk_cache.save(
+                                cache_keys[i],
+                                der[:, i] if kind == "mag" else der[0, i])
+                yield i0, i0+len(chunk), der
+        finally:
+            buffer = der = d = r = None
+            _free_shared(tmp_blocks)
+            _free_shared(blocks)
+
+    def calc_deriv(self, keys, xp, yp, zp, kind, progress=None, sus_inv=True,
+                   rem_inv=False):
+        """
+        Calculate derivative columns of the given prisms and store them as
+        attributes of the prisms. The derivatives are calculated chunk by
+        chunk of prisms (see deriv_chunks); for magnetic data, only the
+        derivatives with respect to the inverted properties are kept.
+
+        Parameters
+        ----------
+        keys : list of int
+            Keys of the prisms for which derivatives are calculated
+        xp, yp, zp : numpy 1D float arrays [n_points]
+            Coordinates of calculation points
+        kind : str
+            If "mag", the derivatives with respect to susceptibility and
+            remanence are stored in attributes sus_der and rem_der (numpy 1D
+            float arrays [n_points] or None if the property is not
+            inverted).
+            If "grav", the derivatives with respect to density are stored in
+            attribute rho_der.
+        progress : object of class Progress, optional; default: None
+            Receives the number of calculated prism-point combinations and
+            allows cancelling the calculation
+        sus_inv : bool, optional
+            If True susceptibility derivatives are calculated; Default: True
+        rem_inv : bool, optional
+            If True remanence derivatives are calculated; Default: False
+
+        Returns
+        -------
+        None.
+
+        """
+        for i0, i1, der in self.deriv_chunks(keys, xp, yp, zp, kind,
+                                             progress):
+            if kind == "mag":
+                sus_der, rem_der = self.combine_unit_deriv(
+                    keys[i0:i1], der, sus_inv, rem_inv)
+                for i, key in enumerate(keys[i0:i1]):
+                    self.prisms[key].sus_der = None if sus_der is None\
+                        else sus_der[i]
+                    self.prisms[key].rem_der = None if rem_der is None\
+                        else rem_der[i]
+            else:
+                for i, key in enumerate(keys[i0:i1]):
+                    self.prisms[key].rho_der = der[0, i].copy()
+
+    def cached_deriv(self, keys, zp0, grid, kind, out):
+        """
+        Calculate derivative columns at points forming a regular grid at
+        constant height using translation invariance of the kernels.
+        Prisms are grouped into classes of equal size, depth and position
+        relative to the grid nodes. For each class, the kernel of one
+        reference prism is calculated once on an extended grid of offsets;
+        the columns of all prisms of the class are shifted windows of it.
+        Reference kernels are kept in self.kernel_cache and reused in later
+        calls (e.g. after prisms have been split). If the size of the cache
+        exceeds self.mem_budget, the least recently used kernels are removed.
+
+        Parameters
+        ----------
+        keys : list of int
+            Keys of the prisms for which derivatives are calculated
+        zp0 : float
+            Height of the calculation points
+        grid : tuple (x0, dx, nx, y0, dy, ny)
+            Regular grid of calculation points (see utils.regular_grid)
+        kind : str
+            "mag" or "grav" (see calc_deriv)
+        out : numpy 3D float array [n_types, n_keys, nx*ny]
+            Array where the derivatives are stored
+
+        Returns
+        -------
+        None.
+
+        """
+        x0, dx, nx, y0, dy, ny = grid
+        x, y, z = self.get_prism_coor(keys)
+        n_types = out.shape[0]
+        sx, sy, classes = self.kernel_classes(x, y, z, zp0, grid, kind)
+        for c, members in classes.items():
+# Offsets (in grid steps) between grid nodes and prisms needed for this call
+            ox1 = -sx[members].max()
+            ox2 = nx - 1 - sx[members].min()
+            oy1 = -sy[members].max()
+            oy2 = ny - 1 - sy[members].min()
+            if c in self.kernel_cache:
+# The kernel is moved to the end of the dictionary, which is ordered from
+#    least to most recently used
+                cx1, cx2, cy1, cy2, kernel = self.kernel_cache.pop(c)
+                self.kernel_cache[c] = (cx1, cx2, cy1, cy2, kernel)
+                if cx1 > ox1 or cx2 < ox2 or cy1 > oy1 or cy2 < oy2:
+                    ox1 = min(ox1, cx1)
+                    ox2 = max(ox2, cx2)
+                    oy1 = min(oy1, cy1)
+                    oy2 = max(oy2, cy2)
+                    del self.kernel_cache[c]
+                    self.kernel_cache_size -= kernel.nbytes
+                    kernel = None
+            else:
+                kernel = None
+            if kernel is None:
+                kernel = self.reference_kernel(
+                    x[members[0]], y[members[0]], z[members[0]],
+                    x0 + (sx[members[0]] + np.arange(ox1, ox2+1))*dx,
+                    y0 + (sy[members[0]] + np.arange(oy1, oy2+1))*dy, zp0,
+                    kind)
+# A class with only one prism is not stored, its kernel is not larger than
+#    the grid itself and might never be used again
+                if len(members) > 1 and kernel.nbytes <= self.mem_budget:
+                    while self.kernel_cache_size+kernel.nbytes >\
+                            self.mem_budget:
+                        oldest = next(iter(self.kernel_cache))
+                        self.kernel_cache_size -=\
+                            self.kernel_cache.pop(oldest)[4].nbytes
+                    self.kernel_cache[c] = (ox1, ox2, oy1, oy2, kernel)
+                    self.kernel_cache_size += kernel.nbytes
+            else:
+                ox1 = cx1
+                oy1 = cy1
+            for i in members:
+                ix = -sx[i] - ox1
+                iy = -sy[i] - oy1
+                out[:, i, :] = kernel[:, iy:iy+ny, ix:ix+nx].reshape(
+                    n_types, nx*ny)
+
+    def kernel_classes(self, x, y, z, zp0, grid, kind):
+        """
+        Group prisms into classes whose kernels at the nodes of a regular grid
+        are shifted copies of each other, i.e. prisms of equal size and depth
+        having the same position relative to the grid nodes.
+
+        Parameters
+        ----------
+        x, y, z : numpy 2D float arrays [n_prisms, 2]
+            Face coordinates of the prisms
+        zp0 : float
+            Height of the grid
+        grid : tuple (x0, dx, nx, y0, dy, ny)
+            Regular grid of calculation points (see utils.regular_grid)
+        kind : str
+            "mag" or "grav" (see calc_deriv)
+
+        Returns
+        -------
+        sx, sy : numpy 1D int arrays [n_prisms]
+            Shift of every prism in grid steps in x and y direction
+        classes : dictionary
+            Key: tuple identifying the class; value: numpy 1D int array with
+            the indices of the prisms belonging to the class
+
+        """
+        x0, dx, _, y0, dy, _ = grid
+# Shift of every prism in grid steps and fractional position (in millionths
+#    of a grid step) of its W and S faces with respect to the grid nodes
+        sx = np.floor((x.min(axis=1) - x0)/dx).astype(int)
+        sy = np.floor((y.min(axis=1) - y0)/dy).astype(int)
+        fx = np.round((x.min(axis=1) - x0 - sx*dx)/dx*1.E6).astype(int)
+        fy = np.round((y.min(axis=1) - y0 - sy*dy)/dy*1.E6).astype(int)
+        sx[fx == 1000000] += 1
+        fx[fx == 1000000] = 0
+        sy[fy == 1000000] += 1
+        fy[fy == 1000000] = 0
+        classes = {}
+        for i in range(len(x)):
+            c = (kind, round(np.ptp(x[i]), 6), round(np.ptp(y[i]), 6),
+                 round(z[i].min(), 6), round(z[i].max(), 6), fx[i], fy[i],
+                 round(zp0, 6), round(dx, 6), round(dy, 6))
+            classes.setdefault(c, []).append(i)
+        for c in classes:
+            classes[c] = np.array(classes[c])
+        return sx, sy, classes
+
+    def reference_kernel(self, x, y, z, xg, yg, zp0, kind):
+        """
+        Calculate the derivatives of one prism at the nodes of a regular grid
+
+        Parameters
+        ----------
+        x, y, z : numpy 1D float arrays [2]
+            Face coordinates of the prism
+        xg, yg : numpy 1D float arrays
+            Coordinates of grid columns and rows
+        zp0 : float
+            Height of the grid
+        kind : str
+            "mag" or "grav" (see calc_deriv)
+
+        Returns
+        -------
+        kernel : numpy 3D float array [n_types, len(yg), len(xg)]
+
+        """
+        xx, yy = np.meshgrid(xg, yg)
+        xx = xx.flatten()
+        yy = yy.flatten()
+        zz = np.full(len(xx), zp0, dtype=np.float64)
+        if kind == "mag":
+            kernel = np.zeros((3, len(xx)))
+        else:
+            kernel = np.zeros((1, len(xx)))
+        for _, jp in self.get_blocks(1, len(xx)):
+            if kind == "mag":
+                kernel[:, jp] = _mag_deriv_block(
+                    x[None, :], y[None, :], z[None, :], xx[jp], yy[jp],
+                    zz[jp], self.earth)[:, 0, :]
+            else:
+                kernel[:, jp] = _grav_deriv_block(
+                    x[None, :], y[None, :], z[None, :], xx[jp], yy[jp],
+                    zz[jp], self.G)[:, 0, :]
+        return kernel.reshape(kernel.shape[0], len(yg), len(xg))
+
+    def clear_kernel_cache(self):
+        """
+        Remove all reference kernels from the cache. Must be called if the
+        Earth's field of the model is changed (the Frechet matrix store is
+        renewed automatically in this case, see create_Frechet).
+        """
+        if self.kernel_cache is not None:
+            self.kernel_cache = {}
+        self.kernel_cache_size = 0
+
+    def cache_key(self, kind, xp, yp, zp, keys=None, tol=0.):
+        """
+        Keys of the disk cache (see class DiskCache) for derivative columns
+        of single prisms or for forward responses of the whole model
+
+        Parameters
+        ----------
+        kind : str
+            "mag" or "grav" (derivative columns), "mag_forward",
+            "grav_forward" or "joint_forward" (forward responses)
+        xp, yp, zp : numpy float arrays
+            Coordinates of calculation points
+        keys : list of int, optional; default: None
+            For derivative columns, keys of the prisms
+        tol : float, optional; default: 0.
+            For forward responses, tolerance of the approximate calculation
+
+        Returns
+        -------
+        str or list of str
+            Key of the forward response or keys of the derivative columns of
+            every prism
+
+        """
+        earth = np.array([self.earth.f, self.earth.inc, self.earth.dec])
+        points = self.disk_cache.key("points", xp, yp, zp)
+        if keys is not None:
+# Gravity derivatives do not depend on the Earth's field
+            if kind == "grav":
+                earth = np.zeros(0)
+            return [self.disk_cache.key(
+                f"{kind}_{points}", self.prisms[key].x, self.prisms[key].y,
+                self.prisms[key].z, earth) for key in keys]
+        x, y, z = self.get_prism_coor()
+        props = np.array([[val.tx, val.ty, val.tz, val.rho]
+                          for val in self.prisms.values()])
+        return self.disk_cache.key(f"{kind}_{tol}_{points}", x, y, z, props,
+                                   earth)
+
+    def direct_deriv(self, keys, xp, yp, zp, kind, out, progress=None,
+                     shm=None):
+        """
+        Calculate derivative columns of the given prisms by direct evaluation
+        of the kernels block by block.
+        If self.n_jobs > 1 and the problem is large enough, blocks are
+        calculated by a pool of processes, each one writing its results
+        directly into an output array located in shared memory (out itself
+        if shm is given).
+        Points repeated at several heights are evaluated in one pass (see
+        height_sets).
+
+        Parameters
+        ----------
+        keys : list of int
+            Keys of the prisms for which derivatives are calculated
+        xp, yp, zp : numpy 1D float arrays [n_points]
+            Coordinates of calculation points
+        kind : str
+            "mag" or "grav" (see calc_deriv)
+        out : numpy 3D float array [n_types, n_keys, n_points]
+            Array where the derivatives are stored
+        progress : object of class Progress, optional; default: None
+            Receives the number of calculated prism-point combinations after
+            every block and allows cancelling the calculation. If it has no
+            callback, progress is printed after every row of blocks.
+        shm : SharedMemory object, optional; default: None
+            Shared memory block at whose start out is located (see
+            _shared_zeros). If None and a process pool is used, the results
+            are calculated in a temporary shared array and copied into out.
+
+        Returns
+        -------
+        None.
+
+        """
+        if progress is None:
+            progress = Progress()
+        x, y, z = self.get_prism_coor(keys)
+        n_new = len(keys)
+        xp, yp, zp = self.height_sets(xp, yp, zp)
+        n_points = len(xp)
+        n_heights = len(zp)
+        shape = out.shape
+# out is contiguous, the reshaped array is a view with the points of every
+#    height along the last axis
+        out_h = out.reshape(shape[0], shape[1], n_heights, n_points)
+
+        def block_task(ip, jp):
+            if kind == "mag":
+                return ip, jp, _mag_deriv_block, (x[ip], y[ip], z[ip],
+                                                  self.earth)
+            return ip, jp, _grav_deriv_block, (x[ip], y[ip], z[ip], self.G)
+
+        if self.n_jobs <= 1 or n_new*n_points < _MIN_PARALLEL_PAIRS:
+            for ip, jp in self.get_blocks(n_new, n_points,
+                                          n_heights=n_heights):
+                _, _, func, args = block_task(ip, jp)
+                out_h[:, ip, :, jp] = func(
+                    args[0], args[1], args[2], xp[jp], yp[jp], zp[:, jp],
+                    *args[3:]).reshape(shape[0], -1, n_heights,
+                                       jp.stop-jp.start)
+                if jp.stop == n_points and progress.callback is None:
+                    print(f"Prisms {ip.start+1} to {ip.stop} of {n_new}: "
+                          + "derivatives calculated")
+                progress.update((ip.stop-ip.start)*(jp.stop-jp.start)
+                                * n_heights)
+            return
+        blocks = []
+        if shm is None:
+            der, shm = _shared_zeros(shape, blocks)
+        else:
+            der = out
+        try:
+            tasks = [block_task(ip, jp) for ip, jp in
+                     self.get_blocks(n_new, n_points, self.n_jobs,
+                                     n_heights)]
+            with ProcessPoolExecutor(
+                    max_workers=self.n_jobs, initializer=_init_worker,
+                    initargs=(xp, yp, zp, shm.name, shape)) as pool:
+                futures = [pool.submit(_deriv_worker, t) for t in tasks]
+                try:
+                    for f in as_completed(futures):
+                        ip, jp = f.result()
+                        if jp.stop == n_points and progress.callback is None:
+                            print(f"Prisms {ip.start+1} to {ip.stop} of "
+                                  + f"{n_new}: derivatives calculated")
+                        progress.update((ip.stop-ip.start)
+                                        * (jp.stop-jp.start)*n_heights)
+# Blocks not yet started are dropped, running ones are waited for
+                except Cancelled:
+                    for f in futures:
+                        f.cancel()
+                    raise
+            if der is not out:
+                out[...] = der
+        finally:
+            der = None
+            _free_shared(blocks)
+
+    def combine_unit_deriv(self, keys, unit_der, sus_inv=True,
+                           rem_inv=False):
+        """
+        Calculate derivatives with respect to susceptibility and remanence as
+        linear combinations of the responses of unit magnetizations in X, Y
+        and Z (see deriv_chunks).
+
+        Parameters
+        ----------
+        keys : list of int
+            Keys of prisms to be treated
+        unit_der : numpy 3D float array [3, n_keys, n_points]
+            Total field anomalies of unit magnetizations of the prisms
+        sus_inv : bool, optional
+            If True susceptibility derivatives are calculated; Default: True
+        rem_inv : bool, optional
+            If True remanence derivatives are calculated; Default: False
+
+        Returns
+        -------
+        sus_der, rem_der : numpy 2D float arrays [n_keys, n_points] or None
+            Derivatives with respect to susceptibility and remanence. None if
+            the property is not inverted.
+
+        """
+# Magnetization components for unit susceptibility and for unit remanence
+#    (same convention as used by Prism.comps)
+        sus_der = None
+        rem_der = None
+        if sus_inv:
+            comps = np.array([utils.magnetization_components(
+                1., 0., self.prisms[key].dec, self.prisms[key].inc,
+                self.earth) for key in keys])
+            sus_der = np.einsum("ik,kin->in", comps, unit_der)
+        if rem_inv:
+            comps = np.array([utils.magnetization_components(
+                0., 1., self.prisms[key].dec, self.prisms[key].inc,
+                self.earth) for key in keys])
+            rem_der = np.einsum("ik,kin->in", comps, unit_der)
+        return sus_der, rem_der
+
+    def build_octree(self, x, y, z, weights, leaf_size=8):
+        """
+        Organize prisms in an octree for far-field approximations.
+        Cells are recursively divided into eight octants of the box
+        containing the prism centers until they contain at most leaf_size
+        prisms.
+
+        Parameters
+        ----------
+        x, y, z : numpy 2D float arrays [n_prisms, 2]
+            Face coordinates of the prisms
+        weights : numpy 1D float array [n_prisms]
+            Absolute values of the prism sources (mass or magnetic moment),
+            used to place the center of every cell
+        leaf_size : int, optional; default: 8
+            Maximum number of prisms in a leaf cell
+
+        Returns
+        -------
+        nodes : list of dictionaries, nodes[0] being the root cell
+            Each dictionary contains:
+            "idx": indices of the prisms of the cell
+            "children": list of indices of child cells (empty for leaves)
+            "center": center of the cell, weighted by the prism sources
+            "radius": largest distance from center to a prism corner
+
+        """
+        xc = x.mean(axis=1)
+        yc = y.mean(axis=1)
+        zc = z.mean(axis=1)
+        vol = np.abs(np.diff(x, axis=1)*np.diff(y, axis=1)
+                     * np.diff(z, axis=1))[:, 0]
+        nodes = []
+        stack = [(np.arange(len(xc)), -1)]
+        while stack:
+            idx, parent = stack.pop()
+            w = weights[idx]
+            if w.sum() <= 0.:
+                w = vol[idx]
+            center = np.array([np.average(xc[idx], weights=w),
+                               np.average(yc[idx], weights=w),
+                               np.average(zc[idx], weights=w)])
+            corners = np.array([
+                np.maximum(np.abs(x[idx]-center[0]).max(axis=1), 0.),
+                np.maximum(np.abs(y[idx]-center[1]).max(axis=1), 0.),
+                np.maximum(np.abs(z[idx]-center[2]).max(axis=1), 0.)])
+            node = {"idx": idx, "children": [], "center": center,
+                    "radius": np.sqrt((corners**2).sum(axis=0)).max()}
+            nodes.append(node)
+            if parent >= 0:
+                nodes[parent]["children"].append(len(nodes)-1)
+            if len(idx) <= leaf_size:
+                continue
+            mid = [(v[idx].min()+v[idx].max())/2. for v in (xc, yc, zc)]
+            octant = (xc[idx] > mid[0])*4 + (yc[idx] > mid[1])*2\
+                + (zc[idx] > mid[2])
+            if np.all(octant == octant[0]):
+                continue
+            for o in np.unique(octant)[::-1]:
+                stack.append((idx[octant == o], len(nodes)-1))
+        return nodes
+
+    def tree_forward(self, xp, yp, zp, kind, tol, leaf_size=8,
+                     progress=None):
+        """
+        Approximate forward calculation using an octree of prisms (see
+        build_octree). A cell of the tree is replaced for a given point by a
+        point dipole (magnetic) or point mass (gravity) located at its
+        center if (radius/distance)**2 <= tol. tol is thus an opening
+        criterion for every cell: it bounds approximately the relative error
+        of the effect of each approximated cell, not of the total field at a
+        point. Since effects of different cells partly cancel, the error of
+        the result should be compared to the largest absolute field values;
+        at points of low amplitude, it may be of the order of the local value
+        itself. Otherwise, child cells are tested or, for leaf cells, the
+        effects of the prisms are calculated exactly. The number of
+        operations is of the order of n_points*log(n_prisms) for large models.
+
+        Parameters
+        ----------
+        xp, yp, zp : numpy 1D float arrays [n_points]
+            Coordinates of calculation points
+        kind : str
+            "mag" or "grav"
+        tol : float
+            Opening criterion of cells, approximately the relative error of
+            the effect of each approximated cell (not of the local field)
+        leaf_size : int, optional; default: 8
+            Maximum number of prisms in a leaf cell
+        progress : object of class Progress, optional; default: None
+            Receives the number of treated prism-point combinations
+            (approximated, calculated exactly or skipped for cells without
+            sources) after every cell and every block of exact calculations
+            and allows cancelling the calculation
+
+        Returns
+        -------
+        numpy 2D float array [n_points, 3] if kind == "mag" (X, Y and Z
+        components), numpy 1D float array [n_points] if kind == "grav"
+        (without gravity constant)
+
+        """
+        if progress is None:
+            progress = Progress()
+        n_points = len(xp)
+        x, y, z = self.get_prism_coor()
+        vol = np.abs(np.diff(x, axis=1)*np.diff(y, axis=1)
+                     * np.diff(z, axis=1))[:, 0]
+        if kind == "mag":
+            mag = np.array([[val.tx, val.ty, val.tz]
+                            for val in self.prisms.values()]).reshape(-1, 3)
+            source = mag*vol[:, None]
+            weights = np.sqrt((source**2).sum(axis=1))
+            v = np.zeros((n_points, 3))
+        else:
+            rho = np.array([val.rho for val in self.prisms.values()])
+            source = rho*vol
+            weights = np.abs(source)
+            v = np.zeros(n_points)
+        nodes = self.build_octree(x, y, z, weights, leaf_size)
+        stack = [(0, np.arange(n_points))]
+        while stack:
+            inode, jp = stack.pop()
+            node = nodes[inode]
+            idx = node["idx"]
+            if weights[idx].max() == 0.:
+                progress.update(len(idx)*len(jp))
+                continue
+            c = node["center"]
+            if kind == "mag":
+                dist2 = (c[0]-xp[jp])**2 + (c[1]-yp[jp])**2 + (c[2]+zp[jp])**2
+            else:
+                dist2 = (c[0]-xp[jp])**2 + (c[1]-yp[jp])**2 + (c[2]-zp[jp])**2
+            far = node["radius"]**2 <= tol*dist2
+            jf = jp[far]
+            if len(jf) > 0:
+                if kind == "mag":
+                    dex, dey, dez = _mag_far(c, source[idx].sum(axis=0),
+                                             xp[jf], yp[jf], zp[jf])
+                    v[jf, 0] += dex
+                    v[jf, 1] += dey
+                    v[jf, 2] += dez
+                else:
+                    v[jf] += _grav_far(c, source[idx].sum(), xp[jf], yp[jf],
+                                       zp[jf])
+                progress.update(len(idx)*len(jf))
+            jn = jp[~far]
+            if len(jn) == 0:
+                continue
+            if node["children"]:
+                for child in node["children"]:
+                    stack.append((child, jn))
+                continue
+# Leaf cell near the points: exact calculation
+            for ip, jb in self.get_blocks(len(idx), len(jn)):
+                k = idx[ip]
+                j = jn[jb]
+                if kind == "mag":
+                    g1, g2, g3, t1, t2, t3 = _mag_terms(
+                        x[k], y[k], z[k], xp[j], yp[j], zp[j])
+                    tx = mag[k, 0]
+                    ty = mag[k, 1]
+                    tz = mag[k, 2]
+                    v[j, 0] += tx @ t1 + ty @ g2 + tz @ g1
+                    v[j, 1] += tx @ g2 + ty @ t2 + tz @ g3
+                    v[j, 2] += tx @ g1 + ty @ g3 + tz @ t3
+                else:
+                    v[j] += rho[k] @ _grav_terms(x[k], y[k], z[k], xp[j],
+                                                 yp[j], zp[j])
+                progress.update(len(k)*len(j))
+        return v
+
+    def mag_forward(self, xp, yp, zp, tol=0., callback=None, cancel=None):
+        """
+        Calculate summed effect of all prisms on all field points.
+        Several observation heights may be evaluated in one pass, terms
+        depending only on horizontal distances being calculated once for all
+        heights: either zp is given as 2D array, or the points are copies of
+        the same horizontal positions (e.g. two-sensor data, see
+        height_sets).
+
+        Parameters
+        ----------
+        prisms : dictionary with Prism class objects
+            Positions and properties of all prisms
+        xp : numpy 1D float array [n_points]
+            X-coordiante of field points
+            [nr: number of rows in NS direction, nc: number columns in EW
+            direction]
+        yp : numpy 1D float array [n_points]
+            Y-coordiante of field points
+        zp : numpy float array [n_points] or [n_heights, n_points]
+            Z-coordiante of field points
+        tol : float, optional; default: 0.
+            If > 0, an approximate calculation is done where far away groups
+            of prisms are replaced by point dipoles. tol approximately bounds
+            the error relative to the largest field values, not to the local
+            value (see tree_forward)
+        callback : callable, optional; default: None
+            Called with the state of the calculation (see Progress.info),
+            items being prism-point combinations
+        cancel : object of class CancelToken, optional; default: None
+            If its cancellation is requested, the calculation stops raising
+            exception Cancelled
+
+        Returns
+        -------
+        v : numpy 2D float array [n_points,5]
+            Calculated anomalies.
+            v[:,0] : X-component (N-S)
+            v[:,1] : Y-component (E-W)
+            v[:,2] : Z-component
+            v[:,3] : horizontal component
+            v[:,4] : total field component
+            If zp is 2D, v has shape [n_heights, n_points, 5].
+        """
+        zp = np.asarray(zp, dtype=np.float64)
+        if self.disk_cache is not None:
+            cache_key = self.cache_key("mag_forward", xp, yp, zp, tol=tol)
+            v = self.disk_cache.load(cache_key)
+            if v is not None:
+                self.v = v.reshape(-1, 5)
+                return v
+        xh, yh, zh = self.height_sets(xp, yp, zp)
+        n_points = len(xh)
+        n_heights = len(zh)
+        progress = Progress(callback, cancel, "magnetic forward model")
+        progress.start(self.n_prisms*n_points*n_heights)
+        self.v = np.zeros((n_heights*n_points, 5))
+        if tol > 0.:
+            self.v[:, :3] = self.tree_forward(
+                np.tile(xh, n_heights), np.tile(yh, n_heights), zh.ravel(),
+                "mag", tol, progress=progress)
+        else:
+            x, y, z = self.get_prism_coor()
+            tx = np.array([val.tx for val in self.prisms.values()])
+            ty = np.array([val.ty for val in self.prisms.values()])
+            tz = np.array([val.tz for val in self.prisms.values()])
+            v = self.v.reshape(n_heights, n_points, 5)
+            shape = (n_heights, -1)
+            for ip, jp in self.get_blocks(len(tx), n_points,
+                                          n_heights=n_heights):
+                g1, g2, g3, t1, t2, t3 = _mag_terms(
+                    x[ip], y[ip], z[ip], xh[jp], yh[jp], zh[:, jp])
+                v[:, jp, 0] += (tx[ip] @ t1 + ty[ip] @ g2
+                                + tz[ip] @ g1).reshape(shape)
+                v[:, jp, 1] += (tx[ip] @ g2 + ty[ip] @ t2
+                                + tz[ip] @ g3).reshape(shape)
+                v[:, jp, 2] += (tx[ip] @ g1 + ty[ip] @ g3
+                                + tz[ip] @ t3).reshape(shape)
+                progress.update((ip.stop-ip.start)*(jp.stop-jp.start)
+                                * n_heights)
+        self.v[:, 3], self.v[:, 4] = utils.compon(
+            self.v[:, 0], self.v[:, 1], self.v[:, 2], self.earth)
+        if zp.ndim == 2:
+            v = self.v.reshape(n_heights, n_points, 5).copy()
+        else:
+            v = np.copy(self.v)
+        if self.disk_cache is not None:
+            self.disk_cache.save(cache_key, v)
+        return v
+
+    def mag_deriv(self, xp, yp, zp, sus_inv=True, rem_inv=False,
+                  callback=None, cancel=None):
+        """
+        Calculate derivatives of the magnetic effect of all prisms on all
+        field points.
+        The kernel is evaluated only once per prism for unit magnetizations
+        in X, Y and Z; susceptibility and remanence derivatives are linear
+        combinations of these three responses (see combine_unit_deriv).
+        Only the derivatives of the inverted properties are stored in the
+        prisms (attributes sus_der and rem_der).
 
         Parameters
         ----------
@@ -654,24 +2877,106 @@ class Prism_calc(Prism, Earth):
             Y-coordiante of field points
         zp : numpy 1D float array [n_points]
             Z-coordiante of field points
+        sus_inv : bool, optional
+            If True susceptibility derivatives are calculated; Default: True
+        rem_inv : bool, optional
+            If True remanence derivatives are calculated; Default: False
+        callback : callable, optional; default: None
+            Called with the state of the calculation (see Progress.info),
+            items being prism-point combinations
+        cancel : object of class CancelToken, optional; default: None
+            If its cancellation is requested, the calculation stops raising
+            exception Cancelled
+
+        """
+        xp = np.asarray(xp, dtype=np.float64)
+        yp = np.asarray(yp, dtype=np.float64)
+        zp = np.asarray(zp, dtype=np.float64)
+        keys = [key for key, val in self.prisms.items()
+                if not val.der_flag_mag]
+        if len(keys) == 0 or not (sus_inv or rem_inv):
+            return True
+        self.calc_deriv(keys, xp, yp, zp, "mag", Progress(
+            callback, cancel, "magnetic derivatives"), sus_inv, rem_inv)
+        for key in keys:
+            self.prisms[key].der_flag_mag = True
+        return True
+
+    def grav_forward(self, xp, yp, zp, tol=0., callback=None, cancel=None):
+        """
+        Calculate summed gravity effect of all prisms on all field points.
+        As in mag_forward, several observation heights may be evaluated in
+        one pass.
+
+        Parameters
+        ----------
+        prisms : dictionary with Prism class objects
+            Positions and properties of all prisms
+        xp : numpy 1D float array [n_points]
+            X-coordiante of field points
+            [nr: number of rows in NS direction, nc: number columns in EW
+            direction]
+        yp : numpy 1D float array [n_points]
+            Y-coordiante of field points
+        zp : numpy float array [n_points] or [n_heights, n_points]
+            Z-coordiante of field points
+        tol : float, optional; default: 0.
+            If > 0, an approximate calculation is done where far away groups
+            of prisms are replaced by point masses. tol approximately bounds
+            the error relative to the largest field values, not to the local
+            value (see tree_forward)
+        callback : callable, optional; default: None
+            Called with the state of the calculation (see Progress.info),
+            items being prism-point combinations
+        cancel : object of class CancelToken, optional; default: None
+            If its cancellation is requested, the calculation stops raising
+            exception Cancelled
 
         Returns
         -------
         g : numpy 1D float array [n_points]
-            Calculated anomalies.
+            Calculated anomalies. If zp is 2D, g has shape
+            [n_heights, n_points].
         """
     # G is the universal gravity constant
     # in order to pass from m/s2 to mGal, it is multiplied by 10**5
-        n_points = len(xp)
-        self.g = np.zeros(n_points)
-        for i in range(n_points):
-            for key, val in self.prisms.items():
-                self.g[i] += val.grav_prism(xp[i], yp[i], zp[i])
-            if np.mod(i+1, 100) == 0:
-                print(f"Point {i+1}: Gravi calculated")
-        return np.copy(self.g)
+        zp = np.asarray(zp, dtype=np.float64)
+        if self.disk_cache is not None:
+            cache_key = self.cache_key("grav_forward", xp, yp, zp, tol=tol)
+            g = self.disk_cache.load(cache_key)
+            if g is not None:
+                self.g = g.ravel()
+                return g
+        xh, yh, zh = self.height_sets(xp, yp, zp)
+        n_points = len(xh)
+        n_heights = len(zh)
+        progress = Progress(callback, cancel, "gravity forward model")
+        progress.start(self.n_prisms*n_points*n_heights)
+        if tol > 0.:
+            self.g = self.tree_forward(
+                np.tile(xh, n_heights), np.tile(yh, n_heights), zh.ravel(),
+                "grav", tol, progress=progress)*self.G
+        else:
+            self.g = np.zeros((n_heights, n_points))
+            x, y, z = self.get_prism_coor()
+            rho = np.array([val.rho for val in self.prisms.values()])
+            for ip, jp in self.get_blocks(len(rho), n_points,
+                                          n_heights=n_heights):
+                self.g[:, jp] += (rho[ip] @ _grav_terms(
+                    x[ip], y[ip], z[ip], xh[jp], yh[jp], zh[:, jp])).reshape(
+                        n_heights, -1)
+                progress.update((ip.stop-ip.start)*(jp.stop-jp.start)
+                                * n_heights)
+            self.g = self.g.ravel()*self.G
+        if zp.ndim == 2:
+            g = self.g.reshape(n_heights, n_points).copy()
+        else:
+            g = np.copy(self.g)
+        if self.disk_cache is not None:
+            self.disk_cache.save(cache_key, g)
+        return g
 
-    def grav_deriv(self, xp, yp, zp, deriv=True):
+    def grav_deriv(self, xp, yp, zp, deriv=True, callback=None, cancel=None):
         """
         Calculate summed gravity effect of all prisms on all field points
 
@@ -687,22 +2992,109 @@ class Prism_calc(Prism, Earth):
             Y-coordiante of field points
         zp : numpy 1D float array [n_points]
             Z-coordiante of field points
+        callback : callable, optional; default: None
+            Called with the state of the calculation (see Progress.info),
+            items being prism-point combinations
+        cancel : object of class CancelToken, optional; default: None
+            If its cancellation is requested, the calculation stops raising
+            exception Cancelled
         """
+        xp = np.asarray(xp, dtype=np.float64)
+        yp = np.asarray(yp, dtype=np.float64)
+        zp = np.asarray(zp, dtype=np.float64)
         n_points = len(xp)
-        for key, val in self.prisms.items():
-            if val.der_flag_grav:
-                continue
-            val.rho_der = np.zeros(n_points)
-            rho = val.rho
-            val.rho = 1.
-            for i in range(n_points):
-                self.prisms[key].rho_der[i] = \
-                    val.grav_prism(xp[i], yp[i], zp[i])
-            val.rho = rho
+        keys = [key for key, val in self.prisms.items()
+                if not val.der_flag_grav]
+        n_new = len(keys)
+        if n_new == 0:
+            return True
+        self.calc_deriv(keys, xp, yp, zp, "grav", Progress(
+            callback, cancel, "gravity derivatives"))
+        for key in keys:
             self.prisms[key].der_flag_grav = True
-            print(f"Prism {key+1}: Gravi derivatives calculated")
         return True
 
+    def joint_forward(self, xp, yp, zp, callback=None, cancel=None):
+        """
+        Calculate summed magnetic and gravity effects of all prisms on all
+        field points in one pass. The expensive geometric terms (corner
+        distances and logarithms) are calculated once for both effects.
+        Heights follow the convention of mag_forward (zp positive upward):
+        the gravity effect corresponds to grav_forward(xp, yp, -zp).
+        As in mag_forward, several observation heights may be evaluated in
+        one pass.
+
+        Parameters
+        ----------
+        xp, yp : numpy 1D float arrays [n_points]
+            Horizontal coordinates of field points
+        zp : numpy float array [n_points] or [n_heights, n_points]
+            Heights of field points
+        callback : callable, optional; default: None
+            Called with the state of the calculation (see Progress.info),
+            items being prism-point combinations
+        cancel : object of class CancelToken, optional; default: None
+            If its cancellation is requested, the calculation stops raising
+            exception Cancelled
+
+        Returns
+        -------
+        v : numpy 2D float array [n_points,5]
+            Magnetic anomalies (see mag_forward)
+        g : numpy 1D float array [n_points]
+            Gravity anomalies
+            If zp is 2D, v and g have shapes [n_heights, n_points, 5] and
+            [n_heights, n_points].
+
+        """
+        zp = np.asarray(zp, dtype=np.float64)
+        if self.disk_cache is not None:
+            cache_key = self.cache_key("joint_forward", xp, yp, zp)
+            v = self.disk_cache.load(cache_key+"_mag")
+            g = self.disk_cache.load(cache_key+"_grav")
+            if v is not None and g is not None:
+                self.v = v.reshape(-1, 5)
+                self.g = g.ravel()
+                return v, g
+        xh, yh, zh = self.height_sets(xp, yp, zp)
+        n_points = len(xh)
+        n_heights = len(zh)
+        self.v = np.zeros((n_heights*n_points, 5))
+        self.g = np.zeros((n_heights, n_points))
+        v = self.v.reshape(n_heights, n_points, 5)
+        x, y, z = self.get_prism_coor()
+        tx = np.array([val.tx for val in self.prisms.values()])
+        ty = np.array([val.ty for val in self.prisms.values()])
+        tz = np.array([val.tz for val in self.prisms.values()])
+        rho = np.array([val.rho for val in self.prisms.values()])
+        shape = (n_heights, -1)
+        progress = Progress(callback, cancel, "joint forward model")
+        progress.start(len(tx)*n_points*n_heights)
+        for ip, jp in self.get_blocks(len(tx), n_points, n_heights=n_heights):
+            g1, g2, g3, t1, t2, t3, g = _mag_terms(
+                x[ip], y[ip], z[ip], xh[jp], yh[jp], zh[:, jp], grav=True)
+            v[:, jp, 0] += (tx[ip] @ t1 + ty[ip] @ g2
+                            + tz[ip] @ g1).reshape(shape)
+            v[:, jp, 1] += (tx[ip] @ g2 + ty[ip] @ t2
+                            + tz[ip] @ g3).reshape(shape)
+            v[:, jp, 2] += (tx[ip] @ g1 + ty[ip] @ g3
+                            + tz[ip] @ t3).reshape(shape)
+            self.g[:, jp] += (rho[ip] @ g).reshape(shape)
+            progress.update((ip.stop-ip.start)*(jp.stop-jp.start)*n_heights)
+        self.v[:, 3], self.v[:, 4] = utils.compon(
+            self.v[:, 0], self.v[:, 1], self.v[:, 2], self.earth)
+        self.g = self.g.ravel()*self.G
+        if zp.ndim == 2:
+            v = self.v.reshape(n_heights, n_points, 5).copy()
+            g = self.g.reshape(n_heights, n_points).copy()
+        else:
+            v = np.copy(self.v)
+            g = np.copy(self.g)
+        if self.disk_cache is not None:
+            self.disk_cache.save(cache_key+"_mag", v)
+            self.disk_cache.save(cache_key+"_grav", g)
+        return v, g
+
     def get_n_param(self, sus_inv, rem_inv, rho_inv):
         """
         Calculate total number of model parameters
@@ -732,9 +3124,22 @@ class Prism_calc(Prism, Earth):
         self.n_param += 1
         return self.n_param
 
-    def create_Frechet(self, sus_inv, rem_inv, rho_inv, xp, yp, zp):
+    def create_Frechet(self, sus_inv, rem_inv, rho_inv, xp, yp, zp,
+                       sparse_store=False, threshold=0., cutoff=0.,
+                       dtype=np.float64, store_file=None, callback=None,
+                       cancel=None):
         """
-        Calculate Freceht matrix
+        Calculate Freceht matrix.
+        The matrix is kept in a FrechetStore (self.frechet_store). If the
+        inverted property types and the data points are the same as in the
+        last call, only columns of prisms created since then are calculated
+        and added; columns of removed prisms are eliminated in place.
+        New columns are calculated chunk by chunk of prisms (see
+        deriv_chunks) and written directly into the store in its type, no
+        copy of the columns is kept in the prisms.
+        Optionally, the matrix is stored in compressed sparse row format (see
+        create_sparse_Frechet), in single precision or out of core in a
+        disk-backed memmap.
 
         Parameters
         ----------
@@ -744,63 +3149,282 @@ class Prism_calc(Prism, Earth):
             If True, remanences are model parameters
         rho_inv : bool
             If True, densities are model parameters
-        xpm : 1D numpy float array (lenght: number of magnetic data points)
-            X coordinates of magnetic data points
-        ypm : 1D numpy float array (lenght: number of magnetic data points)
-            Y coordinates of magnetic data points
-        zpm : 1D numpy float array (lenght: number of magnetic data points)
-            Z coordinates of magnetic data points
-        xpg : 1D numpy float array (lenght: number of gravity data points)
-            X coordinates of gravity data points
-        ypg : 1D numpy float array (lenght: number of gravity data points)
-            Y coordinates of gravity data points
-        zpg : 1D numpy float array (lenght: number of gravity data points)
-            Z coordinates of gravity data points
+        xp : 1D numpy float array (lenght: number of data points)
+            X coordinates of data points
+        yp : 1D numpy float array (lenght: number of data points)
+            Y coordinates of data points
+        zp : 1D numpy float array (lenght: number of data points)
+            Z coordinates of data points
+        sparse_store : bool, optional; default: False
+            If True, return a scipy.sparse CSR matrix, dropping small entries
+        threshold : float, optional; default: 0.
+            Used if sparse_store is True: entries with absolute values below
+            threshold times the maximum absolute value of their column are
+            dropped
+        cutoff : float, optional; default: 0.
+            Used if sparse_store is True and cutoff > 0: entries of data
+            points located at horizontal distances larger than cutoff from
+            the prism center are dropped
+        dtype : numpy float type, optional; default: np.float64
+            Type of the values of the dense matrix
+        store_file : str, optional; default: None
+            If given, the dense matrix is stored in a numpy memmap in this
+            file. Products with the matrix should then be done by blocks of
+            rows (see mag_grav_utilities.normal_equations).
+        callback, cancel : optional; default: None
+            Progress callback and cancellation token (see Progress)
 
         Return
         ------
             self.Frechet : 2D numpy float matrix with size [self.n_dat,
             self.n_param]
-                Frechet matrix
+                Frechet matrix. For dense storage, this is a view of the
+                store's buffer, valid until the next call to create_Frechet.
         """
+        xp = np.asarray(xp, dtype=np.float64)
+        yp = np.asarray(yp, dtype=np.float64)
+        zp = np.asarray(zp, dtype=np.float64)
+        n_data = len(xp)
         self.ndat = 0
+        row_mag = 0
         if sus_inv or rem_inv:
-            n_data = len(xp)
             self.ndat += n_data
-            self.mag_deriv(xp, yp, zp)
+        row_grav = self.ndat
         if rho_inv:
-            n_data = len(xp)
             self.ndat += n_data
-            self.grav_deriv(xp, yp, zp)
         self.n_param = self.get_n_param(sus_inv, rem_inv, rho_inv)
-        self.Frechet = np.zeros((self.ndat, self.n_param))
-        icol = 0
-        nrow = 0
+        labels = []
         self.params = []
         if sus_inv:
-            nrow1 = nrow + n_data
-            for i, key in enumerate(self.prisms.keys()):
-                self.Frechet[nrow:nrow1, i+icol] = self.prisms[key].sus_der
-                self.params.append(self.prisms[key].sus)
-            if not rem_inv:
-                nrow += n_data
-                nrow1 = nrow + n_data
-            icol += self.n_prisms
+            for key, val in self.prisms.items():
+                labels.append(("sus_der", key))
+                self.params.append(val.sus)
         if rem_inv:
-            for i, key in enumerate(self.prisms.keys()):
-                self.Frechet[nrow:nrow1, i+icol] = self.prisms[key].rem_der
-                self.params.append(self.prisms[key].rem)
-            nrow += n_data
-            icol += self.n_prisms
+            for key, val in self.prisms.items():
+                labels.append(("rem_der", key))
+                self.params.append(val.rem)
         if rho_inv:
-            nrow1 = nrow + n_data
-            for i, key in enumerate(self.prisms.keys()):
-                self.Frechet[nrow:nrow1, i+icol] = self.prisms[key].rho_der
-                self.params.append(self.prisms[key].rho)
+            for key, val in self.prisms.items():
+                labels.append(("rho_der", key))
+                self.params.append(val.rho)
+        labels.append(("zero_level", None))
         self.params.append(0.)
-        self.Frechet[:, -1] = 1.
         self.params = np.array(self.params)
-        return np.copy(self.Frechet)
+        if sparse_store:
+            self.Frechet = self.create_sparse_Frechet(
+                labels, xp, yp, zp, row_mag, row_grav, threshold, cutoff,
+                callback, cancel)
+            return self.Frechet
+# A new store is needed if data points, inverted properties or the Earth's
+#    field have changed
+        setup = (sus_inv, rem_inv, rho_inv, np.dtype(dtype), store_file,
+                 self.earth.f, self.earth.inc, self.earth.dec)
+        if self.frechet_store is None or self.frechet_setup != setup or\
+                not np.array_equal(self.frechet_points, np.array([xp, yp, zp])):
+            self.frechet_store = None
+            self.frechet_store = FrechetStore(self.ndat, self.n_param, dtype,
+                                              store_file)
+            self.frechet_setup = setup
+            self.frechet_points = np.array([xp, yp, zp])
+        new = self.frechet_store.update(labels)
+        buffer = self.frechet_store.buffer
+        position = {labels[i]: i for i in new}
+        if ("zero_level", None) in position:
+            buffer[:, position[("zero_level", None)]] = 1.
+# The store already lists the new columns. If their calculation is
+#    interrupted (cancellation or error), it is dropped, since it would
+#    otherwise be reused later with columns of zeros
+        try:
+            keys = [key for key in self.prisms if ("sus_der", key) in position
+                    or ("rem_der", key) in position]
+            if len(keys) > 0:
+                for i0, i1, der in self.deriv_chunks(
+                        keys, xp, yp, zp, "mag",
+                        Progress(callback, cancel, "magnetic derivatives")):
+                    for name, d in zip(("sus_der", "rem_der"),
+                                       self.combine_unit_deriv(
+                                           keys[i0:i1], der, sus_inv,
+                                           rem_inv)):
+                        if d is not None:
+                            cols = [position[(name, key)]
+                                    for key in keys[i0:i1]]
+                            buffer[row_mag:row_mag+n_data, cols] = d.T
+            keys = [key for key in self.prisms
+                    if ("rho_der", key) in position]
+            if len(keys) > 0:
+                for i0, i1, der in self.deriv_chunks(
+                        keys, xp, yp, zp, "grav",
+                        Progress(callback, cancel, "gravity derivatives")):
+                    cols = [position[("rho_der", key)]
+                            for key in keys[i0:i1]]
+                    buffer[row_grav:row_grav+n_data, cols] = der[0].T
+        except BaseException:
+            self.frechet_store = None
+            raise
+        if self.frechet_store.filename is not None:
+            buffer.flush()
+        print(f"Frechet matrix: {len(new)} of {len(labels)} columns "
+              + "calculated")
+        self.Frechet = self.frechet_store.matrix()
+        return self.Frechet
+
+    def create_sparse_Frechet(self, labels, xp, yp, zp, row_mag, row_grav,
+                              threshold, cutoff, callback=None, cancel=None):
+        """
+        Assemble the Frechet matrix in compressed sparse row format. Entries
+        that are small with respect to the maximum of their column or that
+        belong to data points far away from the prism are not stored.
+        Columns are calculated chunk by chunk of prisms (see deriv_chunks)
+        and truncated immediately, so that the dense matrix never exists.
+        The fraction of kept entries and of discarded energy (sum of squares
+        of dropped entries divided by sum of squares of all entries) are
+        printed.
+
+        Parameters
+        ----------
+        labels : list of tuples (name, key)
+            Columns of the matrix (see create_Frechet)
+        xp, yp, zp : 1D numpy float arrays
+            Coordinates of data points
+        row_mag, row_grav : int
+            First rows of magnetic and gravity data
+        threshold : float
+            Relative threshold with respect to the column maximum
+        cutoff : float
+            Maximum horizontal distance between data points and prism
+            centers. If 0, no distance truncation is done.
+        callback, cancel : optional; default: None
+            Progress callback and cancellation token (see Progress)
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix [self.ndat, len(labels)]
+
+        """
+        n_data = len(xp)
+        position = {label: i for i, label in enumerate(labels)}
+        indices = []
+        columns = []
+        values = []
+        energy = 0.
+        energy_kept = 0.
+
+        def truncate(names, keys, blocks, row0):
+            nonlocal energy, energy_kept
+            keep = np.abs(blocks) >= threshold*np.abs(blocks).max(
+                axis=-1, keepdims=True)
+            keep &= blocks != 0.
+            if cutoff > 0.:
+                x, y, _ = self.get_prism_coor(keys)
+                keep &= np.hypot(xp - x.mean(axis=1)[:, None],
+                                 yp - y.mean(axis=1)[:, None]) <= cutoff
+            energy += (blocks**2).sum()
+            for name, block, k in zip(names, blocks, keep):
+                col, row = np.nonzero(k)
+                val = block[col, row]
+                energy_kept += (val**2).sum()
+                indices.append(row + row0)
+                columns.append(np.array([position[(name, key)]
+                                         for key in keys])[col])
+                values.append(val)
+
+        keys = list(self.prisms.keys())
+        inverted = {name for name, _ in labels}
+        names = [name for name in ("sus_der", "rem_der") if name in inverted]
+        if len(names) > 0:
+            for i0, i1, der in self.deriv_chunks(
+                    keys, xp, yp, zp, "mag",
+                    Progress(callback, cancel, "magnetic derivatives")):
+                blocks = [d for d in self.combine_unit_deriv(
+                    keys[i0:i1], der, "sus_der" in names, "rem_der" in names)
+                    if d is not None]
+                truncate(names, keys[i0:i1], np.array(blocks), row_mag)
+        if "rho_der" in inverted:
+            for i0, i1, der in self.deriv_chunks(
+                    keys, xp, yp, zp, "grav",
+                    Progress(callback, cancel, "gravity derivatives")):
+                truncate(["rho_der"], keys[i0:i1], der, row_grav)
+        indices.append(np.arange(self.ndat))
+        columns.append(np.full(self.ndat, position[("zero_level", None)]))
+        values.append(np.ones(self.ndat))
+        G = sparse.coo_matrix((np.concatenate(values),
+                               (np.concatenate(indices),
+                                np.concatenate(columns))),
+                              shape=(self.ndat, len(labels))).tocsr()
+        n_entries = (len(labels)-1)*n_data + self.ndat
+        discarded = 0.
+        if energy > 0.:
+            discarded = (energy-energy_kept)/energy*100.
+        print(f"Sparse Frechet matrix: {G.nnz/n_entries*100.:0.1f}% of "
+              + f"entries kept, discarded energy: {discarded:0.4f}%")
+        return G
+
+    def create_operator(self, sus_inv, rem_inv, rho_inv, xp, yp, zp):
+        """
+        Create a matrix-free linear operator equivalent to the Frechet matrix
+        of create_Frechet (same ordering of data and parameters). Products
+        with the operator and its transpose are calculated layer by layer
+        with 2D FFT convolutions (see operators.FFTSensitivity).
+
+        Parameters
+        ----------
+        sus_inv, rem_inv, rho_inv : bool
+            If True, susceptibilities, remanences, densities are model
+            parameters
+        xp, yp, zp : 1D numpy float arrays
+            Coordinates of data points
+
+        Returns
+        -------
+        operator : object of class operators.FFTSensitivity or None
+            None if data points do not form regular grids at constant heights
+            (one grid per sensor) of at least _MIN_GRID_POINTS points each,
+            e.g. for data on topography
+
+        """
+        xp = np.asarray(xp, dtype=np.float64)
+        yp = np.asarray(yp, dtype=np.float64)
+        zp = np.asarray(zp, dtype=np.float64)
+        segments = utils.grid_segments(xp, yp, zp)
+# Varying heights split the data into many small segments, for which FFTs
+#    are not worth it
+        if len(segments) == 0 or any(
+                g is None or g[2]*g[5] < _MIN_GRID_POINTS
+                for _, g in segments):
+            print("\nData points are not regularly gridded at constant "
+                  + "heights, matrix-free FFT operator cannot be used.")
+            return None
+        return FFTSensitivity(self, sus_inv, rem_inv, rho_inv, xp, yp, zp)
+
+    def create_wavelet_Frechet(self, sus_inv, rem_inv, rho_inv, xp, yp, zp,
+                               threshold=1.E-3, callback=None, cancel=None):
+        """
+        Create the Frechet matrix of create_Frechet compressed in the wavelet
+        domain (see operators.WaveletFrechet). Rows are calculated block by
+        block, each row is transformed with a Haar wavelet transform over the
+        prisms of every layer and only the significant coefficients are kept
+        in a sparse matrix.
+
+        Parameters
+        ----------
+        sus_inv, rem_inv, rho_inv : bool
+            If True, susceptibilities, remanences, densities are model
+            parameters
+        xp, yp, zp : 1D numpy float arrays
+            Coordinates of data points
+        threshold : float, optional; default: 1.E-3
+            Coefficients smaller than threshold times the maximum coefficient
+            of their row are dropped
+        callback, cancel : optional; default: None
+            Progress callback and cancellation token (see Progress)
+
+        Returns
+        -------
+        object of class operators.WaveletFrechet
+
+        """
+        return WaveletFrechet(self, sus_inv, rem_inv, rho_inv, xp, yp, zp,
+                              threshold, callback, cancel)
 
     def create_smooth(self, sus_inv, rem_inv, rho_inv, sigma_sus, sigma_rem,
                       sigma_rho, depth_ref):
@@ -810,6 +3434,9 @@ class Prism_calc(Prism, Earth):
         position [i,j] value is -1. i,j are numbers of neighbouring blocks (not
         block keys but position of the block in the dictionary)
         In the actual version, no smoothing in Z is done
+        Positions of neighbours are taken from the neighbour links of the
+        PrismSet and the matrix is assembled as sparse matrix, so that memory
+        and time are proportional to the number of prisms.
 
         Parameters
         ----------
@@ -830,64 +3457,50 @@ class Prism_calc(Prism, Earth):
 
         Returns
         -------
-        S : 2D numpy float array
+        S : scipy.sparse csr matrix
             Smoothing matrix mith size [n_params,n_params].
 
         """
-        S = np.zeros((self.n_param, self.n_param))
-        SS = np.zeros((self.n_prisms, self.n_prisms))
-        z_fac = np.zeros(self.n_prisms)
-        keys = np.array(list(self.prisms.keys()))
-# Check whether neighbouring block in X direction exists
-        for i, key in enumerate(keys):
-            z_fac[i] = (self.prisms[key].z[0] + self.prisms[key].z[1])\
-                / (2*depth_ref)
-# Determine numbers of neighbouring blocks in dictionary
-            if len(self.prisms[key].x_neigh) > 0:
-                for kk in self.prisms[key].x_neigh:
-                    k = np.where(keys == kk)[0]
-# Add one to the diagonal positions of each block and set the position [i,k]
-#     and the symmetric one [k,i] to -1
-                    SS[i, i] += 1.
-                    SS[k, k] += 1.
-                    SS[k, i] = -1.
-                    SS[i, k] = -1.
-# Do the same for neighbouring blocks in Y direction
-            if len(self.prisms[key].y_neigh) > 0:
-                for kk in self.prisms[key].y_neigh:
-                    k = np.where(keys == kk)[0]
-                    SS[i, i] += 1.
-                    SS[k, k] += 1.
-                    SS[k, i] = -1.
-                    SS[i, k] = -1.
+        pset = self.get_prism_set()
+        z_fac = pset.centers()[2]/depth_ref
+# Positions of neighbouring blocks in X and Y direction in dictionary.
+# Add one to the diagonal positions of each block for every link and set the
+#     position [i,k] and the symmetric one [k,i] to -1 (once, even if a link
+#     is stored twice)
+        links = np.concatenate((pset.x_links, pset.y_links))
+        i = pset.positions(links[:, 0])
+        k = pset.positions(links[:, 1])
+        pairs = np.unique(np.column_stack((np.minimum(i, k),
+                                           np.maximum(i, k))), axis=0)
+        rows = np.concatenate((i, k, pairs[:, 0], pairs[:, 1]))
+        cols = np.concatenate((i, k, pairs[:, 1], pairs[:, 0]))
+        vals = np.concatenate((np.ones(2*len(i)), -np.ones(2*len(pairs))))
 
 # If inversion is done for at least two different parameter types, set the
 #    smmothing parameters for the second parameter type
         z_fac[:] = 1.
+        vals *= z_fac[rows]*z_fac[cols]
+        S_rows = []
+        S_cols = []
+        S_vals = []
         n0 = 0
-        n1 = self.n_prisms
-        if sus_inv:
-            S[n0:n1, n0:n1] = SS/sigma_sus**2
-            for i in range(len(keys)):
-                S[i, :] *= z_fac[i]
-                S[:, i] *= z_fac[i]
-            n0 = n1
-            n1 += self.n_prisms
-        if rem_inv:
-            S[n0:n1, n0:n1] = SS/sigma_rem**2
-            for i in range(len(keys)):
-                S[i+n0, :] *= z_fac[i]
-                S[:, i+n0] *= z_fac[i]
-            n0 = n1
-            n1 += self.n_prisms
-        if rho_inv:
-            S[n0:n1, n0:n1] = SS/sigma_rem**2
-            for i in range(len(keys)):
-                S[i+n0, :] *= z_fac[i]
-                S[:, i+n0] *= z_fac[i]
-        return S
-
-    def get_max_prisms(self, data, deriv, max_lim=0.1, width=10):
+        for inv, sigma in ((sus_inv, sigma_sus), (rem_inv, sigma_rem),
+                           (rho_inv, sigma_rem)):
+            if not inv:
+                continue
+            S_rows.append(rows+n0)
+            S_cols.append(cols+n0)
+            S_vals.append(vals/sigma**2)
+            n0 += self.n_prisms
+        if not S_vals:
+            return sparse.csr_matrix((self.n_param, self.n_param))
+        return sparse.coo_matrix(
+            (np.concatenate(S_vals), (np.concatenate(S_rows),
+                                      np.concatenate(S_cols))),
+            shape=(self.n_param, self.n_param)).tocsr()
+
+    def get_max_prisms(self, data, deriv, max_lim=0.1, width=10, row0=0,
+                       col0=0):
         """
         Find maxima in the matrix data defined as points that are larger than
         all other points in an area if width points around. For maxima with
@@ -907,7 +3520,9 @@ class Prism_calc(Prism, Earth):
         deriv : numpy 2D array (ndata x n_parameters), ndata = nx*ny
             Frechet matrix linking data to parameters (if several classes of
             data and/or parameters are used, pass only the part corresponding
-            to one data/parameter class, i.e. pass a partial Frechet matrix)
+            to one data/parameter class, i.e. pass a partial Frechet matrix,
+            or give its position with row0 and col0). May also be a sparse
+            matrix or a matrix-free operator (see utils.matrix_row).
         max_lim : float, optional Default is 0.1
             Prisms having the strongest influence on data values larger than
             the formula given above will be split.
@@ -915,6 +3530,9 @@ class Prism_calc(Prism, Earth):
             A maximum is recognized if the value at a point (i,j) is larger
             than or equal to all other values within an area of
             (i-width:i+width, j-width:j+width)
+        row0, col0 : int, optional; default: 0
+            First row and column of the part of deriv corresponding to data
+            and to the prism parameters of one class
 
 
         Returns
@@ -942,7 +3560,8 @@ class Prism_calc(Prism, Earth):
                 i = pos[0]
             else:
                 i = pos[0]*nx + pos[1]
-            p = np.argmax(abs(deriv[i, :]))
+            p = np.argmax(abs(utils.matrix_row(deriv, row0+i)[
+                col0:col0+len(keys)]))
             key = keys[p]
             xpmn = self.prisms[key].x[0]
             xpmx = self.prisms[key].x[1]
@@ -1014,8 +3633,8 @@ class Prism_calc(Prism, Earth):
         sus_act = self.prisms[key].sus*4.*np.pi
         rem_act = self.prisms[key].rem
         rho_act = self.prisms[key].rho
-        inc_act = self.prisms[key].inc
-        dec_act = self.prisms[key].dec
+        inc_act = np.degrees(self.prisms[key].inc)
+        dec_act = np.degrees(self.prisms[key].dec)
         xpmn = self.prisms[key].x[0]
         xpmx = self.prisms[key].x[1]
         dx_act = xpmx-xpmn
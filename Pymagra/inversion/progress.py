@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Last modified: Oct 18, 2026
+
+@author: Hermann Zeyen
+        University Paris-Saclay
+
+Contains the following classes used to follow and stop long calculations
+(forward models, Frechet matrices, inversions):
+    Cancelled: Exception raised when a calculation has been cancelled
+
+    CancelToken: Flag that may be set from another thread (e.g. a button of
+    the GUI or a scheduler) to stop a calculation
+        Contains the following methods:
+        - __init__
+        - cancel: requests cancellation
+        - cancelled: tests whether cancellation has been requested
+        - check: raises Cancelled if cancellation has been requested
+
+    Progress: Counts processed items of a calculation and reports progress
+    to a callback function
+        Contains the following methods:
+        - __init__
+        - start: starts counting for a new calculation
+        - update: adds processed items and reports progress
+        - check: raises Cancelled if cancellation has been requested
+        - info: actual state of the calculation
+
+And the function:
+    - print_progress : callback printing progress on the terminal
+
+"""
+
+import threading
+import time
+import numpy as np
+
+
+class Cancelled(Exception):
+    """
+    Raised by CancelToken.check if cancellation has been requested
+    """
+
+
+class CancelToken():
+    """
+    Flag used to stop a calculation. The calculation checks the flag between
+    blocks of work (see Progress.update) and raises Cancelled if it is set.
+
+    Contains the following methods:
+
+    - __init__
+    - cancel: requests cancellation
+    - cancelled: tests whether cancellation has been requested
+    - check: raises Cancelled if cancellation has been requested
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        """
+        Request cancellation. May be called from any thread.
+        """
+        self.event.set()
+
+    def cancelled(self):
+        """
+        Returns
+        -------
+        bool
+            True if cancellation has been requested
+        """
+        return self.event.is_set()
+
+    def check(self):
+        """
+        Raise Cancelled if cancellation has been requested
+        """
+        if self.event.is_set():
+            raise Cancelled("Calculation cancelled")
+
+
+class Progress():
+    """
+    Counts processed items of a calculation (e.g. prism-point evaluations or
+    iterations) and reports progress to a callback function. Reports are
+    sent at most every "interval" seconds and once the calculation is
+    complete, so that callbacks cost nothing even for small blocks of work.
+
+    Contains the following methods:
+
+    - __init__
+    - start: starts counting for a new calculation
+    - update: adds processed items and reports progress
+    - check: raises Cancelled if cancellation has been requested
+    - info: actual state of the calculation
+    """
+
+    def __init__(self, callback=None, cancel=None, label="", interval=0.5):
+        """
+        Parameters
+        ----------
+        callback : callable, optional; default: None
+            Function called with a dictionary as returned by info
+        cancel : object of class CancelToken, optional; default: None
+            Token checked at every update
+        label : str, optional; default: ""
+            Name of the calculation passed to the callback
+        interval : float, optional; default: 0.5
+            Minimum time [s] between two calls to callback
+        """
+        self.callback = callback
+        self.cancel = cancel
+        self.interval = interval
+        self.start(0, label)
+
+    def start(self, total, label=None):
+        """
+        Start counting for a new calculation
+
+        Parameters
+        ----------
+        total : int
+            Number of items to be processed
+        label : str, optional; default: None
+            If given, new name of the calculation
+        """
+        if label is not None:
+            self.label = label
+        self.total = total
+        self.done = 0
+        self.t0 = time.perf_counter()
+        self.t_last = -np.inf
+        self.check()
+
+    def update(self, n=1):
+        """
+        Add processed items, call the callback function if it is due and
+        check for cancellation
+
+        Parameters
+        ----------
+        n : int, optional; default: 1
+            Number of items processed since the last call
+        """
+        self.done += n
+        if self.callback is not None:
+            t = time.perf_counter()
+            if t-self.t_last >= self.interval or self.done >= self.total:
+                self.t_last = t
+                self.callback(self.info())
+        self.check()
+
+    def check(self):
+        """
+        Raise Cancelled if cancellation has been requested
+        """
+        if self.cancel is not None:
+            self.cancel.check()
+
+    def info(self):
+        """
+        Returns
+        -------
+        dictionary with entries
+            "label" : name of the calculation
+            "done", "total" : processed and total number of items
+            "elapsed" : time since start [s]
+            "rate" : processed items per second
+            "eta" : estimated remaining time [s] (nan if unknown)
+        """
+        elapsed = time.perf_counter()-self.t0
+        rate = self.done/elapsed if elapsed > 0. else 0.
+        eta = np.nan
+        if rate > 0.:
+            eta = max(self.total-self.done, 0)/rate
+        return {"label": self.label, "done": self.done, "total": self.total,
+                "elapsed": elapsed, "rate": rate, "eta": eta}
+
+
+def print_progress(info):
+    """
+    Callback printing the state of a calculation on one terminal line
+
+    Parameters
+    ----------
+    info : dictionary
+        State of the calculation (see Progress.info)
+    """
+    end = "\n" if info["done"] >= info["total"] else ""
+    print(f"\r{info['label']}: {info['done']} of {info['total']} "
+          + f"({info['rate']:0.3g}/s, {info['eta']:0.0f} s remaining)",
+          end=end, flush=True)
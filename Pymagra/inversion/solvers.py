@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+Last modified: Oct 18, 2026
+
+@author: Hermann Zeyen
+        University Paris-Saclay
+
+Contains the following functions solving the linear systems of the inversion
+(see inversion.run_inversion):
+    - solve_normal : solves the regularized normal equations by Cholesky
+      factorization
+    - add_smoothing : adds a (sparse) smoothing matrix to a dense matrix
+    - use_data_space : decides whether the data-space formulation is used
+    - normal_diagonal : diagonal of G.T*Cd*G without forming the matrix
+    - solve_data_space : solves the regularized least-squares problem in data
+      space
+    - solve_cg : solves the regularized least-squares problem by matrix-free
+      preconditioned conjugate gradients
+    - solve_positive : fits data with positive prism parameters by
+      Gauss-Newton iterations on the logarithms of the parameters
+
+"""
+
+import numpy as np
+from scipy import linalg, sparse
+from scipy.sparse import linalg as sp_linalg
+from . import mag_grav_utilities as utils
+
+
+def solve_normal(A, b):
+    """
+    Solve the regularized normal equations A x = b.
+    A (G.T*Cd*G + regularization + smoothing) is symmetric and positive
+    definite, so that it is factorized by Cholesky decomposition and the
+    system solved with the factors, which is about three times faster and
+    more accurate than forming the inverse of A.
+    If A is not numerically positive definite (e.g. regularization much
+    smaller than rounding errors), an LU solver is used.
+
+    Parameters
+    ----------
+    A : numpy 2D float array [n_param, n_param]
+        Symmetric positive definite matrix
+    b : numpy float array [n_param] or [n_param, n_rhs]
+        Right hand side(s)
+
+    Returns
+    -------
+    x : numpy float array of the shape of b
+        Solution
+
+    """
+    try:
+        factors = linalg.cho_factor(A, lower=True, check_finite=False)
+    except linalg.LinAlgError:
+        print("\nWarning: normal matrix not positive definite, "
+              + "LU solver used")
+        return linalg.solve(A, b, check_finite=False)
+    return linalg.cho_solve(factors, b, check_finite=False)
+
+
+def add_smoothing(A, smooth):
+    """
+    Add a smoothing matrix to a dense matrix in place. For a sparse
+    smoothing matrix, only its non-zero elements are added.
+
+    Parameters
+    ----------
+    A : numpy 2D float array [n_param, n_param]
+        Matrix to be modified (e.g. G.T*Cd*G)
+    smooth : numpy 2D float array or scipy sparse matrix [n_param, n_param]
+        Smoothing matrix
+
+    Returns
+    -------
+    A : numpy 2D float array [n_param, n_param]
+        Modified matrix
+
+    """
+    if sparse.issparse(smooth):
+        smooth = smooth.tocoo()
+        np.add.at(A, (smooth.row, smooth.col), smooth.data)
+    else:
+        A += smooth
+    return A
+
+
+def use_data_space(G, mode="auto"):
+    """
+    Decide whether the regularized least-squares problem is solved in data
+    space (see solve_data_space) or in parameter space (see solve_normal)
+
+    Parameters
+    ----------
+    G : numpy 2D float array, scipy sparse matrix or LinearOperator
+        Frechet matrix [n_data, n_param]
+    mode : str, optional; default: "auto"
+        "parameter" or "data" to force one formulation. With "auto", the data
+        space formulation is used if there are less data than prism
+        parameters. With "cg", the parameter space system is solved
+        iteratively (see solve_cg).
+        The data space formulation needs a dense Frechet matrix (numpy array
+        or memmap), for other types the parameter space is always used.
+
+    Returns
+    -------
+    bool
+        True if the data space formulation is to be used
+
+    """
+    if not isinstance(G, np.ndarray) or mode in ("parameter", "cg"):
+        return False
+    if mode == "data":
+        return True
+    return G.shape[0] < G.shape[1]-1
+
+
+def normal_diagonal(G, sigma_data, scale=None):
+    """
+    Diagonal of G.T*Cd*G, calculated without forming the matrix. Since the
+    matrix is positive semi-definite, its maximum is also the maximum
+    absolute value of the matrix.
+    Operators having a method normal_diagonal(sigma_data) calculate the
+    diagonal themselves, operators giving access to blocks of rows are
+    reconstructed block by block. For other matrix-free operators, the
+    diagonal is not available and zeros are returned.
+
+    Parameters
+    ----------
+    G : numpy 2D float array, scipy sparse matrix or LinearOperator
+        [n_data, n_param]
+        Frechet matrix
+    sigma_data : numpy 1D float array [n_data]
+        Diagonal of the inverse data covariance matrix Cd
+    scale : numpy 1D float array [n_param], optional; default: None
+        If given, columns of G are multiplied by scale
+
+    Returns
+    -------
+    numpy 1D float array [n_param]
+
+    """
+    if isinstance(G, np.ndarray):
+        diag = np.einsum("ij,ij,i->j", G, G, sigma_data)
+    elif sparse.issparse(G):
+        diag = np.asarray(G.multiply(G).T @ sigma_data).ravel()
+    elif hasattr(G, "normal_diagonal"):
+        diag = G.normal_diagonal(sigma_data)
+    else:
+        diag = np.zeros(G.shape[1])
+        if hasattr(G, "__getitem__"):
+            n_block = max(1, utils._BLOCK_ELEMENTS//G.shape[1])
+            for i0 in range(0, G.shape[0], n_block):
+                rows = slice(i0, i0+n_block)
+                g = G[rows, :]
+                diag += np.einsum("ij,ij,i->j", g, g, sigma_data[rows])
+    if scale is not None:
+        diag *= scale**2
+    return diag
+
+
+def solve_data_space(G, sigma_data, data, reg, smooth, scale=None):
+    """
+    Solve the regularized least-squares problem
+
+        (G.T*Cd*G + diag(reg) + smooth) d = G.T*Cd*data
+
+    in data space. With R = diag(reg) + smooth restricted to the prism
+    parameters and A the prism columns of G, the solution is
+    d = R^-1*A.T*K^-1*(data - g0*c) with K = A*R^-1*A.T + Cd^-1, a system of
+    size [n_data, n_data] instead of [n_param, n_param].
+    The last parameter (zero level, column g0 of G) is not regularized. It
+    is eliminated exactly: c = (g0.T*K^-1*data)/(g0.T*K^-1*g0), which gives
+    the same solution as the parameter space system.
+
+    Parameters
+    ----------
+    G : numpy 2D float array [n_data, n_param]
+        Frechet matrix, the last column corresponding to the zero level
+    sigma_data : numpy 1D float array [n_data]
+        Diagonal of the inverse data covariance matrix Cd
+    data : numpy 1D float array [n_data]
+        Data (misfits) to be fitted
+    reg : numpy 1D float array [n_param]
+        Diagonal regularization (the last value is ignored)
+    smooth : numpy 2D float array or scipy sparse matrix [n_param, n_param]
+        Smoothing matrix (the last row and column are ignored)
+    scale : numpy 1D float array [n_param], optional; default: None
+        If given, columns of G are multiplied by scale
+
+    Returns
+    -------
+    d : numpy 1D float array [n_param]
+        Solution
+
+    """
+    A = G[:, :-1]
+    g0 = np.array(G[:, -1], dtype=np.float64)
+    if scale is not None:
+        A = A*scale[None, :-1]
+        g0 *= scale[-1]
+    R = sparse.csc_matrix(smooth[:-1, :-1]) + sparse.diags(reg[:-1])
+    R = sparse.csc_matrix(R)
+# B = R^-1*A.T; if there is no smoothing, R is diagonal
+    if R.nnz == np.count_nonzero(R.diagonal()):
+        B = A.T/R.diagonal()[:, None]
+    else:
+        B = sp_linalg.splu(R).solve(np.asarray(A.T, dtype=np.float64))
+    K = A @ B
+    K[np.diag_indices(K.shape[0])] += 1./sigma_data
+    factors = linalg.cho_factor(K, lower=True, overwrite_a=True,
+                                check_finite=False)
+    k = linalg.cho_solve(factors, np.column_stack((data, g0)),
+                         check_finite=False)
+    c = 0.
+    gkg = g0 @ k[:, 1]
+    if gkg > 0.:
+        c = (g0 @ k[:, 0])/gkg
+    return np.append(B @ (k[:, 0]-c*k[:, 1]), c)
+
+
+def solve_cg(G, sigma_data, data, reg, smooth, scale=None, tol=1.E-6,
+             max_iter=None):
+    """
+    Solve the regularized least-squares problem
+
+        (G.T*Cd*G + diag(reg) + smooth) d = G.T*Cd*data
+
+    by conjugate gradients preconditioned with the diagonal of the system
+    (see normal_diagonal).
+    Only products of G and of its transpose with vectors are needed, the
+    normal matrix is never formed, so that G may be any matrix-like object
+    (dense array or memmap read by blocks of rows, sparse matrix,
+    operators.FFTSensitivity, operators.WaveletFrechet).
+    Iterations stop when the norm of the residual of the system is smaller
+    than tol times the norm of its right hand side. If this is not reached
+    within max_iter iterations, a warning with the reached relative residual
+    is printed.
+    The normal equations are iterated rather than the least-squares problem
+    itself (CGLS, LSQR), because the smoothing matrix enters the system
+    directly and would otherwise need a square root factor.
+
+    Parameters
+    ----------
+    G : numpy 2D float array, scipy sparse matrix or LinearOperator
+        [n_data, n_param]
+        Frechet matrix
+    sigma_data : numpy 1D float array [n_data]
+        Diagonal of the inverse data covariance matrix Cd
+    data : numpy 1D float array [n_data]
+        Data (misfits) to be fitted
+    reg : numpy 1D float array [n_param]
+        Diagonal regularization
+    smooth : numpy 2D float array or scipy sparse matrix [n_param, n_param]
+        Smoothing matrix
+    scale : numpy 1D float array [n_param], optional; default: None
+        If given, columns of G are multiplied by scale
+    tol : float, optional; default: 1.E-6
+        Relative tolerance of the residual
+    max_iter : int, optional; default: None
+        Maximum number of iterations. If None, n_param.
+
+    Returns
+    -------
+    d : numpy 1D float array [n_param]
+        Solution
+    n_iter : int
+        Number of iterations done
+
+    """
+    n_param = G.shape[1]
+    if scale is None:
+        scale = np.ones(n_param)
+    if max_iter is None:
+        max_iter = n_param
+
+    def normal(v):
+        gv = utils.block_matvec(G, scale*v)
+        return scale*utils.block_rmatvec(G, sigma_data*gv) + reg*v\
+            + smooth @ v
+
+    b = scale*utils.block_rmatvec(G, sigma_data*data)
+    diag = normal_diagonal(G, sigma_data, scale) + reg + smooth.diagonal()
+    diag[diag <= 0.] = 1.
+    b_norm = np.linalg.norm(b)
+    d = np.zeros(n_param)
+    if b_norm == 0.:
+        return d, 0
+    r = b.copy()
+    z = r/diag
+    p = z.copy()
+    rz = r @ z
+    n_iter = 0
+    while n_iter < max_iter and np.linalg.norm(r) > tol*b_norm:
+        q = normal(p)
+        alpha = rz/(p @ q)
+        d += alpha*p
+        r -= alpha*q
+        z = r/diag
+        rz_new = r @ z
+        p = z + (rz_new/rz)*p
+        rz = rz_new
+        n_iter += 1
+    res = np.linalg.norm(r)/b_norm
+    if res > tol:
+        print(f"   Warning: conjugate gradients did not converge in {n_iter} "
+              + f"iterations, relative residual {res:.2e} > {tol:.2e}")
+    return d, n_iter
+
+
+def solve_positive(G, sigma_data, data, params, reg, smooth, mode="parameter",
+                   normal=None, p_min=1.E-7, p_max=1., tol=1.E-3, max_iter=50,
+                   cg_tol=1.E-6, cg_max_iter=None, progress=None):
+    """
+    Fit data with positive prism parameters. Prism parameters are written
+    p = exp(y) and the data misfit is minimized by damped Gauss-Newton
+    iterations on y, starting from the given model (warm start). Every step
+    solves
+
+        (F*G.T*Cd*G*F + diag(reg) + smooth) dy = F*G.T*Cd*(data - G*p)
+
+    where F = diag(p) is the derivative of p with respect to y (the last
+    parameter, zero level, is linear and not transformed). Along dy, a
+    backtracking line search accepts the longest step, not larger than the
+    one bringing any parameter to p_max, that reduces the data misfit.
+    Iterations stop when the largest accepted change of y is smaller than
+    tol (relative change of the parameters), when the misfit does not
+    decrease any more or after max_iter iterations.
+
+    Parameters
+    ----------
+    G : numpy 2D float array, scipy sparse matrix or LinearOperator
+        [n_data, n_param]
+        Frechet matrix, the last column corresponding to the zero level
+    sigma_data : numpy 1D float array [n_data]
+        Diagonal of the inverse data covariance matrix Cd
+    data : numpy 1D float array [n_data]
+        Data to be fitted
+    params : numpy 1D float array [n_param]
+        Starting model. Prism parameters must be positive.
+    reg : numpy 1D float array [n_param]
+        Diagonal regularization (damping) of the steps
+    smooth : numpy 2D float array or scipy sparse matrix [n_param, n_param]
+        Smoothing matrix applied to the steps
+    mode : str, optional; default: "parameter"
+        Solver of the linear systems: "parameter" (solve_normal), "data"
+        (solve_data_space) or "cg" (solve_cg)
+    normal : numpy 2D float array [n_param, n_param], optional; default: None
+        G.T*Cd*G, needed for mode "parameter". It does not depend on the
+        model and is only rescaled in every iteration.
+    p_min, p_max : floats, optional; defaults: 1.E-7, 1.
+        Smallest and largest allowed prism parameters
+    tol : float, optional; default: 1.E-3
+        Convergence limit of the model change
+    max_iter : int, optional; default: 50
+        Maximum number of Gauss-Newton iterations
+    cg_tol, cg_max_iter : float and int, optional; defaults: 1.E-6, None
+        Stopping criteria of solve_cg
+    progress : object of class progress.Progress, optional; default: None
+        Checked for cancellation before every iteration
+
+    Returns
+    -------
+    params : numpy 1D float array [n_param]
+        Fitted model
+    n_iter : int
+        Number of Gauss-Newton iterations done
+
+    """
+    params = np.copy(params)
+    params[:-1] = np.clip(params[:-1], p_min, p_max)
+    y = np.log(params[:-1])
+    y_max = np.log(p_max)
+    misfit = data - utils.block_matvec(G, params)
+    chi2 = misfit @ (sigma_data*misfit)
+    n_iter = 0
+    while n_iter < max_iter:
+        if progress is not None:
+            progress.check()
+        n_iter += 1
+        fac = np.copy(params)
+        fac[-1] = 1.
+        if mode == "cg":
+            dy, _ = solve_cg(G, sigma_data, misfit, reg, smooth, fac, cg_tol,
+                             cg_max_iter)
+        elif mode == "data":
+            dy = solve_data_space(G, sigma_data, misfit, reg, smooth, fac)
+        else:
+# F*G.T*Cd*G*F is built with a single temporary matrix
+            A = fac[:, None]*normal
+            A *= fac[None, :]
+            add_smoothing(A, smooth)
+            A[np.diag_indices(A.shape[0])] += reg
+            rhs = fac*utils.block_rmatvec(G, sigma_data*misfit)
+            dy = solve_normal(A, rhs)
+# Longest step: no parameter may become larger than p_max
+        step = 1.
+        up = dy[:-1] > 0.
+        if np.any(up):
+            step = min(step, ((y_max-y[up])/dy[:-1][up]).min())
+# Backtracking line search on the data misfit
+        for _ in range(10):
+            y_new = y+step*dy[:-1]
+            p_new = np.append(np.clip(np.exp(y_new), p_min, p_max),
+                              params[-1]+step*dy[-1])
+            misfit_new = data - utils.block_matvec(G, p_new)
+            chi2_new = misfit_new @ (sigma_data*misfit_new)
+            if chi2_new <= chi2:
+                break
+            step *= 0.5
+        else:
+            break
+        change = abs(np.log(p_new[:-1])-y).max()
+        decrease = (chi2-chi2_new)/chi2 if chi2 > 0. else 0.
+        y = np.log(p_new[:-1])
+        params = p_new
+        misfit = misfit_new
+        chi2 = chi2_new
+        if change < tol or decrease < 1.E-5:
+            break
+    return params, n_iter